@@ -7,8 +7,7 @@ from datetime import datetime, timedelta
 from data_loader import DataLoader
 from preprocess import Preprocess
 from models.trafo_model import TrafoModel
-from models.feeder_model import FeederModel
-from models.battery_model import BatteryModel
+from batch_runner import analyse_feeders
 import config
 
 warnings.filterwarnings('ignore')
@@ -31,7 +30,8 @@ def sanitize_df(df):
 @app.post("/get_results/")
 @app.get("/get_results/")
 def get_results(
-                number_of_trafos: int = None):
+                number_of_trafos: int = None,
+                feeder_workers: int = 1):
     """
     Finds transformer candidates and determines optimal battery parameters for each feeder.
      Args:
@@ -39,6 +39,8 @@ def get_results(
           
             number_of_trafos: int
                 number of transformers to process
+            feeder_workers: int
+                number of worker processes for feeders of each transformer
 
         Returns:
         --------
@@ -88,17 +90,10 @@ def get_results(
                                     df_p, df_q, trafo_name, config.NET_PATH)
                     tm.create_and_populate_snet()
 
-                    for feeder in tm.feeders:
-                        fm = FeederModel(tm, feeder)
-                        fm.calculate_uv_data_and_slopes()
-
-
-                        if fm.suitable_for_battery:
-                            bm = BatteryModel(fm)
-                            bm.calculate_battery_parameters()
-                            battery_res = pd.concat(
-                                [battery_res, fm.feeder_res],
-                                ignore_index=True)
+                    # results of feeders, where battery is needed
+                    battery_res = pd.concat(
+                        [battery_res, analyse_feeders(tm, feeder_workers=feeder_workers)],
+                        ignore_index=True)
 
             
             
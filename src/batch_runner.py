@@ -0,0 +1,319 @@
+import argparse
+import contextlib
+import copy
+import io
+import os
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from data_loader import DataLoader
+from preprocess import Preprocess
+from models.trafo_model import TrafoModel
+from models.feeder_model import FeederModel
+from models.battery_model import BatteryModel
+from utils import get_feeder_smms, get_data_from_smm_list
+import config
+
+
+def get_default_window():
+    """Returns start and end of the last year, ending at last midnight"""
+    last_midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return last_midnight - timedelta(days=365), last_midnight
+
+
+def init_worker():
+    """Initializer of worker processes, warnings of pandas and pandapower are not printed"""
+    warnings.filterwarnings('ignore')
+
+
+def get_feeder_trafo_model(tm, feeder):
+    """Returns copy of transformer model with voltage and undervoltage data of feeder smms only and
+    empty results, that is sent to a worker process. Worker unpickles its own snet, so feeders do not
+    share snet in populate_snet and powerflows"""
+    tm_feeder = copy.copy(tm)
+    smms = get_feeder_smms(tm.snet, feeder)
+    tm_feeder.voltage_data = get_data_from_smm_list(tm.voltage_data, smms)
+    tm_feeder.undervoltage_data = get_data_from_smm_list(tm.undervoltage_data, smms)
+    tm_feeder.trafo_res_df = pd.DataFrame()
+    tm_feeder.snet_full = None
+    return tm_feeder
+
+
+def analyse_feeder(tm, feeder, create_trafo_results=False):
+    """Calculates slopes and battery of feeder, results are added to tm.trafo_res_df"""
+    fm = FeederModel(tm, feeder)
+    fm.calculate_uv_data_and_slopes()
+    if create_trafo_results or fm.suitable_for_battery:
+        bm = BatteryModel(fm)
+        bm.calculate_battery_parameters()
+
+
+def process_feeder(tm_feeder, feeder, create_trafo_results=False):
+    """
+    Runs analyse_feeder in worker process.
+
+    Returns:
+    --------
+        trafo_res_df: pd.DataFrame
+            results of feeder
+        output: str
+            printed output of feeder
+        calibration_entries: dict
+            calibration cache entries of feeder
+        phase_slopes_cache: dict
+            phase slopes of feeder
+    """
+    init_worker()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        analyse_feeder(tm_feeder, feeder, create_trafo_results)
+    return (tm_feeder.trafo_res_df, output.getvalue(), tm_feeder.calibration_cache.entries,
+            tm_feeder.phase_slopes_cache)
+
+
+def analyse_feeders(tm, create_trafo_results=False, feeder_workers=1):
+    """
+    Calculates slopes and batteries of feeders of transformer, in parallel if feeder_workers > 1.
+
+    Each worker gets its own copy of snet and data of its feeder (see get_feeder_trafo_model). Results,
+    calibration cache and phase slopes of feeders are merged into tm in order of tm.feeders, output of
+    feeders is printed in the same order.
+    Args:
+    --------
+        tm: TrafoModel
+            transformer model with populated snet
+        create_trafo_results: bool
+            if True, results for all feeders are returned, otherwise only for feeders suitable for battery
+        feeder_workers: int
+            number of worker processes, feeders are analysed in this process if 1
+    Returns:
+    --------
+        trafo_res_df: pd.DataFrame
+            results of feeders
+    """
+    if feeder_workers == 1 or len(tm.feeders) == 1:
+        for feeder in tm.feeders:
+            analyse_feeder(tm, feeder, create_trafo_results)
+        return tm.trafo_res_df
+    with ProcessPoolExecutor(max_workers=min(feeder_workers, len(tm.feeders)), initializer=init_worker) \
+            as executor:
+        futures = [executor.submit(process_feeder, get_feeder_trafo_model(tm, feeder), feeder,
+                                   create_trafo_results)
+                   for feeder in tm.feeders]
+        for future in futures:
+            trafo_res_df, output, calibration_entries, phase_slopes_cache = future.result()
+            print(output, end="")
+            tm.trafo_res_df = pd.concat([tm.trafo_res_df, trafo_res_df], ignore_index=True)
+            # calibration entries are keyed by smms of the feeder, so feeders do not overwrite each other
+            tm.calibration_cache.entries.update(calibration_entries)
+            tm.phase_slopes_cache.update(phase_slopes_cache)
+    return tm.trafo_res_df
+
+
+def analyse_trafo(trafo_name, start, end, create_trafo_results=False, feeder_workers=1, n_representative=None):
+    """
+    Loads and preprocesses data of transformer and calculates battery for its feeders.
+
+    Args:
+    --------
+        trafo_name: str
+            name of transformer
+        start: datetime
+            start of data window
+        end: datetime
+            end of data window
+        create_trafo_results: bool
+            if True, results for all feeders are returned, otherwise only for feeders suitable for battery
+        feeder_workers: int
+            number of worker processes for feeders of transformer
+        n_representative: int
+            if set, batteries are sized on this number of representative days and on extreme days
+            (see TrafoModel.compress_period)
+    Returns:
+    --------
+        res_df: pd.DataFrame
+            results of feeders
+    """
+    res_df = pd.DataFrame()
+    dl = DataLoader(load_manual=False,
+                    trafo_name=trafo_name[:6],
+                    start=start,
+                    end=end)
+    voltage_data = dl.load_voltage_data()
+    pr = Preprocess(voltage_data)
+    voltage_data, undervoltage_data, trafo_suitable_for_battery = pr.preprocess_voltage_data_get_undervoltages()
+    if trafo_suitable_for_battery:
+        # There are undervoltages, we need to fix
+        power_data = dl.load_power_data()
+        df_vol, df_p, df_q = pr.preprocess_powers_create_pivot_tables(power_data)
+        tm = TrafoModel(voltage_data, undervoltage_data, df_vol, df_p,
+                        df_q, trafo_name, config.NET_PATH)
+        tm.create_and_populate_snet()
+        if n_representative is not None:
+            tm.compress_period(n_representative)
+        res_df = analyse_feeders(tm, create_trafo_results, feeder_workers)
+    elif create_trafo_results:
+        tm = TrafoModel(voltage_data, undervoltage_data, None, None,
+                        None, trafo_name, config.NET_PATH)
+        tm.create_and_populate_snet()
+        for feeder in tm.feeders:
+            fm = FeederModel(tm, feeder)
+            fm.calculate_and_write_uv_data(empty_battery_columns=True)
+            res_df = pd.concat([res_df, fm.feeder_res], ignore_index=True)
+    return res_df
+
+
+def process_trafo(trafo_name, start, end, create_trafo_results=False, log_dir=None, feeder_workers=1,
+                  n_representative=None):
+    """
+    Runs analyse_trafo isolated from other transformers: warnings are ignored, output and errors are
+    written to log file of the transformer (or discarded, if log_dir is None).
+
+    Returns:
+    --------
+        trafo_name: str
+            name of transformer
+        res_df: pd.DataFrame
+            results of feeders, empty if analysis failed
+        error: str
+            error message, None if analysis succeeded
+    """
+    init_worker()
+    if log_dir is not None:
+        log = open(os.path.join(log_dir, "{}.log".format(trafo_name)), "w", encoding="utf-8")
+    else:
+        log = io.StringIO()
+    res_df, error = pd.DataFrame(), None
+    with log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            res_df = analyse_trafo(trafo_name, start, end, create_trafo_results, feeder_workers,
+                                   n_representative)
+        except Exception as e:
+            traceback.print_exc()
+            error = repr(e)
+    return trafo_name, res_df, error
+
+
+def run_batch(trafos_list, start, end, workers=1, create_trafo_results=False, log_dir=None,
+              feeder_workers=1, n_representative=None):
+    """
+    Analyses transformers, distributed over a pool of worker processes.
+
+    Args:
+    --------
+        trafos_list: list
+            names of transformers
+        start: datetime
+            start of data window
+        end: datetime
+            end of data window
+        workers: int
+            number of worker processes, transformers are analysed in this process if 1
+        create_trafo_results: bool
+            if True, results for all feeders are returned, otherwise only for feeders suitable for battery
+        log_dir: str
+            folder for log files of transformers
+        feeder_workers: int
+            number of worker processes for feeders of each transformer, see analyse_feeders
+        n_representative: int
+            number of representative days for sizing, all days are used if None
+    Returns:
+    --------
+        res_df: pd.DataFrame
+            results of all transformers, in order of trafos_list
+        errors: dict
+            transformer -> error message of failed transformers
+    """
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+    results, errors = {}, {}
+
+    def collect(trafo_name, res_df, error):
+        results[trafo_name] = res_df
+        if error is not None:
+            errors[trafo_name] = error
+        print(trafo_name, "failed: " + error if error is not None else "done",
+              "({}/{})".format(len(results), len(trafos_list)))
+
+    if workers == 1:
+        for trafo_name in trafos_list:
+            collect(*process_trafo(trafo_name, start, end, create_trafo_results, log_dir, feeder_workers,
+                                   n_representative))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = [executor.submit(process_trafo, trafo_name, start, end, create_trafo_results, log_dir,
+                                       feeder_workers, n_representative)
+                       for trafo_name in trafos_list]
+            for future in as_completed(futures):
+                collect(*future.result())
+    res_df = pd.concat([results[trafo_name] for trafo_name in trafos_list], ignore_index=True) \
+        if trafos_list else pd.DataFrame()
+    return res_df, errors
+
+
+def get_trafos_list(args):
+    """Returns transformers from command line arguments: names, file with names or candidates query"""
+    if args.trafos:
+        trafos_list = args.trafos
+    elif args.trafo_file:
+        with open(args.trafo_file, encoding="utf-8") as f:
+            trafos_list = [line.strip() for line in f if line.strip()]
+    else:
+        trafos_list = DataLoader().find_trafo_candidates()
+    if args.number_of_trafos is not None:
+        trafos_list = trafos_list[:args.number_of_trafos]
+    return trafos_list
+
+
+def parse_args(args=None):
+    """Parses command line arguments of batch runner"""
+    parser = argparse.ArgumentParser(description="Calculates batteries for feeders of transformers")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--trafos", nargs="+", help="names of transformers")
+    source.add_argument("--trafo-file", help="file with a name of transformer in each line")
+    source.add_argument("--candidates", action="store_true",
+                        help="transformers with undervoltages from database (default)")
+    parser.add_argument("--number-of-trafos", type=int, help="number of transformers to process")
+    parser.add_argument("--start", help="start of data window, default is one year before end")
+    parser.add_argument("--end", help="end of data window, default is last midnight")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--feeder-workers", type=int, default=1,
+                        help="number of worker processes for feeders of each transformer")
+    parser.add_argument("--representative-days", type=int,
+                        help="size batteries on this number of representative days and on extreme days")
+    parser.add_argument("--trafo-results", action="store_true",
+                        help="save results for all feeders, not only for feeders suitable for battery")
+    parser.add_argument("--log-dir", default="logs", help="folder for log files of transformers")
+    parser.add_argument("--output", default="battery_res.csv", help="results file, .csv or .xlsx")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    start, end = get_default_window()
+    if args.end is not None:
+        end = pd.Timestamp(args.end).to_pydatetime()
+        start = end - timedelta(days=365)
+    if args.start is not None:
+        start = pd.Timestamp(args.start).to_pydatetime()
+    trafos_list = get_trafos_list(args)
+    print(len(trafos_list), "transformers from", start, "to", end)
+    time0 = time.time()
+    res_df, errors = run_batch(trafos_list, start, end, workers=args.workers,
+                               create_trafo_results=args.trafo_results, log_dir=args.log_dir,
+                               feeder_workers=args.feeder_workers, n_representative=args.representative_days)
+    if args.output.endswith(".xlsx"):
+        res_df.to_excel(args.output, index=False)
+    else:
+        res_df.to_csv(args.output, index=False)
+    print(len(errors), "transformers failed")
+    print(time.time() - time0)
+
+
+if __name__ == "__main__":
+    main()
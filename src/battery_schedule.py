@@ -0,0 +1,482 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """numba is optional, without it the scan runs in python"""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+PHASE_COLUMNS = ["u_1", "u_2", "u_3"]
+
+
+def create_voltage_array(voltage_data, dates, smms):
+    """
+    Creates dense array of phase voltages from voltage data.
+
+    Args:
+    --------
+        voltage_data: pd.DataFrame
+            voltage data with date_time, smm and u_1, u_2, u_3 columns
+        dates: array
+            datetimes, first axis of the array
+        smms: list
+            smms, second axis of the array
+    Returns:
+    --------
+        volts: np.array
+            phase voltages with shape (dates, smms, 3), NaN where data is missing
+        present: np.array
+            boolean array with shape (dates, smms), True where voltage data has a row for smm and date
+    """
+    data = voltage_data.drop_duplicates(["date_time", "smm"])
+    date_idx = pd.Index(dates).get_indexer(data.date_time)
+    smm_idx = pd.Index(smms).get_indexer(data.smm)
+    valid = (date_idx >= 0) & (smm_idx >= 0)
+    volts = np.full((len(dates), len(smms), 3), np.nan)
+    present = np.zeros((len(dates), len(smms)), dtype=bool)
+    volts[date_idx[valid], smm_idx[valid]] = data[PHASE_COLUMNS].values[valid].astype(float)
+    present[date_idx[valid], smm_idx[valid]] = True
+    return volts, present
+
+
+class VoltageIndex:
+    """Voltage data sorted by datetime position, so voltage arrays of datetime windows are built
+    without scanning all voltage data
+
+    Args:
+    --------
+        voltage_data: pd.DataFrame
+            voltage data with date_time, smm and u_1, u_2, u_3 columns
+        dates: array
+            all datetimes of the schedule
+        smms: list
+            smms, second axis of voltage arrays
+    """
+
+    def __init__(self, voltage_data, dates, smms):
+        data = voltage_data.drop_duplicates(["date_time", "smm"])
+        date_idx = pd.Index(dates).get_indexer(data.date_time)
+        smm_idx = pd.Index(smms).get_indexer(data.smm)
+        valid = (date_idx >= 0) & (smm_idx >= 0)
+        order = np.argsort(date_idx[valid], kind="stable")
+        self.date_idx = date_idx[valid][order]
+        self.smm_idx = smm_idx[valid][order]
+        self.volts = data[PHASE_COLUMNS].values[valid][order].astype(float)
+        self.n_dates = len(dates)
+        self.n_smms = len(smms)
+
+    def get_array(self, positions):
+        """Returns voltage array and mask of present data (see create_voltage_array) for datetimes at
+        given positions"""
+        positions = np.asarray(positions)
+        if len(positions) > 0 and positions[-1] - positions[0] + 1 == len(positions):
+            # window of consecutive datetimes, its rows are found with binary search
+            rows = slice(np.searchsorted(self.date_idx, positions[0]),
+                         np.searchsorted(self.date_idx, positions[-1], side="right"))
+            rows_date = self.date_idx[rows] - positions[0]
+        else:
+            local = np.full(self.n_dates, -1)
+            local[positions] = np.arange(len(positions))
+            rows = local[self.date_idx] >= 0
+            rows_date = local[self.date_idx[rows]]
+        rows_smm = self.smm_idx[rows]
+        volts = np.full((len(positions), self.n_smms, 3), np.nan)
+        present = np.zeros((len(positions), self.n_smms), dtype=bool)
+        volts[rows_date, rows_smm] = self.volts[rows]
+        present[rows_date, rows_smm] = True
+        return volts, present
+
+
+def calculate_voltage_diffs(volts, present, vol_lim, missing_diff=0.):
+    """
+    Calculates voltage deviations (V) from vol_lim for each phase.
+
+    Missing data gets missing_diff, like in loop version of BatteryModel: missing rows for all phases,
+    not finite voltages for phases 2 and 3. Not finite voltage on phase 1 stays NaN.
+    """
+    diffs = vol_lim * 230 - volts
+    diffs[:, :, 0] = np.where(present, diffs[:, :, 0], missing_diff)
+    for phase in (1, 2):
+        diffs[:, :, phase] = np.where(present & np.isfinite(volts[:, :, phase]), diffs[:, :, phase],
+                                      missing_diff)
+    return diffs
+
+
+def calculate_smm_powers(diffs, slopes, fix_all_phases=True, charging=False):
+    """
+    Calculates battery power needed to fix voltage at each smm.
+
+    Args:
+    --------
+        diffs: np.array
+            voltage deviations with shape (dates, smms, 3)
+        slopes: np.array
+            slopes with shape broadcastable to (dates, smms, 3)
+        fix_all_phases: bool
+            if True, positive (negative when charging) phase powers are summed, otherwise all
+        charging: bool
+            if True, powers for charging are calculated
+    Returns:
+    --------
+        powers: np.array
+            powers with shape (dates, smms)
+    """
+    p = diffs / slopes / 3
+    p1, p2, p3 = p[:, :, 0], p[:, :, 1], p[:, :, 2]
+    if not fix_all_phases:
+        return p1 + p2 + p3
+    if charging:
+        return p1 * (p1 < 0) + p2 * (p2 < 0) + p3 * (p3 < 0)
+    return p1 * (p1 > 0) + p2 * (p2 > 0) + p3 * (p3 > 0)
+
+
+def max_over_smms(powers):
+    """Maximum over smms (axis 1) with the same NaN handling as built-in max over a list:
+    NaN if power of the first smm is NaN, otherwise NaN powers are ignored"""
+    if powers.shape[1] == 0:
+        return np.full(powers.shape[0], np.nan)
+    result = np.fmax.reduce(powers, axis=1)
+    return np.where(np.isnan(powers[:, 0]), np.nan, result)
+
+
+def calculate_segment_energies(powers, block_starts=None):
+    """
+    Labels segments of consecutive nonzero powers and sums powers of each segment.
+
+    Only closed segments, that are followed by zero power or by the start of the next block, are
+    returned, segment that lasts until the end of the schedule is not.
+    Args:
+    --------
+        powers: np.array
+            battery powers, kW
+        block_starts: np.array
+            positions of first datetimes of blocks of consecutive datetimes (see simulate_soc_blocks),
+            segments do not continue over block boundaries
+    Returns:
+    --------
+        starts: np.array
+            positions of first powers of segments
+        ends: np.array
+            positions of last powers of segments
+        sums: np.array
+            sums of powers of segments, kW (energy is sum / 6 for 10 minute data)
+    """
+    powers = np.asarray(powers, dtype=float)
+    nonzero = powers != 0
+    previous = np.concatenate(([False], nonzero[:-1]))
+    following = np.concatenate((nonzero[1:], [True]))
+    if block_starts is not None:
+        block_starts = np.asarray(block_starts, dtype=int)
+        block_starts = block_starts[block_starts > 0]
+        previous[block_starts] = False
+        following[block_starts - 1] = False
+    starts = np.where(nonzero & ~previous)[0]
+    ends = np.where(nonzero & ~following)[0]
+    # every start before the last end belongs to a closed segment
+    starts = starts[:len(ends)]
+    if len(starts) == 0:
+        return starts, ends, np.zeros(0)
+    bounds = np.column_stack((starts, ends + 1)).ravel()
+    sums = np.add.reduceat(powers, bounds)[::2]
+    return starts, ends, sums
+
+
+def calculate_max_segment_sums(powers):
+    """
+    Maximal sum of powers of closed segments (see calculate_segment_energies) for every row of 2d
+    powers array at once.
+
+    Returns:
+    --------
+        max_sums: np.array
+            maximal segment sum of each row, 0 if there is no segment with positive sum
+    """
+    powers = np.asarray(powers, dtype=float)
+    n_rows, n_cols = powers.shape
+    max_sums = np.zeros(n_rows)
+    if n_cols == 0:
+        return max_sums
+    nonzero = powers != 0
+    previous = np.zeros_like(nonzero)
+    previous[:, 1:] = nonzero[:, :-1]
+    following = np.ones_like(nonzero)
+    following[:, :-1] = nonzero[:, 1:]
+    cumulative = np.cumsum(powers, axis=1)
+    rows_start, cols_start = np.nonzero(nonzero & ~previous)
+    rows_end, cols_end = np.nonzero(nonzero & ~following)
+    # starts and ends are ordered by rows, so every end pairs with start of the same order in its row
+    n_ends = np.bincount(rows_end, minlength=n_rows)
+    n_starts = np.bincount(rows_start, minlength=n_rows)
+    first_start = np.concatenate(([0], np.cumsum(n_starts)[:-1]))
+    first_end = np.concatenate(([0], np.cumsum(n_ends)[:-1]))
+    order = np.arange(len(rows_end)) - first_end[rows_end]
+    starts = cols_start[first_start[rows_end] + order]
+    sums = cumulative[rows_end, cols_end] - np.where(starts > 0, cumulative[rows_end, starts - 1], 0)
+    np.maximum.at(max_sums, rows_end, sums)
+    return max_sums
+
+
+@njit(cache=True)
+def simulate_soc(is_uv, sp_max, max_power=150., soc_0=0.):
+    """
+    State of charge scan of battery schedule with charging.
+
+    At undervoltage datetimes battery discharges with sp_max, after them it charges with sp_max
+    (negative, limited by voltage headroom) while state of charge is negative. Charging power is
+    limited so that state of charge does not exceed 0. Powers not below max_power are unrealistic and set to 0.
+    Args:
+    --------
+        is_uv: np.array
+            boolean array, True at undervoltage datetimes
+        sp_max: np.array
+            discharging power at undervoltage datetimes and charging power at other datetimes, kW
+        max_power: float
+            limit of realistic power
+        soc_0: float
+            state of charge before the first datetime
+    Returns:
+    --------
+        powers: np.array
+            battery powers, kW
+        socs: np.array
+            state of charge after each datetime, kWh
+        too_high: np.array
+            boolean array, True where needed power was unrealistic
+    """
+    n = len(is_uv)
+    powers = np.zeros(n)
+    socs = np.zeros(n)
+    too_high = np.zeros(n, dtype=np.bool_)
+    soc = soc_0
+    for i in range(n):
+        if is_uv[i] or soc < 0:
+            sp = sp_max[i]
+            if sp < max_power:
+                if not is_uv[i]:
+                    if sp < soc * 6:
+                        sp = soc * 6
+                        soc = 0.
+                    else:
+                        soc -= sp / 6
+                else:
+                    soc -= sp / 6
+                powers[i] = sp
+            else:
+                too_high[i] = True
+        socs[i] = soc
+    return powers, socs, too_high
+
+
+@njit(cache=True)
+def simulate_soc_batch(is_uv, sp_max, max_power=150.):
+    """simulate_soc for every row of 2d sp_max (samples x datetimes), returns 2d powers and socs"""
+    powers = np.zeros(sp_max.shape)
+    socs = np.zeros(sp_max.shape)
+    for row in range(sp_max.shape[0]):
+        powers[row], socs[row], _ = simulate_soc(is_uv, sp_max[row], max_power)
+    return powers, socs
+
+
+def simulate_soc_blocks(is_uv, sp_max, block_starts, max_power=150.):
+    """simulate_soc for every block of consecutive datetimes, each block starts with full battery
+    (state of charge 0), as blocks of days kept by period compression are not consecutive in time"""
+    bounds = np.append(np.asarray(block_starts, dtype=int), len(is_uv))
+    results = [simulate_soc(is_uv[start:stop], sp_max[start:stop], max_power)
+               for start, stop in zip(bounds[:-1], bounds[1:])]
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def simulate_soc_events(uv_positions, discharge_sp, get_charge_sp, n_dates, max_power=150., window=144,
+                        block_starts=None):
+    """
+    Event driven version of simulate_soc.
+
+    State of charge changes only at undervoltage datetimes and while battery is recharged after them,
+    elsewhere battery is idle with power 0 and unchanged state of charge, so only these datetimes
+    are simulated. Charging powers are calculated lazily for windows of datetimes after events.
+    Args:
+    --------
+        uv_positions: np.array
+            increasing positions of undervoltage datetimes
+        discharge_sp: np.array
+            discharging powers at undervoltage datetimes
+        get_charge_sp: function
+            function (start, stop) -> charging powers for positions start, ..., stop - 1
+        n_dates: int
+            number of all datetimes
+        max_power: float
+            limit of realistic power
+        window: int
+            initial number of datetimes for which charging powers are calculated at once
+        block_starts: np.array
+            positions of first datetimes of blocks, that start with full battery (see simulate_soc_blocks)
+    Returns:
+    --------
+        positions: np.array
+            positions of simulated datetimes
+        powers: np.array
+            battery powers at simulated datetimes
+        socs: np.array
+            state of charge after simulated datetimes
+        too_high: np.array
+            True where needed power was unrealistic
+    """
+    positions, powers, socs, too_high = [], [], [], []
+    block_starts = np.zeros(1, dtype=int) if block_starts is None else np.asarray(block_starts, dtype=int)
+    block = 1
+    soc = 0.
+    for k, position in enumerate(uv_positions):
+        if np.searchsorted(block_starts, position, side="right") != block:
+            block = np.searchsorted(block_starts, position, side="right")
+            soc = 0.
+        sp = discharge_sp[k]
+        if sp < max_power:
+            soc -= sp / 6
+            powers.append(sp)
+            too_high.append(False)
+        else:
+            powers.append(0.)
+            too_high.append(True)
+        positions.append(position)
+        socs.append(soc)
+        next_uv = uv_positions[k + 1] if k + 1 < len(uv_positions) else n_dates
+        if block < len(block_starts):
+            next_uv = min(next_uv, block_starts[block])
+        start = position + 1
+        size = window
+        while soc < 0 and start < next_uv:
+            stop = min(start + size, next_uv)
+            charge_sp = get_charge_sp(start, stop)
+            for i in range(stop - start):
+                if not soc < 0:
+                    break
+                sp = charge_sp[i]
+                if sp < max_power:
+                    if sp < soc * 6:
+                        sp = soc * 6
+                        soc = 0.
+                    else:
+                        soc -= sp / 6
+                    powers.append(sp)
+                    too_high.append(False)
+                else:
+                    powers.append(0.)
+                    too_high.append(True)
+                positions.append(start + i)
+                socs.append(soc)
+            start = stop
+            size *= 2
+    return np.array(positions, dtype=int), np.array(powers), np.array(socs), np.array(too_high, dtype=bool)
+
+
+class RollingSchedule:
+    """Battery schedule over a rolling window of datetimes, that is updated incrementally
+
+    Per datetime discharging/charging powers from slopes (sp_max), battery powers, states of charge and
+    too high flags are kept. New datetimes are appended by continuing the schedule from the last state
+    of charge, so only powers of new datetimes have to be calculated. After the oldest datetimes are
+    evicted, the schedule is recalculated from the new start with full battery (state of charge 0,
+    states of charge are negative discharged energy) only until its state of charge matches the kept
+    one, after that both schedules are the same.
+    Without charging, powers of datetimes are independent and only capacity is recalculated.
+    Args:
+    --------
+        charging: bool
+            if True, schedule with charging (simulate_soc), otherwise discharging powers only
+        max_power: float
+            limit of realistic power
+    """
+
+    def __init__(self, charging=True, max_power=150.):
+        self.charging = charging
+        self.max_power = max_power
+        self.dates = np.array([], dtype="datetime64[ns]")
+        self.is_uv = np.zeros(0, dtype=bool)
+        self.sp_max = np.zeros(0)
+        self.powers = np.zeros(0)
+        self.socs = np.zeros(0)
+        self.too_high = np.zeros(0, dtype=bool)
+
+    def simulate(self, is_uv, sp_max, soc_0=0.):
+        """Returns powers, states of charge and too high flags of datetimes, starting from soc_0"""
+        if self.charging:
+            return simulate_soc(is_uv, sp_max, self.max_power, soc_0)
+        too_high = is_uv & ~(sp_max < self.max_power)
+        powers = np.where(is_uv & ~too_high, sp_max, 0.)
+        return powers, np.zeros(len(sp_max)), too_high
+
+    def append(self, dates, is_uv, sp_max):
+        """Appends datetimes (later than kept ones) with their undervoltage flags and powers from slopes"""
+        dates = np.asarray(dates, dtype="datetime64[ns]")
+        is_uv = np.asarray(is_uv, dtype=bool)
+        sp_max = np.asarray(sp_max, dtype=float)
+        soc_0 = self.socs[-1] if len(self.socs) else 0.
+        powers, socs, too_high = self.simulate(is_uv, sp_max, soc_0)
+        self.dates = np.concatenate((self.dates, dates))
+        self.is_uv = np.concatenate((self.is_uv, is_uv))
+        self.sp_max = np.concatenate((self.sp_max, sp_max))
+        self.powers = np.concatenate((self.powers, powers))
+        self.socs = np.concatenate((self.socs, socs))
+        self.too_high = np.concatenate((self.too_high, too_high))
+
+    def evict(self, start, window=144):
+        """Removes datetimes before start, schedule of the remaining datetimes starts with full battery
+        (state of charge 0). If battery was full before start, the kept schedule is unchanged."""
+        n_evicted = int(np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start), "ns")))
+        if n_evicted == 0:
+            return
+        soc_before = self.socs[n_evicted - 1]
+        self.dates = self.dates[n_evicted:]
+        self.is_uv = self.is_uv[n_evicted:]
+        self.sp_max = self.sp_max[n_evicted:]
+        self.powers = self.powers[n_evicted:]
+        self.socs = self.socs[n_evicted:]
+        self.too_high = self.too_high[n_evicted:]
+        if not self.charging or soc_before == 0:
+            return
+        # schedule is recalculated until state of charge matches the kept state of charge
+        position, soc = 0, 0.
+        while position < len(self.dates):
+            stop = min(position + window, len(self.dates))
+            powers, socs, too_high = self.simulate(self.is_uv[position:stop], self.sp_max[position:stop], soc)
+            same = np.where(socs == self.socs[position:stop])[0]
+            stop = position + same[0] + 1 if len(same) else stop
+            self.powers[position:stop] = powers[:stop - position]
+            self.socs[position:stop] = socs[:stop - position]
+            self.too_high[position:stop] = too_high[:stop - position]
+            if len(same):
+                return
+            position, soc = stop, socs[-1]
+            window *= 2
+
+    def get_characteristics(self):
+        """Returns capacity, power, cycles and number of unresolved undervoltages of the schedule"""
+        if self.charging:
+            capacity = -1 * self.socs.min() if len(self.socs) else 0.
+        else:
+            _, _, sums = calculate_segment_energies(self.powers)
+            capacity = max(sums.max() if len(sums) else 0., 0.) / 6
+        power = self.powers.max() if len(self.powers) else 0.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cycles = np.float64(self.powers[self.powers > 0].sum() / 6) / capacity
+        return capacity, power, cycles, int((self.too_high & self.is_uv).sum())
+
+    def save(self, path):
+        """Saves schedule to pickle file"""
+        with open(path, "wb") as f:
+            pickle.dump(self.__dict__, f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads schedule from pickle file"""
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        schedule = cls(data["charging"], data["max_power"])
+        schedule.__dict__.update(data)
+        return schedule
@@ -0,0 +1,250 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+
+from battery_schedule import create_voltage_array, calculate_voltage_diffs, simulate_soc
+from models.battery_model import BatteryModel
+from slope_calculation import calculate_slopes
+from utils import order_smms_by_undervoltage_sum
+
+
+def get_candidate_smms(fm, n_candidates=None):
+    """
+    Returns smms of feeder, that can host battery, ordered by sum of undervoltages.
+
+    Smms without undervoltages follow smms with undervoltages. Only smms with load in snet are eligible.
+    Args:
+    --------
+        fm: FeederModel
+            feeder model with defined uv_data_avg (define_and_limit_voltage)
+        n_candidates: int
+            number of candidates, all eligible smms if None
+    Returns:
+    --------
+        candidates: list
+            candidate smms
+    """
+    smms_ordered = order_smms_by_undervoltage_sum(fm.uv_data_avg, vol_lim=fm.lim_vol_avg)
+    smms_ordered += [smm for smm in fm.smms if smm not in smms_ordered]
+    snet_smms = set(fm.snet.load.smm.values)
+    candidates = [smm for smm in smms_ordered if smm in snet_smms]
+    if n_candidates is not None:
+        candidates = candidates[:n_candidates]
+    return candidates
+
+
+def calculate_candidate_slopes(fm, candidates):
+    """Calculates slopes of all candidates at once with analytic sensitivities, which need one
+    powerflow per date regardless of number of candidates"""
+    return calculate_slopes(fm.get_powerflow_snet(), candidates,
+                            fm.avg_dates,
+                            fm.smms,
+                            fm.tm.df_p,
+                            fm.tm.df_q,
+                            fm.tm.df_vol,
+                            calibrate=fm.enough_voltage_data,
+                            method="jacobian",
+                            calibration_method=fm.calibration_method,
+                            calibration_info=fm.calibration_info,
+                            calibration_cache=fm.tm.calibration_cache)
+
+
+def evaluate_battery_smm(fm, battery_smm, slopes):
+    """Calculates battery schedule and characteristics for battery at battery_smm with given slopes
+
+    Returns:
+    --------
+        bm: BatteryModel
+            battery model with calculated capacity, power, cycles and number of unresolved undervoltages
+    """
+    bm = BatteryModel(fm)
+    bm.battery_smm = battery_smm
+    bm.slopes = slopes[[str(battery_smm)]]
+    # messages about too high powers are summarized in N_of_unresolved
+    with contextlib.redirect_stdout(io.StringIO()):
+        if bm.powers_with_charging:
+            bm.calculate_battery_events()
+        else:
+            bm.calculate_battery_powers()
+            bm.get_max_energy()
+            bm.get_battery_power()
+            if bm.battery_capacity > 0:
+                bm.get_battery_cycles()
+    return bm
+
+
+def rank_battery_smms(fm, n_candidates=None):
+    """
+    Evaluates candidate smms as battery sites and ranks them.
+
+    Slopes of all candidates are calculated at once (see calculate_candidate_slopes) instead of
+    perturbed powerflows for each candidate. Candidates are ranked by number of undervoltages the battery can not resolve, then by
+    capacity and power.
+    Args:
+    --------
+        fm: FeederModel
+            feeder model with defined uv_data_avg (define_and_limit_voltage)
+        n_candidates: int
+            number of candidates with highest undervoltages, all eligible smms if None
+    Returns:
+    --------
+        ranking: pd.DataFrame
+            battery_capacity, battery_power, battery_cycles, N_of_unresolved and max_slope
+            of each candidate, best first
+        slopes: pd.DataFrame
+            slopes of all candidates
+    """
+    candidates = get_candidate_smms(fm, n_candidates)
+    slopes = calculate_candidate_slopes(fm, candidates)
+    rows = []
+    for battery_smm in candidates:
+        bm = evaluate_battery_smm(fm, battery_smm, slopes)
+        rows.append({"battery_smm": battery_smm,
+                     "battery_capacity": bm.battery_capacity,
+                     "battery_power": bm.battery_power,
+                     "battery_cycles": bm.battery_cycles,
+                     "N_of_unresolved": bm.N_of_unresolved,
+                     "max_slope": slopes[str(battery_smm)].max()})
+    ranking = pd.DataFrame(rows).sort_values(["N_of_unresolved", "battery_capacity", "battery_power"],
+                                             kind="stable")
+    ranking = ranking.set_index("battery_smm")
+    return ranking, slopes
+
+
+def get_slope_matrix(slopes, smms, candidates):
+    """Returns slopes as (smm x candidate) array, duplicated smms in slopes index are dropped"""
+    slopes = slopes[~slopes.index.duplicated()]
+    return slopes.reindex(index=smms, columns=[str(smm) for smm in candidates]).values.astype(float)
+
+
+def calculate_unit_phase_powers(diffs, slopes_unit, max_power=150.):
+    """
+    Calculates phase powers of a battery unit, that fixes positive voltage deviations.
+
+    Power needed on phase of an smm is deviation / slope / 3 and raises voltage of that phase at every
+    smm by 3 * slope * power, so power of each phase is the highest power needed on that phase over
+    smms. If total power exceeds max_power, phase powers are scaled down and unit fixes
+    undervoltages partly.
+    Args:
+    --------
+        diffs: np.array
+            voltage deviations with shape (dates, smms, 3), positive are undervoltages
+        slopes_unit: np.array
+            slopes of smms for unit smm
+        max_power: float
+            power limit of unit
+    Returns:
+    --------
+        phase_powers: np.array
+            phase powers with shape (dates, 3)
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.clip(np.nan_to_num(diffs, nan=0.), 0, None) / slopes_unit[None, :, None] / 3
+    p = np.nan_to_num(p, nan=0., posinf=0., neginf=0.)
+    phase_powers = p.max(axis=1) if p.shape[1] else np.zeros((len(p), 3))
+    power = phase_powers.sum(axis=1)
+    scale = np.where(power > max_power, max_power / np.where(power > 0, power, 1), 1.)
+    return phase_powers * scale[:, None]
+
+
+def add_unit_voltages(diffs, slopes_unit, phase_powers):
+    """Returns voltage deviations after unit with phase_powers (superposition of linear sensitivities)"""
+    return diffs - 3 * slopes_unit[None, :, None] * phase_powers[:, None, :]
+
+
+def get_remaining_deviations(diffs, tol=0.01):
+    """Returns number of datetimes where voltage deviation of some smm and phase exceeds tol (V) and sum
+    over datetimes of the highest deviation"""
+    worst = np.clip(np.nan_to_num(diffs, nan=0.), 0, None).max(axis=(1, 2)) if diffs.size else np.zeros(0)
+    return int((worst > tol).sum()), worst.sum()
+
+
+def calculate_unit_characteristics(fm, battery_smm, slopes, uv_powers):
+    """Calculates capacity, power and cycles of unit with given discharging powers at undervoltage
+    datetimes, charging powers are allowed by voltage headroom of unit smm without other units"""
+    bm = BatteryModel(fm)
+    bm.battery_smm = battery_smm
+    bm.slopes = slopes[[str(battery_smm)]]
+    dates = bm.voltage_data.date_time.unique()
+    is_uv = np.isin(dates, bm.undervoltage_data.date_time.unique())
+    sp_max = np.zeros(len(dates))
+    sp_max[is_uv] = uv_powers
+    sp_max[~is_uv] = bm.calculate_max_powers(dates[~is_uv], charging=True, missing_diff=-5000.)
+    # unit powers are already limited, so none is discarded
+    powers, socs, _ = simulate_soc(is_uv, sp_max, np.inf)
+    capacity = -1 * socs.min()
+    energy = powers[powers > 0].sum() / 6
+    return {"battery_smm": battery_smm,
+            "battery_capacity": capacity,
+            "battery_power": powers.max(),
+            "battery_cycles": energy / capacity if capacity > 0 else np.nan}
+
+
+def place_batteries(fm, max_batteries=3, n_candidates=None, max_power=150., vol_lim=207/230, tol=0.01):
+    """
+    Greedy placement of multiple battery units on feeder.
+
+    Units are added one at a time. Each candidate smm is evaluated on voltage deviations remaining
+    after previous units, updated by superposition of linear sensitivities, and the candidate that
+    leaves the fewest unresolved undervoltage datetimes (then needs the least energy) is placed.
+    Units that reach max_power fix undervoltages partly, the rest is left to next units.
+    Placement stops when all undervoltages are resolved, max_batteries are placed or no candidate
+    reduces remaining deviations.
+    Args:
+    --------
+        fm: FeederModel
+            feeder model with defined uv_data_avg (define_and_limit_voltage)
+        max_batteries: int
+            maximal number of units
+        n_candidates: int
+            number of candidate smms with highest undervoltages, all eligible smms if None
+        max_power: float
+            power limit of each unit, kW
+        vol_lim: float
+            voltage limit, p.u.
+        tol: float
+            voltage deviation (V) still considered as resolved
+    Returns:
+    --------
+        units: pd.DataFrame
+            battery_smm, battery_capacity, battery_power, battery_cycles of each unit and
+            N_of_unresolved, number of undervoltage datetimes unresolved after the unit is added
+    """
+    if fm.tm.period_compression is not None:
+        raise ValueError("Placement of multiple batteries does not support voltage data compressed to "
+                         "representative days")
+    candidates = get_candidate_smms(fm, n_candidates)
+    slopes = calculate_candidate_slopes(fm, candidates)
+    slope_matrix = get_slope_matrix(slopes, fm.smms, candidates)
+    uv_dates = np.sort(fm.undervoltage_data.date_time.unique())
+    volts, present = create_voltage_array(fm.voltage_data, uv_dates, fm.smms)
+    diffs = calculate_voltage_diffs(volts, present, vol_lim)
+    n_unresolved, deviation = get_remaining_deviations(diffs, tol)
+    dates = fm.voltage_data.date_time.unique()
+    units = []
+    while n_unresolved > 0 and len(units) < max_batteries:
+        best = None
+        for k, battery_smm in enumerate(candidates):
+            if battery_smm in [unit["battery_smm"] for unit in units]:
+                continue
+            phase_powers = calculate_unit_phase_powers(diffs, slope_matrix[:, k], max_power)
+            residual = add_unit_voltages(diffs, slope_matrix[:, k], phase_powers)
+            n_residual, residual_deviation = get_remaining_deviations(residual, tol)
+            if residual_deviation > deviation - tol:
+                continue
+            score = (n_residual, phase_powers.sum())
+            if best is None or score < best[0]:
+                best = (score, battery_smm, phase_powers, residual)
+        if best is None:
+            break
+        _, battery_smm, phase_powers, diffs = best
+        n_unresolved, deviation = get_remaining_deviations(diffs, tol)
+        uv_powers = pd.Series(phase_powers.sum(axis=1), index=uv_dates)
+        uv_powers = uv_powers.reindex(dates[np.isin(dates, uv_dates)]).values
+        unit = calculate_unit_characteristics(fm, battery_smm, slopes, uv_powers)
+        unit["N_of_unresolved"] = n_unresolved
+        units.append(unit)
+    return pd.DataFrame(units, columns=["battery_smm", "battery_capacity", "battery_power",
+                                        "battery_cycles", "N_of_unresolved"])
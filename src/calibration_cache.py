@@ -0,0 +1,78 @@
+import pickle
+
+import pandas as pd
+
+from powerflow_backends import network_state_hash
+
+
+def data_fingerprint(date, *dfs):
+    """Hash of rows of dataframes (powers and voltages with smms as columns) on date"""
+    return tuple(int(pd.util.hash_pandas_object(df.loc[date], index=True).sum()) for df in dfs)
+
+
+def smms_hash(smms):
+    """Hash of sorted smms, calibration is fitted to voltages of these smms"""
+    return int(pd.util.hash_pandas_object(pd.Series(sorted(smms), dtype=float), index=False).sum())
+
+
+class CalibrationCache:
+    """Cache of calibration results of one transformer network
+
+    Entries are keyed by transformer, network state hash (topology and line impedances), date,
+    hash of feeder smms, fingerprint of measured data on the date and calibration method, and hold
+    calibrated trafo_lv, res_f and powerflow bus results of the calibrated state (base case) with name
+    of the powerflow backend that calculated them.
+    Calibration is fitted to voltages of feeder smms, so every feeder has its own entries. Different
+    battery candidates of the feeder and later runs reuse them instead of calibrating again, while
+    changed data of the date is calibrated again.
+    Args:
+    --------
+        trafo_name: str
+            name of the transformer
+    """
+
+    def __init__(self, trafo_name=None):
+        self.trafo_name = trafo_name
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, snet, date, smms, fingerprint=None, method="secant"):
+        """Returns cache key for calibration of snet on date to voltages of smms, fingerprint is
+        data_fingerprint of the date"""
+        return (self.trafo_name, network_state_hash(snet), pd.Timestamp(date), smms_hash(smms), fingerprint,
+                method)
+
+    def get(self, snet, date, smms, fingerprint=None, method="secant"):
+        """Returns cached entry (dictionary with trafo_lv, res_f, res_bus and backend) or None"""
+        entry = self.entries.get(self.get_key(snet, date, smms, fingerprint, method))
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, snet, date, smms, trafo_lv, res_f, res_bus=None, fingerprint=None, method="secant",
+            backend=None):
+        """Stores calibration result to voltages of smms and base case bus results of snet on date,
+        calculated with backend (name)"""
+        self.entries[self.get_key(snet, date, smms, fingerprint, method)] = {
+            "trafo_lv": trafo_lv,
+            "res_f": res_f,
+            "res_bus": None if res_bus is None else res_bus.copy(),
+            "backend": backend
+        }
+
+    def save(self, path):
+        """Saves cache to pickle file"""
+        with open(path, "wb") as f:
+            pickle.dump({"trafo_name": self.trafo_name, "entries": self.entries}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads cache from pickle file"""
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        cache = cls(data["trafo_name"])
+        cache.entries = data["entries"]
+        return cache
@@ -12,3 +12,13 @@ CON_STRING = """Driver={};
                 Database={};
                 Trusted_Connection={};""".format(DRIVER, SERVER, DATABASE,
                                                  TRUSTED_CONNECTION)
+
+# Powerflow backend used by run_powerflow: "pandapower" (reference), "pandapower_numba",
+# "sweep" (backward/forward sweep for radial feeders) or "sparse" (direct sparse solver)
+POWERFLOW_BACKEND = "pandapower"
+# Backends for separate calculation stages, None means POWERFLOW_BACKEND is used
+POWERFLOW_BACKENDS = {
+    "calibration": None,
+    "slopes": None,
+    "timeseries": "sparse",
+}
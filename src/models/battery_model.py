@@ -1,7 +1,10 @@
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 from models.feeder_model import FeederModel
+from utils import get_data_from_smm_list
+from battery_schedule import create_voltage_array, calculate_voltage_diffs, calculate_smm_powers, \
+    max_over_smms, simulate_soc, simulate_soc_events, VoltageIndex, calculate_segment_energies, \
+    simulate_soc_batch, calculate_max_segment_sums, RollingSchedule, simulate_soc_blocks
 
 class BatteryModel:
     def __init__(self, fm: FeederModel):
@@ -10,92 +13,231 @@ class BatteryModel:
         self.battery_smm = fm.battery_smm
         self.voltage_data = fm.voltage_data
         self.undervoltage_data = fm.undervoltage_data
+        if self.tm.period_compression is not None:
+            # battery is sized on representative and extreme days only
+            self.voltage_data = self.tm.period_compression.transform(self.voltage_data)
+            self.undervoltage_data = self.tm.period_compression.transform(self.undervoltage_data)
         self.slopes = fm.slopes
         self.vol_lim = 207/230
         self.smms = fm.smms
         self.fix_all_phases = True
+        # Powers not below these limits (kW) are unrealistic and set to 0, without and with charging
+        self.max_power = 100.
+        self.max_power_charging = 150.
         self.battery_capacity = None
         self.battery_power = None
         self.battery_powers = None
         self.battery_cycles = None
+        # Number of undervoltage datetimes, where needed power was too high and set to 0
+        self.N_of_unresolved = None
         self.max_energy_start_date = None
+        self.max_energy_end_date = None
+        # Energy of every discharging event (segment of nonzero powers), without charging only
+        self.event_energies = None
         self.battery_df = pd.DataFrame()
         self.powers_with_charging = True
+        # If True, slopes for every datetime are calculated with LinDistFlow model of the feeder
+        self.use_surrogate = False
+        self.slopes_ts = None
+        # Per phase slopes for every datetime, phase -> dataframe, used if feeder has phase slopes
+        self.phase_slopes_ts = None
+        # If True, discharging powers are verified with powerflows of calibrated network and increased
+        # where voltage rise is smaller than linear slopes predict, see verify_uv_powers
+        self.closed_loop = False
+        self.closed_loop_tol = 0.01
+        self.closed_loop_max_iteration = 10
+        self.closed_loop_info = None
+        # Weights of days, if voltage data is compressed to representative days (see PeriodCompression),
+        # blocks of consecutive kept days are simulated separately (see get_block_starts)
+        self.day_weights = self.tm.day_weights
+        # Schedule over rolling window of datetimes, updated incrementally with new data
+        self.rolling_schedule = None
+        # Capacity and power of every Monte Carlo sample, see monte_carlo
+        self.mc_samples = None
+        # If True (and powers_with_charging), only undervoltage events and recharging after them are
+        # simulated, battery_df then holds only these datetimes
+        self.event_driven = False
+
+    def calculate_surrogate_slopes(self):
+        """Calculates slopes of battery smm for every datetime in voltage data with LinDistFlow model,
+        so slopes follow the loading state instead of being averaged over few dates"""
+        if self.fm.surrogate is None:
+            self.fm.create_surrogate()
+        dates = self.voltage_data.date_time.unique()
+        self.slopes_ts = self.fm.surrogate.calculate_slopes(self.battery_smm,
+                                                            self.tm.df_p.reindex(dates),
+                                                            self.tm.df_q.reindex(dates))
+
+    def calculate_cluster_slopes(self):
+        """Assigns every datetime in voltage data to a load state cluster of the feeder and uses slopes
+        of that cluster"""
+        dates = self.voltage_data.date_time.unique()
+        labels = self.fm.state_clustering.predict(dates, self.tm.df_p, self.tm.df_q)
+        slopes = {}
+        for cluster, cluster_slopes in self.fm.cluster_slopes.items():
+            slopes_smm = cluster_slopes[str(self.battery_smm)]
+            slopes[cluster] = slopes_smm[~slopes_smm.index.duplicated()]
+        self.slopes_ts = pd.DataFrame([slopes[label] for label in labels.values], index=dates)
+
+    def calculate_phase_slopes_ts(self):
+        """Assigns per phase slopes of the feeder (for each cluster of load states) to every datetime"""
+        dates = self.voltage_data.date_time.unique()
+        if None in self.fm.phase_slopes:
+            labels = [None] * len(dates)
+        else:
+            labels = self.fm.state_clustering.predict(dates, self.tm.df_p, self.tm.df_q).values
+        self.phase_slopes_ts = {}
+        for phase in (1, 2, 3):
+            slopes = {}
+            for cluster, phase_slopes in self.fm.phase_slopes.items():
+                slopes_smm = phase_slopes[phase][str(self.battery_smm)]
+                slopes[cluster] = slopes_smm[~slopes_smm.index.duplicated()]
+            self.phase_slopes_ts[phase] = pd.DataFrame([slopes[label] for label in labels],
+                                                       index=dates)
+
+    def calculate_slopes_ts(self):
+        """Calculates slopes for every datetime, if they change with load state (surrogate model,
+        clusters of load states or per phase slopes)"""
+        if self.use_surrogate:
+            self.calculate_surrogate_slopes()
+        elif self.fm.cluster_slopes is not None:
+            self.calculate_cluster_slopes()
+        if self.fm.phase_slopes is not None:
+            self.calculate_phase_slopes_ts()
+
+    def get_block_starts(self, dates):
+        """Returns positions of first datetimes of blocks of consecutive days. If voltage data is
+        compressed to representative days, every block of kept days starts with full battery, otherwise
+        all datetimes are one block"""
+        if self.day_weights is None:
+            return np.zeros(1, dtype=int)
+        days = pd.DatetimeIndex(dates).normalize()
+        return np.where(np.concatenate(([True], np.diff(days.values) > np.timedelta64(1, "D"))))[0]
+
+    def check_uncompressed(self, method):
+        """Raises ValueError, if method does not support voltage data compressed to representative days"""
+        if self.day_weights is not None:
+            raise ValueError("{} does not support voltage data compressed to representative days".format(method))
+
+    def get_voltage_array(self, dates):
+        """Returns dense (datetime x smm x phase) voltage array and mask of present voltage data"""
+        return create_voltage_array(self.voltage_data, dates, self.smms)
+
+    def get_slope_array(self, dates):
+        """Returns slopes of smms for battery smm with shape broadcastable to (datetime x smm x phase)"""
+        if self.phase_slopes_ts is not None:
+            return np.stack([self.phase_slopes_ts[phase].loc[dates, self.smms].values
+                             for phase in (1, 2, 3)], axis=2)
+        if self.slopes_ts is not None:
+            return self.slopes_ts.loc[dates, self.smms].values[:, :, None]
+        slopes = [self.slopes[str(self.battery_smm)][smm] for smm in self.smms]
+        return np.array(slopes, dtype=float)[None, :, None]
+
+    def calculate_max_powers(self, dates, charging=False, missing_diff=0.):
+        """Calculates maximal power over smms needed to fix (or, when charging, allowed by) voltages
+        at given datetimes"""
+        volts, present = self.get_voltage_array(dates)
+        diffs = calculate_voltage_diffs(volts, present, self.vol_lim, missing_diff)
+        powers = calculate_smm_powers(diffs, self.get_slope_array(dates), self.fix_all_phases, charging)
+        return max_over_smms(powers)
+
+    def verify_uv_powers(self, uv_dates, sp_max, max_power, missing_diff=0.):
+        """
+        Verifies discharging powers at undervoltage datetimes with powerflows of calibrated network.
+
+        Linear slopes predict, that battery power raises voltage of each smm by slope * power needed by
+        that smm. Powerflows with battery injection at battery smm are solved for all undervoltage
+        datetimes at once (one compiled network, see FeederModel.get_timeseries_powerflow), where
+        voltage rise of some smm is smaller than predicted, power is increased by shortfall / slope.
+        This is repeated for datetimes with shortfall until it is below closed_loop_tol (V).
+        Args:
+        --------
+            uv_dates: array
+                undervoltage datetimes
+            sp_max: np.array
+                discharging powers from linear slopes, kW
+            max_power: float
+                limit of realistic power, unrealistic powers are not verified
+            missing_diff: float
+                voltage deviation for missing data, see calculate_voltage_diffs
+        Returns:
+        --------
+            sp_verified: np.array
+                verified discharging powers, details are in closed_loop_info
+        """
+        volts, present = self.get_voltage_array(uv_dates)
+        diffs = calculate_voltage_diffs(volts, present, self.vol_lim, missing_diff)
+        slopes = np.broadcast_to(self.get_slope_array(uv_dates), volts.shape)
+        # voltage rise, that each smm needs according to linear slopes (balanced powerflow)
+        slopes_smm = slopes.mean(axis=2)
+        needed_rise = slopes_smm * np.nan_to_num(calculate_smm_powers(diffs, slopes, self.fix_all_phases), nan=0.)
+        engine = self.fm.get_timeseries_powerflow()
+        loads = self.fm.get_powerflow_snet().load
+        buses = [loads.bus[loads.smm == smm].iloc[0] if (loads.smm == smm).any() else None for smm in self.smms]
+        measured = np.array([bus is not None for bus in buses])
+        buses = [bus for bus in buses if bus is not None]
+        df_p = self.tm.df_p.reindex(uv_dates)
+        df_q = self.tm.df_q.reindex(uv_dates)
+        sp_verified = np.array(sp_max, dtype=float)
+        active = np.isfinite(sp_verified) & (sp_verified > 0) & (sp_verified < max_power)
+        shortfall_0 = np.zeros(len(sp_verified))
+        iterations = np.zeros(len(sp_verified), dtype=int)
+        if active.any():
+            volts_0 = engine.run(df_p[active], df_q[active], buses=buses).values
+        else:
+            volts_0 = np.zeros((0, len(buses)))
+        base = pd.DataFrame(volts_0, index=np.where(active)[0])
+        for iteration in range(self.closed_loop_max_iteration):
+            if not active.any():
+                break
+            rows = np.where(active)[0]
+            df_p_battery = df_p.iloc[rows].copy()
+            if self.battery_smm not in df_p_battery.columns:
+                df_p_battery[self.battery_smm] = 0.
+            df_p_battery[self.battery_smm] = df_p_battery[self.battery_smm].fillna(0) - sp_verified[rows]
+            volts_1 = engine.run(df_p_battery, df_q.iloc[rows], buses=buses).values
+            rise = (volts_1 - base.loc[rows].values) * 230
+            shortfall = needed_rise[rows][:, measured] - rise
+            max_shortfall = shortfall.max(axis=1) if shortfall.shape[1] else np.zeros(len(rows))
+            if iteration == 0:
+                shortfall_0[rows] = max_shortfall
+            iterations[rows] = iteration + 1
+            converged = max_shortfall < self.closed_loop_tol
+            with np.errstate(divide="ignore", invalid="ignore"):
+                correction = np.nanmax(np.where(shortfall > 0, shortfall / slopes_smm[rows][:, measured], 0),
+                                       axis=1) if shortfall.shape[1] else np.zeros(len(rows))
+            sp_verified[rows[~converged]] += correction[~converged]
+            active[rows[converged]] = False
+            # unrealistic powers are not verified further
+            active &= sp_verified < max_power
+        self.closed_loop_info = pd.DataFrame({"power_linear": sp_max,
+                                              "power": sp_verified,
+                                              "shortfall": shortfall_0,
+                                              "N_of_iterations": iterations},
+                                             index=pd.Index(uv_dates, name="date_time"))
+        return sp_verified
 
     def calculate_battery_powers(self):
         """Calculates battery operating schedule for given dates and battery smm
         Function returns list of powers, and list of dates, where the battery is needed to solve undervoltages.
-        Powers are calculated using slopes of the battery smm."""
-        
-        powers_slope = []
-        dates_uv = []
-        dates = np.sort(self.undervoltage_data.date_time.unique())
-        for date in tqdm(self.voltage_data.date_time.unique()):
-            if date in dates:
-                vol_state = self.voltage_data.loc[self.voltage_data.date_time == date]
-                powers_list = []
-                for smm in self.smms:
-                    # get slope of smm we are fixing
-                    vol_slope = self.slopes[str(self.battery_smm)][smm]
-                    # Get voltage deviation from vol_lim for each phase, if a phase is missing in the data, it is not fixed
-                    try:                    
-                        vol1 = vol_state.loc[vol_state.smm ==
-                                             smm].u_1.values[0]
-                        vol1_diff = self.vol_lim*230 - vol1
-                    except:
-                        vol1 = self.vol_lim
-                        vol1_diff = 0
-                    try:
-                        vol2 = vol_state.loc[vol_state.smm ==
-                                             smm].u_2.values[0]
-                        vol2_diff = self.vol_lim*230 - vol2
-                        if not np.isfinite(vol2):
-                            vol2 = self.vol_lim
-                            vol2_diff = 0
-
-                    except Exception as e:
-                        vol2 = self.vol_lim
-                        vol2_diff = 0
-                    try:
-                        vol3 = vol_state.loc[vol_state.smm ==
-                                             smm].u_3.values[0]
-                        vol3_diff = self.vol_lim*230 - vol3
-                        if not np.isfinite(vol3):
-                            vol3 = self.vol_lim
-                            vol3_diff = 0
-                    except:
-                        vol3 = self.vol_lim
-                        vol3_diff = 0
-                    # calculate power for each phase
-                    p1 = vol1_diff / vol_slope /3
-                    p2 = vol2_diff / vol_slope /3
-                    p3 = vol3_diff / vol_slope /3
-                    if self.fix_all_phases:
-                        # if all phases are fixed, we sum the positive powers
-                        p = (p1*(p1 > 0) + p2*(p2 > 0) + p3*(p3 > 0))
-                        powers_list.append(p)
-                    else:
-                        # if only average voltage is fixed, we sum all powers
-                        powers_list.append(p1 + p2 + p3)
-                # For needed power at certain datetime, we take the maximum power from all smms
-                sp_max = max(powers_list)
-                # If power is unrealistic, we set it to 0
-                if sp_max < 100:
-                    powers_slope.append(sp_max)
-                    dates_uv.append(date)
-                else:
-                    print("Power is too high, setting to 0")
-                    print(sp_max)
-                    powers_slope.append(0)
-                    dates_uv.append(date)
-            else:
-                # if we dont have undervoltage, we set power to 0
-                dates_uv.append(date)
-                powers_slope.append(0)
-        self.battery_powers = powers_slope
-        self.battery_dates = dates_uv
+        Powers are calculated using slopes of the battery smm, for all undervoltage datetimes at once
+        from dense (datetime x smm x phase) voltage array."""
+        dates = self.voltage_data.date_time.unique()
+        is_uv = np.isin(dates, self.undervoltage_data.date_time.unique())
+        sp_max = self.calculate_max_powers(dates[is_uv])
+        if self.closed_loop:
+            sp_max = self.verify_uv_powers(dates[is_uv], sp_max, self.max_power)
+        # If power is unrealistic, we set it to 0
+        for power in sp_max[~(sp_max < self.max_power)]:
+            print("Power is too high, setting to 0")
+            print(power)
+        self.N_of_unresolved = int((~(sp_max < self.max_power)).sum())
+        powers_slope = np.zeros(len(dates))
+        powers_slope[is_uv] = np.where(sp_max < self.max_power, sp_max, 0)
+        self.battery_powers = powers_slope.tolist()
+        self.battery_dates = list(dates)
         self.battery_df = pd.DataFrame(
-            {"date_time": dates_uv, "battery_power": powers_slope})
+            {"date_time": dates, "battery_power": powers_slope})
         self.battery_df.set_index("date_time", inplace=True)
 
 
@@ -103,114 +245,305 @@ class BatteryModel:
         """Calculates battery operating schedule for given dates and battery smm
         Function returns list of powers, and list of dates, where the battery is needed to solve undervoltages.
         Powers are calculated using slopes of the battery smm. Function takes state of charge into account, so 
-        when battery is not fulll, we are charging it, if possible"""
-        
-        powers_slope = []
-        dates_uv = []
-        dates = np.sort(self.undervoltage_data.date_time.unique())
-        soc = 0.
-        socs = []
-        for date in tqdm(self.voltage_data.date_time.unique()):
-            if date in dates or soc < 0:
-                if date in dates:
-                    charging = False
+        when battery is not fulll, we are charging it, if possible.
+        Discharging powers at undervoltage datetimes and charging powers at other datetimes are calculated
+        at once, only state of charge recurrence is a scan over datetimes."""
+        dates = self.voltage_data.date_time.unique()
+        is_uv = np.isin(dates, self.undervoltage_data.date_time.unique())
+        sp_max = np.zeros(len(dates))
+        # Unrealisticly big negative power for missing phases, so it does not effect results
+        sp_max[is_uv] = self.calculate_max_powers(dates[is_uv], charging=False, missing_diff=-5000.)
+        if self.closed_loop:
+            sp_max[is_uv] = self.verify_uv_powers(dates[is_uv], sp_max[is_uv], self.max_power_charging,
+                                                  missing_diff=-5000.)
+        sp_max[~is_uv] = self.calculate_max_powers(dates[~is_uv], charging=True, missing_diff=-5000.)
+        powers_slope, socs, too_high = simulate_soc_blocks(is_uv, sp_max, self.get_block_starts(dates),
+                                                           self.max_power_charging)
+        self.N_of_unresolved = int((too_high & is_uv).sum())
+        for power in sp_max[too_high]:
+            print("Power is too high, setting to 0")
+            print(power)
+        self.battery_powers = powers_slope.tolist()
+        self.battery_dates = list(dates)
+        self.battery_socs = socs.tolist()
+        self.battery_df = pd.DataFrame(
+            {"date_time": dates, "battery_power": powers_slope, "soc": socs})
+        self.battery_df.set_index("date_time", inplace=True)
+
+    def calculate_battery_events(self):
+        """Calculates battery schedule with charging only at undervoltage datetimes and during recharging
+        after them, and battery capacity, power and cycles from it. Results are the same as with
+        calculate_battery_powers_with_charging, idle datetimes are not in battery_df."""
+        dates = self.voltage_data.date_time.unique()
+        uv_positions = np.where(np.isin(dates, self.undervoltage_data.date_time.unique()))[0]
+        voltage_index = VoltageIndex(self.voltage_data, dates, self.smms)
+
+        def get_max_powers(positions, charging):
+            volts, present = voltage_index.get_array(positions)
+            # Unrealisticly big negative power for missing phases, so it does not effect results
+            diffs = calculate_voltage_diffs(volts, present, self.vol_lim, missing_diff=-5000.)
+            powers = calculate_smm_powers(diffs, self.get_slope_array(dates[positions]),
+                                          self.fix_all_phases, charging)
+            return max_over_smms(powers)
+
+        discharge_sp = get_max_powers(uv_positions, False)
+        if self.closed_loop:
+            discharge_sp = self.verify_uv_powers(dates[uv_positions], discharge_sp, self.max_power_charging,
+                                                 missing_diff=-5000.)
+        positions, powers, socs, too_high = simulate_soc_events(
+            uv_positions, discharge_sp,
+            lambda start, stop: get_max_powers(np.arange(start, stop), True), len(dates),
+            self.max_power_charging, block_starts=self.get_block_starts(dates))
+        self.N_of_unresolved = int(too_high[np.isin(positions, uv_positions)].sum())
+        for power in powers[too_high]:
+            print("Power is too high, setting to 0")
+            print(power)
+        self.battery_powers = powers.tolist()
+        self.battery_dates = list(dates[positions])
+        self.battery_socs = socs.tolist()
+        self.battery_df = pd.DataFrame(
+            {"date_time": dates[positions], "battery_power": powers, "soc": socs})
+        self.battery_df.set_index("date_time", inplace=True)
+        # idle datetimes have power 0 and state of charge 0
+        idle = len(positions) < len(dates)
+        soc_min = min(socs.min() if len(socs) else 0., 0. if idle else np.inf)
+        self.battery_capacity = -1 * np.float64(soc_min)
+        self.max_energy_start_date = dates[positions[np.argmin(socs)]] if soc_min < 0 else dates[0]
+        self.battery_power = np.float64(max(powers.max() if len(powers) else 0., 0. if idle else -np.inf))
+        self.get_battery_cycles()
+
+    def sweep(self, vol_lims, max_powers=None, fix_all_phases=(True, False)):
+        """
+        Calculates battery characteristics for a grid of voltage limits, power limits and fix_all_phases
+        settings, so trade-off curves do not need a run of the whole pipeline for every point.
+
+        Voltage array and slopes are created once, powers are calculated for all datetimes at once for
+        every voltage limit and phase setting, power limits are applied to the same powers. Undervoltage
+        datetimes are those in undervoltage_data for all voltage limits, as in calculate_battery_parameters.
+        Slopes of the surrogate model, clusters of load states and per phase slopes are used as in
+        calculate_battery_parameters. Closed loop verification and compressed voltage data are not
+        supported.
+        Args:
+        --------
+            vol_lims: list
+                voltage limits, p.u.
+            max_powers: list
+                limits of realistic power (kW), max_power_charging or max_power if None
+            fix_all_phases: tuple
+                fix_all_phases settings
+        Returns:
+        --------
+            sweep_df: pd.DataFrame
+                battery_capacity, battery_power, battery_cycles and unresolved_minutes (undervoltage
+                time with too high needed power) for every vol_lim, max_power and fix_all_phases
+        """
+        self.check_uncompressed("sweep")
+        if self.closed_loop:
+            raise ValueError("sweep does not support closed loop verification of powers")
+        if max_powers is None:
+            max_powers = [self.max_power_charging if self.powers_with_charging else self.max_power]
+        self.calculate_slopes_ts()
+        dates = self.voltage_data.date_time.unique()
+        is_uv = np.isin(dates, self.undervoltage_data.date_time.unique())
+        # duration of one datetime, from resolution of voltage data
+        step_minutes = pd.Series(dates).diff().median() / pd.Timedelta(minutes=1) if len(dates) > 1 else 10.
+        volts, present = self.get_voltage_array(dates)
+        slopes = np.broadcast_to(self.get_slope_array(dates), volts.shape)
+        rows = []
+        for vol_lim in vol_lims:
+            for fap in fix_all_phases:
+                if self.powers_with_charging:
+                    # Unrealisticly big negative power for missing phases, so it does not effect results
+                    diffs = calculate_voltage_diffs(volts, present, vol_lim, missing_diff=-5000.)
+                    sp_max = np.zeros(len(dates))
+                    sp_max[is_uv] = max_over_smms(calculate_smm_powers(diffs[is_uv], slopes[is_uv], fap))
+                    sp_max[~is_uv] = max_over_smms(calculate_smm_powers(diffs[~is_uv], slopes[~is_uv],
+                                                                        fap, charging=True))
                 else:
-                    charging = True
-                vol_state = self.voltage_data.loc[self.voltage_data.date_time == date]
-                powers_list = []
-                for smm in self.smms:
-                    # get slope of smm we are fixing
-                    vol_slope = self.slopes[str(self.battery_smm)][smm]
-                    # Get voltage deviation from vol_lim for each phase, if a phase is missing in the data, it is not fixed
-                    try:                    
-                        vol1 = vol_state.loc[vol_state.smm ==
-                                             smm].u_1.values[0]
-                        vol1_diff = self.vol_lim*230 - vol1
-                    except:
-                        vol1 = self.vol_lim
-                        vol1_diff = -5000. # Unrealisticly big negative power, so it does not effect results
-                    try:
-                        vol2 = vol_state.loc[vol_state.smm ==
-                                             smm].u_2.values[0]
-                        vol2_diff = self.vol_lim*230 - vol2
-                        if not np.isfinite(vol2):
-                            vol2 = self.vol_lim
-                            vol2_diff = -5000.
-
-                    except Exception as e:
-                        vol2 = self.vol_lim
-                        vol2_diff = -5000.
-                    try:
-                        vol3 = vol_state.loc[vol_state.smm ==
-                                             smm].u_3.values[0]
-                        vol3_diff = self.vol_lim*230 - vol3
-                        if not np.isfinite(vol3):
-                            vol3 = self.vol_lim
-                            vol3_diff = -5000.
-                    except:
-                        vol3 = self.vol_lim
-                        vol3_diff = -5000.
-                    # calculate power for each phase
-                    p1 = vol1_diff / vol_slope /3
-                    p2 = vol2_diff / vol_slope /3
-                    p3 = vol3_diff / vol_slope /3
-                    if not charging:
-                        # we have undervoltage
-                        if self.fix_all_phases:
-                            # if all phases are fixed, we sum the positive powers
-                            p = (p1*(p1 > 0) + p2*(p2 > 0) + p3*(p3 > 0))
-                            powers_list.append(p)
-                        else:
-                            # if only average voltage is fixed, we sum all powers
-                            powers_list.append(p1 + p2 + p3)
-                    else:
-                        # we have to charge the battery
-                        if self.fix_all_phases:
-                            # if all phases are fixed, we sum the negative powers
-                            p = (p1*(p1 < 0) + p2*(p2 < 0) + p3*(p3 < 0))
-                            powers_list.append(p)
-                        else:
-                            # if only average voltage is fixed, we sum all powers
-                            powers_list.append(p1 + p2 + p3)
-                # For needed power at certain datetime, we take the maximum power from all smms
-                df_powers_state = pd.DataFrame({"smm": self.smms, "power": powers_list}) 
-                sp_max = max(powers_list)
-                # If power is unrealistic, we set it to 0
-                if sp_max < 150:
-                    if charging:
-                        if sp_max < soc*6:
-                            sp_max = soc*6
-                            soc = 0
-                        else:
-                            soc -= sp_max/6
+                    diffs = calculate_voltage_diffs(volts[is_uv], present[is_uv], vol_lim)
+                    sp_max = max_over_smms(calculate_smm_powers(diffs, slopes[is_uv], fap))
+                for max_power in max_powers:
+                    if self.powers_with_charging:
+                        powers, socs, too_high = simulate_soc(is_uv, sp_max, max_power)
+                        capacity = -1 * socs.min() if len(socs) else 0.
+                        n_unresolved = (too_high & is_uv).sum()
                     else:
-                        soc -= sp_max/6
-                    powers_slope.append(sp_max)
-                    dates_uv.append(date)
-                    socs.append(soc)
-                else:
-                    print("Power is too high, setting to 0")
-                    print(sp_max)
-                    powers_slope.append(0)
-                    dates_uv.append(date)
-                    socs.append(soc)
-                
+                        too_high = ~(sp_max < max_power)
+                        powers = np.zeros(len(dates))
+                        powers[is_uv] = np.where(too_high, 0, sp_max)
+                        _, _, sums = calculate_segment_energies(powers)
+                        capacity = max(sums.max() if len(sums) else 0., 0.) / 6
+                        n_unresolved = too_high.sum()
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        cycles = np.float64(powers[powers > 0].sum() / 6) / capacity
+                    rows.append({"vol_lim": vol_lim,
+                                 "max_power": max_power,
+                                 "fix_all_phases": fap,
+                                 "battery_capacity": capacity,
+                                 "battery_power": powers.max() if len(powers) else 0.,
+                                 "battery_cycles": cycles,
+                                 "unresolved_minutes": int(n_unresolved * step_minutes)})
+        return pd.DataFrame(rows)
+
+    def get_slope_spread(self):
+        """Returns relative standard deviation of slopes of smms over dates (fm.date_slopes), 0 if
+        slopes of single date are known"""
+        column = str(self.battery_smm)
+        date_slopes = [slopes[column] for slopes in self.fm.date_slopes if column in slopes]
+        if len(date_slopes) < 2:
+            return np.zeros(len(self.smms))
+        stacked = np.array([slopes[~slopes.index.duplicated()].reindex(self.smms).values
+                            for slopes in date_slopes], dtype=float)
+        mean = np.nanmean(stacked, axis=0)
+        spread = np.nanstd(stacked, axis=0, ddof=1) / np.where(np.abs(mean) > 0, np.abs(mean), np.nan)
+        return np.nan_to_num(spread)
+
+    def monte_carlo(self, n_samples=1000, u_noise=1., percentiles=(5, 50, 95), random_state=0,
+                    max_memory_mb=500):
+        """
+        Monte Carlo battery sizing under slope and measurement uncertainty.
+
+        Every sample scales slopes by 1 + z * relative spread of slopes over dates (z is standard normal,
+        common to all smms, as slopes of all smms change together with loading) and adds normal noise
+        with standard deviation u_noise (V) to measured phase voltages. Schedules of samples are
+        calculated in batches as array computations, batch size is limited by max_memory_mb.
+        Args:
+        --------
+            n_samples: int
+                number of samples
+            u_noise: float
+                standard deviation of voltage measurement noise, V
+            percentiles: tuple
+                percentiles of capacity and power
+            random_state: int
+                seed of random generator
+            max_memory_mb: int
+                approximate memory limit of voltage arrays of one batch
+        Returns:
+        --------
+            mc_df: pd.DataFrame
+                battery_capacity and battery_power percentiles, capacity and power of every sample
+                are in mc_samples
+        """
+        self.check_uncompressed("monte_carlo")
+        rng = np.random.default_rng(random_state)
+        self.calculate_slopes_ts()
+        dates = self.voltage_data.date_time.unique()
+        is_uv = np.isin(dates, self.undervoltage_data.date_time.unique())
+        if not self.powers_with_charging:
+            # without charging, only undervoltage datetimes have nonzero power
+            dates_used = dates[is_uv]
+        else:
+            dates_used = dates
+        volts, present = self.get_voltage_array(dates_used)
+        slopes = np.broadcast_to(self.get_slope_array(dates_used), volts.shape)
+        spread = self.get_slope_spread()
+        # voltages, noise, diffs and powers of a sample are held at once
+        sample_mb = volts.nbytes * 4 / 1e6
+        batch_size = int(max(1, min(n_samples, max_memory_mb // max(sample_mb, 1e-6))))
+        capacities, powers_max = [], []
+        for start in range(0, n_samples, batch_size):
+            size = min(batch_size, n_samples - start)
+            factors = 1 + rng.standard_normal(size)[:, None] * spread[None, :]
+            volts_batch = volts[None] + rng.normal(0., u_noise, (size,) + volts.shape)
+            slopes_batch = slopes[None] * factors[:, None, :, None]
+            shape = (size * volts.shape[0],) + volts.shape[1:]
+            volts_batch = volts_batch.reshape(shape)
+            slopes_batch = slopes_batch.reshape(shape)
+            present_batch = np.broadcast_to(present[None], (size,) + present.shape).reshape(shape[:2])
+            if self.powers_with_charging:
+                # Unrealisticly big negative power for missing phases, so it does not effect results
+                diffs = calculate_voltage_diffs(volts_batch, present_batch, self.vol_lim, missing_diff=-5000.)
+                uv_rows = np.tile(is_uv, size)
+                sp_max = np.zeros(len(uv_rows))
+                sp_max[uv_rows] = max_over_smms(calculate_smm_powers(
+                    diffs[uv_rows], slopes_batch[uv_rows], self.fix_all_phases))
+                sp_max[~uv_rows] = max_over_smms(calculate_smm_powers(
+                    diffs[~uv_rows], slopes_batch[~uv_rows], self.fix_all_phases, charging=True))
+                powers, socs = simulate_soc_batch(is_uv, sp_max.reshape(size, len(dates)),
+                                                  self.max_power_charging)
+                capacities.append(-1 * socs.min(axis=1))
             else:
-                #We dont have undervoltage, and we dont have to charge the battery
-                dates_uv.append(date)
-                powers_slope.append(0)
-                socs.append(soc)
+                diffs = calculate_voltage_diffs(volts_batch, present_batch, self.vol_lim)
+                sp_max = max_over_smms(calculate_smm_powers(diffs, slopes_batch, self.fix_all_phases))
+                sp_max = sp_max.reshape(size, len(dates_used))
+                powers = np.zeros((size, len(dates)))
+                powers[:, is_uv] = np.where(sp_max < self.max_power, sp_max, 0)
+                capacities.append(calculate_max_segment_sums(powers) / 6)
+            powers_max.append(powers.max(axis=1))
+        self.mc_samples = pd.DataFrame({"battery_capacity": np.concatenate(capacities),
+                                        "battery_power": np.concatenate(powers_max)})
+        mc_df = self.mc_samples.quantile([p / 100 for p in percentiles])
+        mc_df.index = list(percentiles)
+        mc_df.index.name = "percentile"
+        return mc_df
 
+    def calculate_schedule_powers(self, voltage_data, undervoltage_data):
+        """Returns sorted datetimes of voltage_data, undervoltage flags and powers from slopes, discharging
+        at undervoltage datetimes and charging (if powers_with_charging) at others"""
+        self.check_uncompressed("Rolling schedule")
+        if self.slopes_ts is not None or self.phase_slopes_ts is not None:
+            raise ValueError("Rolling schedule needs slopes that do not change with datetime")
+        dates = np.sort(voltage_data.date_time.unique())
+        is_uv = np.isin(dates, undervoltage_data.date_time.unique())
+        volts, present = create_voltage_array(voltage_data, dates, self.smms)
+        slopes = self.get_slope_array(dates)
+        sp_max = np.zeros(len(dates))
+        # Unrealisticly big negative power for missing phases, so it does not effect results
+        missing_diff = -5000. if self.powers_with_charging else 0.
+        diffs = calculate_voltage_diffs(volts, present, self.vol_lim, missing_diff)
+        sp_max[is_uv] = max_over_smms(calculate_smm_powers(diffs[is_uv], slopes, self.fix_all_phases))
+        if self.powers_with_charging:
+            sp_max[~is_uv] = max_over_smms(calculate_smm_powers(diffs[~is_uv], slopes, self.fix_all_phases,
+                                                                charging=True))
+        return dates, is_uv, sp_max
 
-                
-        self.battery_powers = powers_slope
-        self.battery_dates = dates_uv
-        self.battery_socs = socs
-        self.battery_df = pd.DataFrame(
-            {"date_time": dates_uv, "battery_power": powers_slope, "soc": socs})
+    def set_rolling_characteristics(self):
+        """Sets battery characteristics and battery_df from rolling schedule"""
+        schedule = self.rolling_schedule
+        self.battery_capacity, self.battery_power, self.battery_cycles, self.N_of_unresolved = \
+            schedule.get_characteristics()
+        self.battery_df = pd.DataFrame({"date_time": schedule.dates, "battery_power": schedule.powers})
+        if schedule.charging:
+            self.battery_df["soc"] = schedule.socs
         self.battery_df.set_index("date_time", inplace=True)
 
+    def start_rolling_schedule(self):
+        """Calculates schedule over all voltage data and keeps it for incremental updates"""
+        max_power = self.max_power_charging if self.powers_with_charging else self.max_power
+        self.rolling_schedule = RollingSchedule(self.powers_with_charging, max_power)
+        self.rolling_schedule.append(*self.calculate_schedule_powers(self.voltage_data, self.undervoltage_data))
+        self.set_rolling_characteristics()
 
+    def update_rolling_schedule(self, voltage_data, undervoltage_data, window=pd.Timedelta(days=365)):
+        """
+        Appends new voltage data (e.g. one day) to rolling schedule, evicts datetimes older than window
+        and updates battery characteristics. Only powers of new datetimes are calculated.
+        Args:
+        --------
+            voltage_data: pd.DataFrame
+                voltage data of new datetimes (later than datetimes in schedule)
+            undervoltage_data: pd.DataFrame
+                undervoltage data of new datetimes
+            window: pd.Timedelta
+                length of rolling window
+        """
+        if self.rolling_schedule is None:
+            self.start_rolling_schedule()
+        voltage_data = get_data_from_smm_list(voltage_data, self.smms)
+        undervoltage_data = get_data_from_smm_list(undervoltage_data, self.smms)
+        self.rolling_schedule.append(*self.calculate_schedule_powers(voltage_data, undervoltage_data))
+        self.rolling_schedule.evict(pd.Timestamp(self.rolling_schedule.dates[-1]) - window)
+        self.set_rolling_characteristics()
+
+    def save_rolling_schedule(self, path):
+        """Saves rolling schedule to pickle file"""
+        self.rolling_schedule.save(path)
+
+    def load_rolling_schedule(self, path):
+        """Loads rolling schedule of previous runs from pickle file"""
+        self.rolling_schedule = RollingSchedule.load(path)
+        self.set_rolling_characteristics()
 
     def get_max_energy(self):
         """Calculates needed battery capacity from power data
@@ -221,28 +554,20 @@ class BatteryModel:
             self.max_energy_start_date = self.battery_df["soc"].idxmin()
 
         else:
+            dates = self.battery_df.index
+            starts, ends, sums = calculate_segment_energies(self.battery_df["battery_power"].values,
+                                                            self.get_block_starts(dates))
+            self.event_energies = pd.DataFrame(
+                {"start_date": dates[starts], "end_date": dates[ends], "energy": sums / 6})
             max_sum = 0
-            current_sum = 0
-            in_segment = False
-            max_sum_start_date = None
-            current_segment_start_date = None
-
-            for idx, value in self.battery_df['battery_power'].items():
-
-                if value == 0:
-                    if in_segment:
-                        if current_sum > max_sum:
-                            max_sum = current_sum
-                            max_sum_start_date = current_segment_start_date
-                        current_sum = 0
-                        in_segment = False
-                else:
-                    if not in_segment:
-                        current_segment_start_date = idx
-                        in_segment = True
-                    current_sum += value
-            self.battery_capacity =  max_sum/6
-            self.max_energy_start_date =  max_sum_start_date
+            self.max_energy_start_date = None
+            self.max_energy_end_date = None
+            if len(sums) > 0 and sums.max() > 0:
+                max_idx = np.argmax(sums)
+                max_sum = sums[max_idx]
+                self.max_energy_start_date = dates[starts[max_idx]]
+                self.max_energy_end_date = dates[ends[max_idx]]
+            self.battery_capacity = max_sum/6
 
     def calculate_battery_parameters(self):
         """Function that calculates battery operating schedule and the battery characteristics"""
@@ -258,6 +583,10 @@ class BatteryModel:
     def calculate_battery_characteristics(self):
         """
         Function that calculates battery operating schedule and the battery characteristics"""
+        self.calculate_slopes_ts()
+        if self.event_driven and self.powers_with_charging:
+            self.calculate_battery_events()
+            return
         if self.powers_with_charging:
             self.calculate_battery_powers_with_charging()
         else:
@@ -277,6 +606,9 @@ class BatteryModel:
         """Calculates number of cycles from power data and battery capacity 
         """
         powers = self.battery_df['battery_power']
+        if self.day_weights is not None:
+            # energy of represented days
+            powers = powers * self.day_weights.reindex(powers.index.normalize()).fillna(1.).values
         energy = sum(powers*(powers>0))/6
         self.battery_cycles = energy/self.battery_capacity
             
@@ -287,6 +619,9 @@ class BatteryModel:
             self.fm.feeder_res["battery_capacity"] = [self.battery_capacity]
             self.fm.feeder_res["battery_power"] = [self.battery_power]
             self.fm.feeder_res["battery_cycles"] = [self.battery_cycles]
+            if self.fm.battery_units is not None:
+                self.fm.feeder_res["N_of_batteries"] = [len(self.fm.battery_units)]
+                self.fm.feeder_res["battery_units"] = [self.fm.battery_units.to_dict("records")]
         else:
             self.fm.feeder_res["battery_smm"] = [None]
             self.fm.feeder_res["battery_capacity"] = [None]
@@ -1,7 +1,17 @@
+import numpy as np
 import pandas as pd
 import pandapower as pp
-from slope_calculation import calculate_slopes
+from slope_calculation import calculate_slopes, calculate_slopes_adaptive, calibrate_dates, select_dates, \
+    calculate_date_slopes
 from models.trafo_model import TrafoModel
+from subnet_creation import Subnet
+from network_manipulation import compare_feeder_subnet, populate_snet
+from models.lindistflow_model import LinDistFlowModel
+from state_clustering import StateClustering
+from phase_sensitivity import calculate_phase_slopes
+from powerflow_backends import network_state_hash
+from calibration_cache import data_fingerprint
+from timeseries_powerflow import TimeseriesPowerflow
 from utils import *
 
 
@@ -23,6 +33,53 @@ class FeederModel():
         self.slopes = None
         self.bm = None
         self.enough_voltage_data = self.tm.enough_voltage_data
+        # If "aggregate" or "ignore", powerflows run only on the feeder subtree, other feeders are
+        # represented with aggregated load at transformer busbar or ignored
+        self.feeder_local = None
+        # Maximal voltage difference (p.u.) between feeder subnet and whole snet
+        self.feeder_local_tol = 0.001
+        # (feeder_local, feeder_local_tol, network) chosen by get_powerflow_snet, so the subnet is
+        # created and checked only once
+        self.powerflow_snet = None
+        # If True, slopes are calculated with linearized LinDistFlow model instead of powerflows
+        self.use_surrogate = False
+        self.surrogate = None
+        # "finite_difference" or "jacobian" (analytic sensitivities, see sensitivity.py)
+        self.slope_method = "finite_difference"
+        # "secant", "gauss_newton" (joint calibration of res_factor and trafo_lv with warm starts)
+        # or "multi_date" (one res_factor for all sampled dates)
+        self.calibration_method = "secant"
+        # iteration and powerflow counts of joint calibrations
+        self.calibration_info = []
+        # If True, number of dates for slopes is chosen adaptively, until relative standard error of
+        # slopes is below adaptive_tol or powerflow_budget is used
+        self.adaptive_dates = False
+        self.adaptive_tol = 0.02
+        self.powerflow_budget = 200
+        self.slope_confidence = None
+        # If True, load states at undervoltage datetimes are clustered and slopes are calculated for
+        # representative state of each cluster
+        self.cluster_states = False
+        self.n_clusters = 4
+        self.state_clustering = None
+        self.cluster_slopes = None
+        # If True, per phase slopes are calculated with unbalanced powerflows, for each cluster of
+        # load states if cluster_states is True, otherwise for one representative date
+        self.phase_sensitivities = False
+        self.phase_slopes = None
+        # If True, battery smm is chosen by evaluating battery at every eligible smm (or at
+        # n_site_candidates smms with highest undervoltages), ranking is stored in site_ranking
+        self.search_battery_smm = False
+        self.n_site_candidates = None
+        self.site_ranking = None
+        # If more than 1, battery units are placed greedily until all undervoltages are resolved,
+        # units are stored in battery_units
+        self.max_batteries = 1
+        self.battery_units = None
+        # Slopes of every date (or cluster), their spread is used for Monte Carlo sizing
+        self.date_slopes = []
+        # Compiled calibrated network for batched powerflows, see get_timeseries_powerflow
+        self.timeseries_powerflow = None
 
     def define_calibration_lim_vol(self):
         """Defines calibration limit voltage for feeder based on undervoltage data,
@@ -67,18 +124,188 @@ class FeederModel():
         smms_ordered = order_smms_by_undervoltage_sum(self.uv_data_avg,
                                                       vol_lim=self.lim_vol_avg)
         self.battery_smm = find_battery_smm(self.snet, smms_ordered)
+        if self.search_battery_smm:
+            self.rank_battery_smms()
+
+    def rank_battery_smms(self):
+        """Ranks candidate smms by battery needed at them and chooses the best one as battery smm"""
+        # battery_siting uses BatteryModel, which imports this module
+        from battery_siting import rank_battery_smms
+        self.site_ranking, _ = rank_battery_smms(self, self.n_site_candidates)
+        self.battery_smm = self.site_ranking.index[0]
+
+    def place_batteries(self):
+        """Places up to max_batteries battery units on feeder, see battery_siting.place_batteries"""
+        # battery_siting uses BatteryModel, which imports this module
+        from battery_siting import place_batteries
+        self.battery_units = place_batteries(self, self.max_batteries, self.n_site_candidates)
+
+    def get_powerflow_snet(self):
+        """Returns network for powerflows of this feeder
+        If feeder_local is set, feeder subnet is created and checked against the whole snet on the
+        calibration dates. If results differ more than feeder_local_tol on some date, whole snet is used.
+        Chosen network is kept for next calls."""
+        if self.feeder_local is None:
+            return self.snet
+        if self.powerflow_snet is None or self.powerflow_snet[:2] != (self.feeder_local, self.feeder_local_tol):
+            self.powerflow_snet = (self.feeder_local, self.feeder_local_tol, self.create_feeder_local_snet())
+        return self.powerflow_snet[2]
+
+    def create_feeder_local_snet(self):
+        """Creates feeder subnet and returns it, if it matches the whole snet on calibration dates,
+        otherwise returns the whole snet"""
+        fsnet = Subnet(self.snet).create_feeder_subnet(self.feeder_name,
+                                                      other_feeders=self.feeder_local)
+        dates = select_dates(self.avg_dates) if len(self.avg_dates) > 4 else self.avg_dates
+        aggregated = list(fsnet.aggregated_loads)
+        diff = 0.
+        scalings = []
+        for date in dates:
+            max_diff, max_diff_drop = compare_feeder_subnet(self.snet, fsnet, self.smms,
+                                                            self.tm.df_p.loc[date],
+                                                            self.tm.df_q.loc[date])
+            scalings.append(fsnet.load.loc[aggregated, "scaling"].values)
+            # Ignored feeders change only busbar voltage, which is calibrated with trafo_lv,
+            # so only voltage drops along the feeder have to match
+            diff = max(diff, max_diff if self.feeder_local == "aggregate" else max_diff_drop)
+        if aggregated and len(scalings):
+            # losses of other feeders averaged over compared states
+            fsnet.load.loc[aggregated, "scaling"] = np.mean(scalings, axis=0)
+        if diff > self.feeder_local_tol:
+            print("Feeder subnet differs from snet for", diff, "p.u., using whole snet")
+            return self.snet
+        return fsnet
+
+    def calibrate_on_dates(self, snet, dates):
+        """Calibrates snet on given dates and returns average transformer voltage and resistance factor"""
+        calibration = calibrate_dates(snet, dates, self.smms, self.tm.df_p, self.tm.df_q,
+                                      self.tm.df_vol, method=self.calibration_method,
+                                      calibration_info=self.calibration_info,
+                                      calibration_cache=self.tm.calibration_cache)
+        trafo_lvs, res_fs = zip(*calibration.values())
+        return np.mean(trafo_lvs), np.mean(res_fs)
+
+    def create_surrogate(self, N_of_dates=4):
+        """Creates LinDistFlow model with network calibrated on sampled undervoltage dates.
+        Deviation of the model from powerflow on these dates is stored in surrogate.errors"""
+        snet = self.get_powerflow_snet()
+        dates_cal = select_dates(self.avg_dates, N_of_dates)
+        if self.enough_voltage_data:
+            trafo_lv, res_f = self.calibrate_on_dates(snet, dates_cal)
+        else:
+            trafo_lv, res_f = 0.425, 1.
+        self.surrogate = LinDistFlowModel(snet, res_factor=res_f, trafo_lv=trafo_lv)
+        self.surrogate.validate(self.tm.df_p, self.tm.df_q, dates_cal)
+        return dates_cal
+
+    def get_timeseries_powerflow(self, N_of_dates=4):
+        """Returns batched powerflow engine of the network calibrated on sampled undervoltage dates,
+        network is compiled once per feeder"""
+        if self.timeseries_powerflow is None:
+            snet = self.get_powerflow_snet()
+            if self.enough_voltage_data:
+                trafo_lv, res_f = self.calibrate_on_dates(snet, select_dates(self.avg_dates, N_of_dates))
+            else:
+                trafo_lv, res_f = 0.425, 1.
+            self.timeseries_powerflow = TimeseriesPowerflow(snet, self.tm.df_p.columns, res_factor=res_f,
+                                                            trafo_lv=trafo_lv)
+        return self.timeseries_powerflow
+
+    def calculate_surrogate_slopes(self):
+        """Calculates slopes for battery smm with LinDistFlow model, averaged over sampled dates"""
+        dates_cal = self.create_surrogate()
+        self.slopes = self.surrogate.get_slopes([self.battery_smm], self.tm.df_p.loc[dates_cal],
+                                                self.tm.df_q.loc[dates_cal])
+
+    def calculate_cluster_slopes(self):
+        """Clusters load states at undervoltage datetimes and calculates calibrated slopes on medoid
+        date of each cluster. slopes are average of cluster slopes weighted by cluster size."""
+        snet = self.get_powerflow_snet()
+        self.state_clustering = StateClustering(self.smms, self.n_clusters)
+        self.state_clustering.fit(self.undervoltage_data.date_time.unique(), self.tm.df_p, self.tm.df_q)
+        medoids = list(self.state_clustering.medoids.values())
+        calibration = calibrate_dates(snet, medoids, self.smms, self.tm.df_p, self.tm.df_q,
+                                      self.tm.df_vol, calibrate=self.enough_voltage_data,
+                                      method=self.calibration_method,
+                                      calibration_info=self.calibration_info,
+                                      calibration_cache=self.tm.calibration_cache)
+        self.cluster_slopes = {}
+        for cluster, date in self.state_clustering.medoids.items():
+            self.cluster_slopes[cluster] = calculate_date_slopes(snet, [self.battery_smm], date,
+                                                                 self.tm.df_p, self.tm.df_q,
+                                                                 calibration[date],
+                                                                 method=self.slope_method)
+        self.date_slopes = list(self.cluster_slopes.values())
+        weights = self.state_clustering.get_weights()
+        self.slopes = sum(self.cluster_slopes[cluster] * weight for cluster, weight in weights.items())
+
+    def calculate_phase_slopes(self):
+        """Calculates per phase slopes of battery smm for each cluster of load states (or for middle
+        undervoltage date, stored under cluster None). Results are cached in trafo model."""
+        snet = self.get_powerflow_snet()
+        if self.state_clustering is not None:
+            dates = dict(self.state_clustering.medoids)
+        else:
+            dates = {None: self.avg_dates[len(self.avg_dates) // 2]}
+        calibration = calibrate_dates(snet, list(dates.values()), self.smms, self.tm.df_p, self.tm.df_q,
+                                      self.tm.df_vol, calibrate=self.enough_voltage_data,
+                                      method=self.calibration_method,
+                                      calibration_cache=self.tm.calibration_cache)
+        self.phase_slopes = {}
+        for cluster, date in dates.items():
+            opt_trafo_lv, res_f = calibration[date]
+            # slopes depend on network, loads of the date and calibration, not on the feeder
+            key = (network_state_hash(snet), self.battery_smm, pd.Timestamp(date),
+                   data_fingerprint(date, self.tm.df_p, self.tm.df_q), opt_trafo_lv, res_f)
+            if key not in self.tm.phase_slopes_cache:
+                populate_snet(snet, self.tm.df_p.loc[date], self.tm.df_q.loc[date], warn=False)
+                self.tm.phase_slopes_cache[key] = calculate_phase_slopes(snet, [self.battery_smm],
+                                                                         res_factor=res_f,
+                                                                         trafo_lv=opt_trafo_lv)
+            self.phase_slopes[cluster] = self.tm.phase_slopes_cache[key]
 
     def calculate_slopes(self):
         """Calculates slopes for given feeder, for battery smm"""
         self.define_and_limit_voltage()
         self.determine_battery_smm()
-        self.slopes = calculate_slopes(self.snet, [self.battery_smm],
+        if self.use_surrogate:
+            self.calculate_surrogate_slopes()
+            return
+        if self.cluster_states:
+            self.calculate_cluster_slopes()
+        if self.phase_sensitivities:
+            self.calculate_phase_slopes()
+        if self.cluster_states:
+            return
+        if self.adaptive_dates:
+            self.slopes, self.slope_confidence = calculate_slopes_adaptive(
+                self.get_powerflow_snet(), [self.battery_smm],
+                self.avg_dates,
+                self.smms,
+                self.tm.df_p,
+                self.tm.df_q,
+                self.tm.df_vol,
+                calibrate=self.enough_voltage_data,
+                tol=self.adaptive_tol,
+                max_powerflows=self.powerflow_budget,
+                method=self.slope_method,
+                calibration_method=self.calibration_method,
+                calibration_info=self.calibration_info,
+                calibration_cache=self.tm.calibration_cache)
+            return
+        self.date_slopes = []
+        self.slopes = calculate_slopes(self.get_powerflow_snet(), [self.battery_smm],
                                        self.avg_dates,
                                        self.smms,
                                        self.tm.df_p,
                                        self.tm.df_q,
                                        self.tm.df_vol,
-                                       calibrate=self.enough_voltage_data)
+                                       calibrate=self.enough_voltage_data,
+                                       method=self.slope_method,
+                                       calibration_method=self.calibration_method,
+                                       calibration_info=self.calibration_info,
+                                       calibration_cache=self.tm.calibration_cache,
+                                       date_slopes=self.date_slopes)
 
     def calculate_and_write_uv_data(self, empty_battery_columns=False):
         """Calculates undervoltage parameters for given feeder, determines if solving with battery is needed, calculates voltage-power slopes"""
@@ -92,3 +319,5 @@ class FeederModel():
         self.calculate_and_write_uv_data()
         if self.suitable_for_battery:
             self.calculate_slopes()
+            if self.max_batteries > 1:
+                self.place_batteries()
@@ -0,0 +1,200 @@
+import numpy as np
+import pandas as pd
+import pandapower.topology as top
+import networkx as nx
+from network_manipulation import run_powerflow, populate_snet
+
+
+class LinDistFlowModel:
+    """Linearized radial voltage model (LinDistFlow) of the trafo network
+
+    Squared voltages at smm busses are linear in load powers:
+        v_i^2 = v_0^2 - 2 * sum_k (R_ik * p_k + X_ik * q_k)
+    where R_ik and X_ik are resistance and reactance of the common path from the transformer
+    to busses i and k (transformer impedance included) and v_0 is the no-load transformer voltage.
+    Evaluating many states is a matrix product, line charging and transformer no-load losses are neglected.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        smms: list
+            smms at which voltages are calculated, if None all smms in snet
+        res_factor: float
+            calibrated resistance factor for lines
+        trafo_lv: float
+            calibrated transformer voltage
+    """
+
+    def __init__(self, snet, smms=None, res_factor=1., trafo_lv=0.425):
+        self.snet = snet
+        self.res_factor = res_factor
+        self.trafo_lv = trafo_lv
+        loads = snet.load[snet.load.smm.notna()]
+        if smms is not None:
+            loads = loads[loads.smm.isin(smms)]
+        # voltages are calculated at the bus of the first load of each smm
+        loads = loads.drop_duplicates("smm")
+        self.smms = loads.smm.values
+        self.buses = loads.bus.values
+        self.vn_kv = snet.bus.loc[self.buses, "vn_kv"].values
+        self.errors = None
+        self.create_load_incidence()
+        self.create_path_matrices()
+
+    def create_load_incidence(self):
+        """Creates matrix that maps smm powers to all loads in service, as in populate_snet: every load of
+        smm gets its power and aggregated loads get the sum of powers of smms they represent"""
+        loads = self.snet.load[self.snet.load.in_service]
+        aggregated = self.snet.get("aggregated_loads", {})
+        smms_loads = [aggregated.get(load_id, [load.smm]) for load_id, load in loads.iterrows()]
+        self.power_smms = pd.unique([smm for smms_load in smms_loads for smm in smms_load
+                                     if not pd.isna(smm)])
+        smm_position = {smm: i for i, smm in enumerate(self.power_smms)}
+        self.load_buses = loads.bus.values
+        self.load_incidence = np.zeros((len(self.power_smms), len(loads)))
+        for j, (smms_load, scaling) in enumerate(zip(smms_loads, loads.scaling.values)):
+            for smm in smms_load:
+                if smm in smm_position:
+                    self.load_incidence[smm_position[smm], j] = scaling
+
+    def get_transformer_parameters(self):
+        """Returns no-load voltage in kV and impedance in Ohm of the transformer, referred to the LV side"""
+        trafo = self.snet.trafo.iloc[0]
+        ext_grid = self.snet.ext_grid.iloc[0]
+        v_hv = ext_grid.vm_pu * self.snet.bus.loc[ext_grid.bus, "vn_kv"]
+        v_0 = v_hv * self.trafo_lv / trafo.vn_hv_kv
+        if np.isfinite(trafo.tap_pos) and np.isfinite(trafo.tap_neutral) and np.isfinite(trafo.tap_step_percent):
+            tap = 1 + (trafo.tap_pos - trafo.tap_neutral) * trafo.tap_step_percent / 100
+            v_0 = v_0 / tap if trafo.tap_side == "hv" else v_0 * tap
+        z_base = self.trafo_lv**2 / trafo.sn_mva / trafo.parallel
+        r_t = trafo.vkr_percent / 100 * z_base
+        x_t = np.sqrt(max(trafo.vk_percent**2 - trafo.vkr_percent**2, 0)) / 100 * z_base
+        return v_0, r_t, x_t
+
+    def get_edge_impedance(self, mg, u, v):
+        """Returns impedance in Ohm of all parallel lines and switches between busses u and v"""
+        y = 0
+        for (element, idx) in mg.get_edge_data(u, v).keys():
+            if element != "line":
+                # closed bus-bus switch
+                return 0.
+            line = self.snet.line.loc[idx]
+            z = (line.r_ohm_per_km + 1j * line.x_ohm_per_km) * line.length_km * self.res_factor
+            y += line.parallel / z
+        return 1 / y
+
+    def create_path_matrices(self):
+        """Creates matrices R and X of common path impedances between smm busses and matrices R_load and
+        X_load between smm busses and load busses"""
+        tr_bus = self.snet.bus[self.snet.bus["aclass_id"] == "TR"].index[0]
+        mg = top.create_nxgraph(self.snet, respect_switches=True, include_trafos=False)
+        paths = nx.single_source_shortest_path(mg, tr_bus)
+        edges = {}
+
+        def get_incidence(buses):
+            rows = []
+            for bus in buses:
+                # loads that are not connected to the transformer do not change voltages
+                path = paths.get(bus, [])
+                row = []
+                for u, v in zip(path[:-1], path[1:]):
+                    key = (min(u, v), max(u, v))
+                    if key not in edges:
+                        edges[key] = len(edges)
+                    row.append(edges[key])
+                rows.append(row)
+            return rows, [bus in paths for bus in buses]
+
+        rows, _ = get_incidence(self.buses)
+        load_rows, connected = get_incidence(self.load_buses)
+        incidence = np.zeros((len(self.buses), len(edges)))
+        for i, row in enumerate(rows):
+            incidence[i, row] = 1
+        load_incidence = np.zeros((len(self.load_buses), len(edges)))
+        for i, row in enumerate(load_rows):
+            load_incidence[i, row] = 1
+        z_edges = np.zeros(len(edges), dtype=complex)
+        for (u, v), j in edges.items():
+            z_edges[j] = self.get_edge_impedance(mg, u, v)
+        self.v_0, r_t, x_t = self.get_transformer_parameters()
+        self.R = incidence @ np.diag(z_edges.real) @ incidence.T + r_t
+        self.X = incidence @ np.diag(z_edges.imag) @ incidence.T + x_t
+        self.R_load = (incidence @ np.diag(z_edges.real) @ load_incidence.T + r_t) * connected
+        self.X_load = (incidence @ np.diag(z_edges.imag) @ load_incidence.T + x_t) * connected
+
+    def get_state_arrays(self, df_p, df_q):
+        """Returns arrays of load powers in MW (states x loads), missing powers are 0"""
+        p = df_p.reindex(columns=self.power_smms).fillna(0).values @ self.load_incidence / 1000
+        q = df_q.reindex(columns=self.power_smms).fillna(0).values @ self.load_incidence / 1000
+        return p, q
+
+    def calculate_voltages(self, df_p, df_q):
+        """Calculates voltages at smms for all states in df_p and df_q
+
+        Args:
+        --------
+            df_p:
+                dataframe with active powers in kW, dates as index and smms as columns
+            df_q:
+                dataframe with reactive powers in kvar
+        Returns:
+        --------
+            volts: pd.DataFrame
+                voltages in p.u. with dates as index and smms as columns
+        """
+        p, q = self.get_state_arrays(df_p, df_q)
+        v_sq = self.v_0**2 - 2 * (p @ self.R_load.T + q @ self.X_load.T)
+        volts = np.sqrt(np.clip(v_sq, 0, None)) / self.vn_kv
+        return pd.DataFrame(volts, index=df_p.index, columns=self.smms)
+
+    def calculate_slopes(self, battery_smm, df_p, df_q):
+        """Calculates slopes (V/kW) for battery smm for all states in df_p and df_q
+        Slope is voltage increase at each smm when power at battery smm is decreased by 1 kW,
+        derived from d(v_i^2)/dp_k = -2 R_ik at the voltage of given state.
+        Returns:
+        --------
+            slopes: pd.DataFrame
+                slopes with dates as index and smms as columns
+        """
+        k = np.where(self.smms == battery_smm)[0][0]
+        volts = self.calculate_voltages(df_p, df_q).values
+        slopes = self.R[:, k] / (volts * self.vn_kv) / 1000 / self.vn_kv * 230
+        return pd.DataFrame(slopes, index=df_p.index, columns=self.smms)
+
+    def get_slopes(self, battery_smms, df_p, df_q):
+        """Calculates average slopes over states in df_p and df_q, in the same shape as calculate_slopes
+        in slope_calculation (smms as index, battery smms as columns)"""
+        slopes_smms = pd.DataFrame(index=self.smms)
+        for battery_smm in battery_smms:
+            slopes_smms[str(battery_smm)] = self.calculate_slopes(battery_smm, df_p, df_q).mean().values
+        slopes_smms.index.name = "smm"
+        return slopes_smms
+
+    def validate(self, df_p, df_q, dates, backend=None):
+        """Compares model voltages with pandapower powerflow on sampled dates
+
+        Args:
+        --------
+            df_p:
+                dataframe with active powers for all smms
+            df_q:
+                dataframe with reactive powers for all smms
+            dates: list
+                dates on which the model is compared with powerflow
+            backend:
+                powerflow backend
+        Returns:
+        --------
+            errors: pd.DataFrame
+                maximal and mean absolute voltage deviation in p.u. for each date
+        """
+        volts_lin = self.calculate_voltages(df_p.loc[dates], df_q.loc[dates])
+        errors = []
+        for date in dates:
+            populate_snet(self.snet, df_p.loc[date], df_q.loc[date], warn=False)
+            run_powerflow(self.snet, res_factor=self.res_factor, trafo_lv=self.trafo_lv, backend=backend)
+            vol_pp = self.snet.res_bus.vm_pu.loc[self.buses].values
+            deviation = np.abs(volts_lin.loc[date].values - vol_pp)
+            errors.append([deviation.max(), deviation.mean()])
+        self.errors = pd.DataFrame(errors, index=dates, columns=["max_abs_error", "mean_abs_error"])
+        return self.errors
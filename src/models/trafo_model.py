@@ -3,6 +3,8 @@ import pandapower as pp
 import networkx as nx
 from utils import *
 from subnet_creation import Subnet
+from network_reduction import reduce_snet
+from calibration_cache import CalibrationCache
 
 class TrafoModel:
     def __init__(self, voltage_data, undervoltage_data, df_vol, df_p, df_q,  trafo_name, network_path):
@@ -16,6 +18,18 @@ class TrafoModel:
         self.feeders = None
         self.trafo_res_df = pd.DataFrame()
         self.snet = None
+        self.snet_full = None
+        # If True, unloaded and unmeasured busses are eliminated from snet before calculations
+        self.reduce_network = False
+        # Calibrations and base case results of all feeders of the transformer
+        self.calibration_cache = CalibrationCache(trafo_name)
+        # Per phase slopes from unbalanced powerflows, keyed by network state, battery smm, date, data of
+        # the date and calibration, shared by all feeders of the transformer
+        self.phase_slopes_cache = {}
+        # If set, batteries are sized on representative and extreme days kept by this PeriodCompression,
+        # day_weights are weights of kept days (see compress_period)
+        self.period_compression = None
+        self.day_weights = None
         if self.voltage_data is not None:
             self.enough_voltage_data = self.is_there_enough_voltage_data()
 
@@ -76,6 +90,31 @@ class TrafoModel:
         if self.snet is None:
             self.create_snet()
         self.populate_snet_feeders_phases()
+        if self.reduce_network:
+            self.reduce_snet()
+
+    def reduce_snet(self):
+        """Replaces snet with reduced network, that keeps only busses with smms and transformer busses.
+        Original network is kept in snet_full, mapping of busses is in snet.bus_map"""
+        if self.snet_full is None:
+            self.snet_full = self.snet
+        self.snet = reduce_snet(self.snet_full)
+
+    def compress_period(self, n_representative=10, n_extreme=5):
+        """Selects representative and extreme days of voltage data, on which batteries of all feeders are
+        sized. Undervoltage parameters and slopes of feeders are still calculated on all data"""
+        # period_compression uses BatteryModel, which imports this module
+        from period_compression import PeriodCompression
+        self.period_compression = PeriodCompression(n_representative, n_extreme)
+        self.day_weights = self.period_compression.fit(self.voltage_data, self.undervoltage_data)
+
+    def load_calibration_cache(self, path):
+        """Loads calibration cache of previous runs from pickle file"""
+        self.calibration_cache = CalibrationCache.load(path)
+
+    def save_calibration_cache(self, path):
+        """Saves calibration cache to pickle file"""
+        self.calibration_cache.save(path)
 
     def percentage_of_voltage_data(self):
         """Calculates precentage of smms, for which we have voltage data"""
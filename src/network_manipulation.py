@@ -1,7 +1,10 @@
+from contextlib import contextmanager
+
 import networkx as nx
 import numpy as np
 import pandapower as pp
 
+from powerflow_backends import get_backend
 
 def create_network(json_path):
 	net = pp.from_json(json_path)
@@ -21,7 +24,7 @@ def set_volts(snet, state_vol, warn=True, sort=True):
             if True, sorts the dataframe by real voltage"""
     volts = snet.load[['bus', 'p_mw', "q_mvar", "smm", "name"]]
     volts["vol_pp"] = 0
-    volts["vol_real"] = 0
+    volts["vol_real"] = np.nan
     for row in snet.load.itertuples():
         bus = row.bus
         vol_pp = snet.res_bus.loc[bus]
@@ -41,9 +44,10 @@ def set_volts(snet, state_vol, warn=True, sort=True):
     return volts
 
 
-def run_powerflow(snet, res_factor=1., trafo_lv=0.4):
-    """Runs powerflow on snet with adjusted resistance factor and transformer voltage
-    Makes sure that the original values are restored in case of an error
+@contextmanager
+def adjusted_snet(snet, res_factor=1., trafo_lv=0.4):
+    """Context in which snet lines are scaled with res_factor and transformer voltage is set to trafo_lv
+    Makes sure that the original values are restored, also in case of an error
     Args:
         --------
         snet:
@@ -57,20 +61,37 @@ def run_powerflow(snet, res_factor=1., trafo_lv=0.4):
        
         raise Exception("res_factor or trafo_lv is not finite")
     orig_lv = snet.trafo['vn_lv_kv'].copy()
-    # print("orig_lv: ", orig_lv)
     snet.line['r_ohm_per_km'] = snet.line['r_ohm_per_km'] * res_factor
     snet.line['x_ohm_per_km'] = snet.line['x_ohm_per_km'] * res_factor
     snet.trafo['vn_lv_kv'] = trafo_lv
     try:
-        pp.runpp(snet, numba=False)
-        snet.trafo['vn_lv_kv'] = orig_lv
-        snet.line['r_ohm_per_km'] = snet.line['r_ohm_per_km'] / res_factor
-        snet.line['x_ohm_per_km'] = snet.line['x_ohm_per_km'] / res_factor
-    except:
+        yield snet
+    finally:
         snet.trafo['vn_lv_kv'] = orig_lv
         snet.line['r_ohm_per_km'] = snet.line['r_ohm_per_km'] / res_factor
         snet.line['x_ohm_per_km'] = snet.line['x_ohm_per_km'] / res_factor
-        raise Exception("Powerflow did not converge")
+
+
+def run_powerflow(snet, res_factor=1., trafo_lv=0.4, backend=None):
+    """Runs powerflow on snet with adjusted resistance factor and transformer voltage
+    Makes sure that the original values are restored in case of an error
+    Args:
+        --------
+        snet:
+            network in pandapower format
+        res_factor: float
+            resistance factor for lines
+        trafo_lv: float
+            transformer voltage
+        backend: str or PowerflowBackend
+            powerflow backend, if None config.POWERFLOW_BACKEND is used
+    """
+    backend = get_backend(backend)
+    with adjusted_snet(snet, res_factor, trafo_lv):
+        try:
+            backend.run(snet)
+        except:
+            raise Exception("Powerflow did not converge")
     
 
 def populate_snet(snet, state_p, state_q, warn=True):
@@ -85,7 +106,7 @@ def populate_snet(snet, state_p, state_q, warn=True):
             dictionary with measured reactive powers
         warn: bool
             if True, prints warnings if some data is missing"""
-    smms = snet.load.smm.unique()
+    smms = snet.load.smm.dropna().unique()
     snet.load["p_mw"] = 0
     snet.load["q_mvar"] = 0
     for smm in smms:
@@ -107,3 +128,67 @@ def populate_snet(snet, state_p, state_q, warn=True):
             if warn:
                 print("manjka jalova moc za smm: ", smm)
             snet.load.loc[snet.load.smm == smm, 'q_mvar'] = 0
+    # loads that represent several smms, e.g. other feeders in feeder subnet
+    for load_id, smms_agg in snet.get("aggregated_loads", {}).items():
+        snet.load.loc[load_id, 'p_mw'] = np.nansum(state_p.reindex(smms_agg).astype(float)) / 1000
+        snet.load.loc[load_id, 'q_mvar'] = np.nansum(state_q.reindex(smms_agg).astype(float)) / 1000
+
+
+def set_aggregated_load_scaling(snet, fsnet):
+    """Sets scaling of aggregated loads in fsnet, so that they include losses of the feeders they represent
+    snet must have powerflow results and fsnet must be populated with the same state.
+    Scaling is the ratio between active power flowing from transformer busbar into represented feeders
+    and the sum of their loads."""
+    tr_bus = snet.bus[snet.bus["aclass_id"] == "TR"].index[0]
+    lines = snet.line[(snet.line.from_bus == tr_bus) | (snet.line.to_bus == tr_bus)]
+    lines = lines[~lines.index.isin(fsnet.line.index)]
+    p_heads = np.where(lines.from_bus == tr_bus, snet.res_line.loc[lines.index].p_from_mw,
+                       snet.res_line.loc[lines.index].p_to_mw).sum()
+    for load_id in fsnet.get("aggregated_loads", {}):
+        p_load = fsnet.load.loc[load_id, "p_mw"]
+        fsnet.load.loc[load_id, "scaling"] = p_heads / p_load if p_load > 0 else 1.
+
+
+def compare_feeder_subnet(snet, fsnet, smms_feeder, state_p, state_q, res_factor=1., trafo_lv=0.425,
+                          backend=None):
+    """Compares voltages at feeder smms calculated on feeder subnet with voltages on the whole snet
+    Aggregated loads in fsnet are scaled to include losses of other feeders in this state.
+    Args:
+        --------
+        snet:
+            network in pandapower format
+        fsnet:
+            feeder subnet, created with Subnet.create_feeder_subnet
+        smms_feeder: list
+            smms in the feeder
+        state_p: dict
+            dictionary with measured powers in kW, keys are smms
+        state_q: dict
+            dictionary with measured reactive powers
+        res_factor: float
+            resistance factor for lines
+        trafo_lv: float
+            transformer voltage
+        backend: str or PowerflowBackend
+            powerflow backend
+    Returns:
+        --------
+        max_diff: float
+            maximal absolute difference of voltages in p.u.
+        max_diff_drop: float
+            maximal absolute difference of voltage drops from transformer busbar in p.u.
+    """
+    tr_bus = snet.bus[snet.bus["aclass_id"] == "TR"].index[0]
+    buses = snet.load.loc[snet.load.smm.isin(smms_feeder), "bus"].unique()
+    vols = []
+    drops = []
+    for net in (snet, fsnet):
+        populate_snet(net, state_p, state_q, warn=False)
+        if net is fsnet:
+            set_aggregated_load_scaling(snet, fsnet)
+        run_powerflow(net, res_factor=res_factor, trafo_lv=trafo_lv, backend=backend)
+        vols.append(net.res_bus.vm_pu.loc[buses])
+        drops.append(net.res_bus.vm_pu.loc[tr_bus] - net.res_bus.vm_pu.loc[buses])
+    max_diff = (vols[0] - vols[1]).abs().max()
+    max_diff_drop = (drops[0] - drops[1]).abs().max()
+    return max_diff, max_diff_drop
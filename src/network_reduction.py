@@ -0,0 +1,254 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pandapower as pp
+
+
+def get_protected_buses(snet, keep_buses=None):
+    """Returns busses that must stay in the reduced network
+    These are busses with loads (smms) or static generators, transformer and external grid busses,
+    transformer busbar (aclass_id TR), busses with switches or out of service lines, and keep_buses.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        keep_buses: list
+            additional busses that must not be eliminated
+    Returns:
+    --------
+        protected: set
+            set of protected busses
+    """
+    protected = set(snet.load.bus) | set(snet.sgen.bus) | set(snet.ext_grid.bus)
+    protected |= set(snet.trafo.hv_bus) | set(snet.trafo.lv_bus)
+    if "aclass_id" in snet.bus.columns:
+        protected |= set(snet.bus[snet.bus["aclass_id"] == "TR"].index)
+    protected |= set(snet.switch.bus)
+    bus_switches = snet.switch[snet.switch.et == "b"]
+    protected |= set(bus_switches.element)
+    switched_lines = snet.line.loc[snet.line.index.isin(snet.switch[snet.switch.et == "l"].element)]
+    oos_lines = snet.line[~snet.line.in_service]
+    for lines in (switched_lines, oos_lines):
+        protected |= set(lines.from_bus) | set(lines.to_bus)
+    if keep_buses is not None:
+        protected |= set(keep_buses)
+    return protected
+
+
+def eliminate_bus(bus, adjacency, branches, new_branch_id, shunt_c):
+    """Eliminates bus with star-mesh (Kron) transformation of its branches
+    Each pair of neighbours gets an equivalent branch with impedance z_i * z_j * sum(1/z_k).
+    For two branches this is a series connection, for one branch (dead end) the branch is removed
+    and its capacitance is lumped to the neighbour, as for pairs of branches to the same neighbour.
+    Args:
+    --------
+        bus:
+            bus to eliminate
+        adjacency: dict
+            bus -> set of branch ids
+        branches: dict
+            branch id -> dict with from_bus, to_bus, z_ohm, c_nf, length_km, max_i_ka and name
+        new_branch_id: int
+            id of the first new branch
+        shunt_c: dict
+            bus -> capacitance (nF) of removed lines lumped to bus
+    Returns:
+    --------
+        new_branch_id:
+            id of the next new branch
+    """
+    star = [branches.pop(br) for br in adjacency.pop(bus)]
+    neighbours = [br["to_bus"] if br["from_bus"] == bus else br["from_bus"] for br in star]
+    for br, neighbour in zip(star, neighbours):
+        adjacency[neighbour].discard(br["id"])
+    c_bus = shunt_c.pop(bus, 0.)
+    if len(star) == 1:
+        shunt_c[neighbours[0]] += star[0]["c_nf"] + c_bus
+        return new_branch_id
+    y_sum = sum(1 / br["z_ohm"] for br in star)
+    n_pairs = len(star) * (len(star) - 1) // 2
+    # capacitance of eliminated lines and bus is shared among equivalent branches
+    c_share = (sum(br["c_nf"] for br in star) + c_bus) / n_pairs
+    for i in range(len(star)):
+        for j in range(i + 1, len(star)):
+            if neighbours[i] == neighbours[j]:
+                # parallel branches to the same neighbour would give a branch from the neighbour to
+                # itself, that carries no current, so only its capacitance is kept
+                shunt_c[neighbours[i]] += c_share
+                continue
+            bi, bj = star[i], star[j]
+            # feeder lines (IZV) give name to the equivalent branch, so feeders can still be found
+            name = bj["name"] if "IZV" in str(bj["name"]) else bi["name"]
+            branches[new_branch_id] = {
+                "id": new_branch_id,
+                "from_bus": neighbours[i],
+                "to_bus": neighbours[j],
+                "z_ohm": bi["z_ohm"] * bj["z_ohm"] * y_sum,
+                "c_nf": c_share,
+                "length_km": bi["length_km"] + bj["length_km"],
+                "max_i_ka": min(bi["max_i_ka"], bj["max_i_ka"]),
+                "name": name,
+                "template": bi["template"],
+            }
+            adjacency[neighbours[i]].add(new_branch_id)
+            adjacency[neighbours[j]].add(new_branch_id)
+            new_branch_id += 1
+    return new_branch_id
+
+
+def is_elimination_valid(bus, adjacency, branches):
+    """Star-mesh of branches with different R/X ratios can give negative resistance, we skip such busses"""
+    star = [branches[br] for br in adjacency[bus]]
+    if len(star) < 3:
+        return True
+    y_sum = sum(1 / br["z_ohm"] for br in star)
+    for i in range(len(star)):
+        for j in range(i + 1, len(star)):
+            z = star[i]["z_ohm"] * star[j]["z_ohm"] * y_sum
+            if z.real <= 0 or z.imag < 0:
+                return False
+    return True
+
+
+def reduce_snet(snet, keep_buses=None, max_degree=2):
+    """Creates reduced copy of snet without unloaded and unmeasured busses
+
+    Dead ends without loads are removed, series chains are collapsed into equivalent lines and,
+    if max_degree > 2, junctions with up to max_degree lines are eliminated with star-mesh
+    (Kron) transformation. Voltages at protected busses (smms, transformer) are preserved, line
+    capacitances are lumped to the remaining busses: capacitances of removed dead ends and of lines
+    from a bus to itself (which carry no current and are not reduced) become shunts. Kept busses keep
+    their original ids, so loads, smms and set_volts work on reduced network without changes.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        keep_buses: list
+            additional busses that must not be eliminated
+        max_degree: int
+            maximal number of lines at bus that is eliminated
+    Returns:
+    --------
+        snet_red:
+            reduced network, snet_red.bus_map holds mapping from original to reduced busses
+    """
+    protected = get_protected_buses(snet, keep_buses)
+    lines = snet.line[snet.line.in_service]
+    parallel = lines.parallel.values
+    branches = {}
+    adjacency = {bus: set() for bus in snet.bus.index}
+    shunt_c = {bus: 0. for bus in snet.bus.index}
+    for (idx, line), n in zip(lines.iterrows(), parallel):
+        if line.from_bus == line.to_bus:
+            shunt_c[line.from_bus] += line.c_nf_per_km * line.length_km * n
+            continue
+        branches[idx] = {
+            "id": idx,
+            "from_bus": line.from_bus,
+            "to_bus": line.to_bus,
+            "z_ohm": (line.r_ohm_per_km + 1j * line.x_ohm_per_km) * line.length_km / n,
+            "c_nf": line.c_nf_per_km * line.length_km * n,
+            "length_km": line.length_km,
+            "max_i_ka": line.max_i_ka * n,
+            "name": line["name"],
+            "template": idx,
+        }
+        adjacency[line.from_bus].add(idx)
+        adjacency[line.to_bus].add(idx)
+    new_branch_id = snet.line.index.max() + 1
+    representative = {}
+    candidates = [bus for bus in snet.bus.index if bus not in protected]
+    changed = True
+    while changed:
+        changed = False
+        for bus in candidates:
+            if bus not in adjacency:
+                continue
+            degree = len(adjacency[bus])
+            if degree == 0 or degree > max(max_degree, 1):
+                continue
+            if not is_elimination_valid(bus, adjacency, branches):
+                continue
+            # eliminated bus is represented by electrically closest neighbour
+            closest = min(adjacency[bus], key=lambda br: abs(branches[br]["z_ohm"]))
+            br = branches[closest]
+            representative[bus] = br["to_bus"] if br["from_bus"] == bus else br["from_bus"]
+            new_branch_id = eliminate_bus(bus, adjacency, branches, new_branch_id, shunt_c)
+            changed = True
+    removed_buses = list(representative.keys())
+    snet_red = copy.deepcopy(snet)
+    snet_red.bus.drop(removed_buses, inplace=True)
+    snet_red.line = build_line_table(snet, branches)
+    create_capacitance_shunts(snet_red, shunt_c)
+    for table, index in (("bus_geodata", snet_red.bus.index), ("line_geodata", snet_red.line.index)):
+        if table in snet_red and len(snet_red[table]):
+            snet_red[table] = snet_red[table].loc[snet_red[table].index.isin(index)]
+    snet_red["bus_map"] = create_bus_map(snet, representative)
+    return snet_red
+
+
+def create_capacitance_shunts(snet_red, shunt_c):
+    """Creates shunts with capacitances (nF) of removed lines at busses of reduced network"""
+    for bus, c_nf in shunt_c.items():
+        if c_nf > 0:
+            vn_kv = snet_red.bus.at[bus, "vn_kv"]
+            q_mvar = -vn_kv**2 * 2 * np.pi * snet_red.f_hz * c_nf * 1e-9
+            pp.create_shunt(snet_red, bus, q_mvar=q_mvar, p_mw=0., vn_kv=vn_kv, name="line capacitance")
+
+
+def build_line_table(snet, branches):
+    """Creates line table of reduced network, original lines are kept, equivalent lines are added"""
+    rows = []
+    for idx, br in branches.items():
+        if idx in snet.line.index:
+            rows.append(snet.line.loc[idx])
+            continue
+        row = snet.line.loc[br["template"]].copy()
+        length = max(br["length_km"], 1e-3)
+        row["from_bus"] = br["from_bus"]
+        row["to_bus"] = br["to_bus"]
+        row["length_km"] = length
+        row["r_ohm_per_km"] = br["z_ohm"].real / length
+        row["x_ohm_per_km"] = br["z_ohm"].imag / length
+        row["c_nf_per_km"] = br["c_nf"] / length
+        row["max_i_ka"] = br["max_i_ka"]
+        row["parallel"] = 1
+        row["name"] = br["name"]
+        row["std_type"] = None
+        row.name = idx
+        rows.append(row)
+    oos = snet.line[~snet.line.in_service]
+    line = pd.concat([pd.DataFrame(rows), oos]).sort_index()
+    return line.astype(snet.line.dtypes.to_dict())
+
+
+def create_bus_map(snet, representative):
+    """Creates mapping from original busses to busses in reduced network
+
+    Returns:
+    --------
+        bus_map: pd.DataFrame
+            index are original busses, column reduced_bus is bus in reduced network or NaN
+            if bus was eliminated, column nearest_bus is the reduced bus that represents it
+    """
+    nearest = []
+    for bus in snet.bus.index:
+        while bus in representative:
+            bus = representative[bus]
+        nearest.append(bus)
+    bus_map = pd.DataFrame({"nearest_bus": nearest}, index=snet.bus.index)
+    bus_map["reduced_bus"] = np.where(bus_map.index.isin(list(representative.keys())), np.nan,
+                                      bus_map.index)
+    return bus_map[["reduced_bus", "nearest_bus"]]
+
+
+def map_bus_results(snet_red, res_bus=None):
+    """Maps bus results of reduced network back to all original busses
+    Eliminated busses get results of the reduced bus that represents them."""
+    if res_bus is None:
+        res_bus = snet_red.res_bus
+    bus_map = snet_red.bus_map
+    res = res_bus.loc[bus_map.nearest_bus].copy()
+    res.index = bus_map.index
+    return res
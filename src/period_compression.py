@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+
+from models.battery_model import BatteryModel
+from state_clustering import get_medoids
+
+FEATURES = ["N_of_uv", "longest_event", "depth", "deficit", "min_voltage", "mean_voltage"]
+
+
+class PeriodCompression:
+    """Compression of voltage data to representative and extreme days
+
+    Days with the longest and the deepest undervoltage events and with the largest voltage deficit
+    (which mostly determines capacity) are always kept. Other days are clustered with KMeans by their
+    undervoltage and voltage features, each cluster is represented by the day closest to the cluster
+    centre, weighted by the number of days in the cluster. Day after a
+    kept undervoltage day is also kept (with weight 0), so events lasting over midnight and recharging
+    after them are simulated. Every block of consecutive kept days is simulated from full battery
+    (see BatteryModel.get_block_starts), so state of charge is not carried over dropped days.
+    Capacity and power are maxima over kept days, weights are used for energy and cycles.
+    Sweep, Monte Carlo sizing, rolling schedule and placement of multiple units do not support
+    compressed data.
+    Args:
+    --------
+        n_representative: int
+            number of representative days (clusters)
+        n_extreme: int
+            number of days kept by each of longest event, depth and deficit
+        include_next_day: bool
+            if True, days after kept undervoltage days are kept
+        vol_lim: float
+            voltage limit for depth of undervoltages, p.u.
+        random_state: int
+            seed of KMeans
+    """
+
+    def __init__(self, n_representative=10, n_extreme=5, include_next_day=True, vol_lim=207/230,
+                 random_state=0):
+        self.n_representative = n_representative
+        self.n_extreme = n_extreme
+        self.include_next_day = include_next_day
+        self.vol_lim = vol_lim
+        self.random_state = random_state
+        self.features = None
+        self.extreme_days = None
+        self.weights = None
+
+    def get_daily_features(self, voltage_data, undervoltage_data):
+        """Returns number of undervoltage datetimes, longest undervoltage event (datetimes), depth of
+        undervoltage (V below vol_lim), deficit (sum of depths of datetimes), minimal and mean voltage of
+        each day"""
+        u_min = voltage_data[["u_1", "u_2", "u_3"]].min(axis=1).groupby(voltage_data.date_time).min()
+        days = u_min.index.normalize()
+        features = pd.DataFrame({"min_voltage": u_min.groupby(days).min(),
+                                 "mean_voltage": u_min.groupby(days).mean()})
+        features["depth"] = (self.vol_lim * 230 - features.min_voltage).clip(lower=0)
+        features["deficit"] = (self.vol_lim * 230 - u_min).clip(lower=0).groupby(days).sum()
+        uv_dates = pd.Series(np.sort(undervoltage_data.date_time.unique()))
+        uv_days = uv_dates.dt.normalize()
+        # consecutive undervoltage datetimes of the same day form an event
+        new_event = (uv_dates.diff() != pd.Timedelta("10 minutes")) | (uv_days != uv_days.shift())
+        events = uv_dates.groupby([uv_days, new_event.cumsum()]).size()
+        features["N_of_uv"] = uv_days.value_counts().reindex(features.index).fillna(0)
+        features["longest_event"] = events.groupby(level=0).max().reindex(features.index).fillna(0)
+        return features[FEATURES]
+
+    def fit(self, voltage_data, undervoltage_data):
+        """Selects kept days and their weights
+
+        Returns:
+        --------
+            weights: pd.Series
+                weight of each kept day
+        """
+        self.features = self.get_daily_features(voltage_data, undervoltage_data)
+        uv_features = self.features[self.features.N_of_uv > 0]
+        longest = uv_features.sort_values("longest_event", ascending=False, kind="stable").index[:self.n_extreme]
+        deepest = uv_features.sort_values("depth", ascending=False, kind="stable").index[:self.n_extreme]
+        largest = uv_features.sort_values("deficit", ascending=False, kind="stable").index[:self.n_extreme]
+        self.extreme_days = longest.union(deepest).union(largest)
+        weights = pd.Series(1., index=self.extreme_days)
+        others = self.features.drop(self.extreme_days)
+        if len(others) > 0:
+            states = others.values.astype(float)
+            std = states.std(axis=0)
+            states = (states - states.mean(axis=0)) / np.where(std > 0, std, 1)
+            n_clusters = min(self.n_representative, len(others))
+            kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=self.random_state)
+            labels = kmeans.fit_predict(states)
+            for cluster, position in get_medoids(states, labels, kmeans.cluster_centers_).items():
+                weights[others.index[position]] = np.sum(labels == cluster)
+        if self.include_next_day:
+            kept_uv_days = weights.index[self.features.N_of_uv.reindex(weights.index) > 0]
+            next_days = (kept_uv_days + pd.Timedelta(days=1)).intersection(self.features.index)
+            for day in next_days.difference(weights.index):
+                weights[day] = 0.
+        self.weights = weights.sort_index()
+        return self.weights
+
+    def transform(self, data):
+        """Returns rows of voltage or undervoltage data on kept days"""
+        return data[data.date_time.dt.normalize().isin(self.weights.index)]
+
+    def get_compression_ratio(self):
+        """Returns share of days that are kept"""
+        return len(self.weights) / len(self.features)
+
+
+def calculate_compression_error(fm, compression):
+    """
+    Compares battery sizing of feeder on compressed data with sizing on full data.
+
+    Slopes of the feeder model are used for both, so the difference comes only from compression.
+    Args:
+    --------
+        fm: FeederModel
+            feeder model with calculated slopes
+        compression: PeriodCompression
+            fitted compression
+    Returns:
+    --------
+        error_df: pd.DataFrame
+            full, compressed and relative error of battery_capacity, battery_power and battery_cycles
+    """
+    results = {}
+    for name in ("full", "compressed"):
+        bm = BatteryModel(fm)
+        bm.voltage_data, bm.undervoltage_data, bm.day_weights = fm.voltage_data, fm.undervoltage_data, None
+        if name == "compressed":
+            bm.voltage_data = compression.transform(fm.voltage_data)
+            bm.undervoltage_data = compression.transform(fm.undervoltage_data)
+            bm.day_weights = compression.weights
+        bm.calculate_battery_characteristics()
+        results[name] = pd.Series({"battery_capacity": bm.battery_capacity,
+                                   "battery_power": bm.battery_power,
+                                   "battery_cycles": bm.battery_cycles})
+    error_df = pd.DataFrame(results)
+    error_df["relative_error"] = (error_df.compressed - error_df.full) / error_df.full.abs()
+    return error_df
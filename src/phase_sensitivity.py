@@ -0,0 +1,121 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pandapower as pp
+
+PHASES = {1: "a", 2: "b", 3: "c"}
+
+# Zero sequence data that runpp_3ph needs and is usually missing in our networks
+EXT_GRID_DEFAULTS = {"s_sc_max_mva": 1000., "rx_max": 0.1, "x0x_max": 1., "r0x0_max": 0.1}
+TRAFO_DEFAULTS = {"vector_group": "Dyn", "mag0_percent": 100., "mag0_rx": 0., "si0_hv_partial": 0.9}
+# zero sequence impedance of LV cables is approximately four times positive sequence impedance
+LINE_ZERO_SEQUENCE_FACTOR = 4.
+
+
+def fill_missing(df, column, values):
+    """Sets values in column of df where they are missing"""
+    if column not in df.columns:
+        df[column] = values
+    else:
+        df[column] = df[column].where(df[column].notna(), values)
+
+
+def create_3ph_snet(snet, res_factor=1., trafo_lv=0.425):
+    """
+    Creates copy of snet for unbalanced powerflow with adjusted line impedances and transformer voltage.
+
+    Missing zero sequence data is filled with defaults, loads are replaced with asymmetric loads:
+    3 phase smms have power split equally between phases, 1 phase smms are connected to phase a,
+    which is measured as u_1. Powers are taken from snet.load, so snet has to be populated.
+    Args:
+    --------
+        snet:
+            network in pandapower format, populated with loads
+        res_factor: float
+            resistance factor for lines
+        trafo_lv: float
+            transformer voltage
+    Returns:
+    --------
+        net3:
+            network for pp.runpp_3ph, net3.load_map holds asymmetric load of each load in snet
+    """
+    net3 = copy.deepcopy(snet)
+    for column, value in EXT_GRID_DEFAULTS.items():
+        fill_missing(net3.ext_grid, column, value)
+    for column, value in TRAFO_DEFAULTS.items():
+        fill_missing(net3.trafo, column, value)
+    fill_missing(net3.trafo, "vk0_percent", net3.trafo.vk_percent)
+    fill_missing(net3.trafo, "vkr0_percent", net3.trafo.vkr_percent)
+    fill_missing(net3.line, "r0_ohm_per_km", net3.line.r_ohm_per_km * LINE_ZERO_SEQUENCE_FACTOR)
+    fill_missing(net3.line, "x0_ohm_per_km", net3.line.x_ohm_per_km * LINE_ZERO_SEQUENCE_FACTOR)
+    fill_missing(net3.line, "c0_nf_per_km", net3.line.c_nf_per_km)
+    for column in ("r_ohm_per_km", "x_ohm_per_km", "r0_ohm_per_km", "x0_ohm_per_km"):
+        net3.line[column] = net3.line[column] * res_factor
+    net3.trafo["vn_lv_kv"] = trafo_lv
+    load_map = {}
+    for load_id, load in snet.load[snet.load.in_service].iterrows():
+        p_mw = load.p_mw * load.scaling
+        q_mvar = load.q_mvar * load.scaling
+        if load.get("phases", 3) == 1:
+            shares = (1., 0., 0.)
+        else:
+            shares = (1 / 3, 1 / 3, 1 / 3)
+        load_map[load_id] = pp.create_asymmetric_load(
+            net3, load.bus,
+            p_a_mw=p_mw * shares[0], p_b_mw=p_mw * shares[1], p_c_mw=p_mw * shares[2],
+            q_a_mvar=q_mvar * shares[0], q_b_mvar=q_mvar * shares[1], q_c_mvar=q_mvar * shares[2])
+    net3.load["in_service"] = False
+    net3["load_map"] = load_map
+    return net3
+
+
+def get_phase_volts(net3, buses):
+    """Returns phase voltages in V at buses, phases 1, 2, 3 as columns"""
+    res = net3.res_bus_3ph.loc[buses]
+    return np.column_stack([res["vm_{}_pu".format(PHASES[phase])].values * 230 for phase in PHASES])
+
+
+def calculate_phase_slopes(snet, battery_smms, res_factor=1., trafo_lv=0.425):
+    """
+    Calculates per phase slopes with unbalanced powerflows for the state currently in snet.
+
+    Phase slope is voltage increase at a phase of each smm when battery power on the same phase
+    is decreased by 1/3 kW, i.e. by its share of 1 kW of 3 phase battery power, so BatteryModel uses
+    phase slopes in the same way as balanced slopes. Unlike balanced slopes they include voltage
+    drop on the neutral conductor and unbalance of loads.
+    One base and three perturbed unbalanced powerflows are run for each battery smm.
+    Args:
+    --------
+        snet:
+            network in pandapower format, populated with loads
+        battery_smms: list
+            smms for which slopes are calculated
+        res_factor: float
+            resistance factor for lines
+        trafo_lv: float
+            transformer voltage
+    Returns:
+    --------
+        phase_slopes: dict
+            phase (1, 2, 3) -> dataframe with battery smms as columns and all smms in snet as index
+    """
+    net3 = create_3ph_snet(snet, res_factor, trafo_lv)
+    loads = snet.load[snet.load.smm.notna()]
+    pp.runpp_3ph(net3)
+    volts_0 = get_phase_volts(net3, loads.bus.values)
+    phase_slopes = {phase: pd.DataFrame(index=loads.smm.values) for phase in PHASES}
+    for battery_smm in battery_smms:
+        asym_loads = [net3.load_map[load_id] for load_id in loads.index[loads.smm == battery_smm]]
+        for phase, name in PHASES.items():
+            column = "p_{}_mw".format(name)
+            p_mw = net3.asymmetric_load.loc[asym_loads, column].copy()
+            net3.asymmetric_load.loc[asym_loads, column] -= 0.001 / 3
+            pp.runpp_3ph(net3)
+            volts_1 = get_phase_volts(net3, loads.bus.values)
+            net3.asymmetric_load.loc[asym_loads, column] = p_mw
+            phase_slopes[phase][str(battery_smm)] = volts_1[:, phase - 1] - volts_0[:, phase - 1]
+    for slopes in phase_slopes.values():
+        slopes.index.name = "smm"
+    return phase_slopes
@@ -0,0 +1,239 @@
+import numpy as np
+import pandas as pd
+import pandapower as pp
+from pandapower.pypower.makeYbus import makeYbus
+from pandapower.pypower.idx_bus import BUS_TYPE, REF, NONE
+from pandapower.pypower.idx_gen import GEN_BUS, VG
+from scipy.sparse.linalg import splu
+
+import config
+
+
+class PowerflowBackend:
+    """Base class for powerflow backends used by run_powerflow.
+    Backend receives snet with already adjusted line impedances and transformer voltage,
+    solves the powerflow and writes bus voltages to snet.res_bus."""
+    name = None
+
+    def run(self, snet):
+        raise NotImplementedError
+
+
+class PandapowerBackend(PowerflowBackend):
+    """Runs pandapower powerflow with given runpp arguments
+
+    Args:
+    --------
+        name: str
+            name of the backend
+        kwargs:
+            arguments passed to pp.runpp, e.g. algorithm and numba
+    """
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.kwargs = kwargs
+
+    def run(self, snet):
+        pp.runpp(snet, **self.kwargs)
+
+
+class CountingBackend(PowerflowBackend):
+    """Wraps another backend and counts powerflows run with it
+
+    Args:
+    --------
+        backend: PowerflowBackend
+            backend that solves the powerflows
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.count = 0
+
+    def run(self, snet):
+        self.count += 1
+        self.backend.run(snet)
+
+
+class CompiledNetwork:
+    """Admittance model of snet, built once and reused for multiple powerflows
+
+    Network is converted to pypower format by one pandapower powerflow, so switches, fused busses
+    and transformer model are the same as in pandapower. Admittance matrix of non-slack busses is
+    factorized once, powerflow is then solved with fixed point current injection iterations,
+    that only need the factorization (implicit Z-bus method).
+    Loads are taken from snet.load at the time of solving, so populate_snet does not require
+    recompilation, while changed line impedances or transformer voltage do.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+    """
+
+    def __init__(self, snet):
+        # pandapower builds the full ppc (with out of service busses) that matches its bus lookup
+        pp.runpp(snet, calculate_voltage_angles=False, numba=False)
+        ppc = snet._ppc
+        self.base_mva = ppc["baseMVA"]
+        self.bus_lookup = snet._pd2ppc_lookups["bus"]
+        self.Ybus, _, _ = makeYbus(self.base_mva, ppc["bus"], ppc["branch"])
+        self.Ybus = self.Ybus.tocsc()
+        bus_types = ppc["bus"][:, BUS_TYPE]
+        self.n_bus = len(bus_types)
+        self.ref = np.where(bus_types == REF)[0]
+        self.pq = np.where((bus_types != REF) & (bus_types != NONE))[0]
+        gen_bus = ppc["gen"][:, GEN_BUS].astype(int)
+        v_ref = pd.Series(ppc["gen"][:, VG], index=gen_bus)
+        self.v_ref = v_ref.loc[self.ref].values.astype(complex)
+        self.Y_pp = self.Ybus[self.pq, :][:, self.pq].tocsc()
+        self.Y_pr = self.Ybus[self.pq, :][:, self.ref]
+        self.lu = splu(self.Y_pp)
+        self.i_ref = self.Y_pr @ self.v_ref
+        # position of each ppc bus among non-slack busses
+        self.pq_position = np.full(self.n_bus, -1)
+        self.pq_position[self.pq] = np.arange(len(self.pq))
+
+    def load_incidence(self, load_buses):
+        """Returns positions of given pandapower busses in non-slack voltage vector"""
+        return self.pq_position[self.bus_lookup[np.asarray(load_buses, dtype=int)]]
+
+    def get_s_pq(self, snet):
+        """Returns complex power injections in p.u. at non-slack busses from snet.load and snet.sgen"""
+        s = np.zeros(len(self.pq), dtype=complex)
+        for element, sign in (("load", -1), ("sgen", 1)):
+            df = snet[element]
+            if len(df) == 0:
+                continue
+            df = df[df.in_service]
+            pos = self.load_incidence(df.bus.values)
+            power = (df.p_mw.values + 1j * df.q_mvar.values) * df.scaling.values
+            valid = pos >= 0
+            np.add.at(s, pos[valid], sign * power[valid] / self.base_mva)
+        return s
+
+    def solve(self, s_pq, v0=None, tolerance_mva=1e-8, max_iteration=50):
+        """Solves powerflow for given power injections at non-slack busses
+        If s_pq has two dimensions, every column is a separate state and all states are solved
+        together with the same factorization.
+        Args:
+        --------
+            s_pq: np.array
+                complex power injections in p.u. at non-slack busses, shape (n_pq,) or (n_pq, n_states)
+            v0: np.array
+                initial voltages at non-slack busses, flat start if None
+            tolerance_mva: float
+                maximal power mismatch in MVA
+            max_iteration: int
+                maximal number of iterations
+        Returns:
+        --------
+            v_pq:
+                complex voltages at non-slack busses, same shape as s_pq
+        """
+        v = np.full(s_pq.shape, self.v_ref[0], dtype=complex) if v0 is None else v0.copy()
+        i_ref = self.i_ref if s_pq.ndim == 1 else self.i_ref[:, None]
+        tol = tolerance_mva / self.base_mva
+        for _ in range(max_iteration):
+            mismatch = v * np.conj(self.Y_pp @ v + i_ref) - s_pq
+            if np.max(np.abs(mismatch)) < tol:
+                return v
+            v = self.lu.solve(np.conj(s_pq / v) - i_ref)
+        raise pp.LoadflowNotConverged("Sparse powerflow did not converge")
+
+    def write_results(self, snet, v_pq):
+        """Writes voltages and bus powers to snet.res_bus, like pandapower does"""
+        v = np.full(self.n_bus, np.nan, dtype=complex)
+        v[self.ref] = self.v_ref
+        v[self.pq] = v_pq
+        s = v * np.conj(self.Ybus @ np.nan_to_num(v)) * self.base_mva
+        lookup = self.bus_lookup[snet.bus.index.values]
+        v_bus = v[lookup]
+        s_bus = s[lookup]
+        snet["res_bus"] = pd.DataFrame(
+            {
+                "vm_pu": np.abs(v_bus),
+                "va_degree": np.angle(v_bus, deg=True),
+                "p_mw": -s_bus.real,
+                "q_mvar": -s_bus.imag
+            },
+            index=snet.bus.index)
+        snet["converged"] = True
+
+
+class SparseDirectBackend(PowerflowBackend):
+    """Powerflow with one sparse LU factorization of the admittance matrix per network state
+    Compiled network is cached and reused while line impedances, transformer voltage and
+    topology do not change, so repeated runs with different loads only cost a few triangular solves."""
+    name = "sparse"
+
+    def __init__(self, tolerance_mva=1e-8, max_iteration=50):
+        self.tolerance_mva = tolerance_mva
+        self.max_iteration = max_iteration
+        self._key = None
+        self._model = None
+
+    def get_model(self, snet):
+        """Returns compiled network for snet, compiles it if snet changed"""
+        key = (id(snet), network_state_hash(snet))
+        if key != self._key:
+            self._model = CompiledNetwork(snet)
+            self._key = key
+        return self._model
+
+    def run(self, snet):
+        model = self.get_model(snet)
+        v_pq = model.solve(model.get_s_pq(snet),
+                           tolerance_mva=self.tolerance_mva,
+                           max_iteration=self.max_iteration)
+        model.write_results(snet, v_pq)
+
+
+def network_state_hash(snet):
+    """Hash of all snet data that changes the admittance matrix, loads are not included"""
+    parts = [
+        snet.bus[["vn_kv", "in_service"]],
+        snet.line[["from_bus", "to_bus", "length_km", "r_ohm_per_km", "x_ohm_per_km",
+                   "c_nf_per_km", "parallel", "in_service"]],
+        snet.trafo[["hv_bus", "lv_bus", "vn_hv_kv", "vn_lv_kv", "tap_pos", "in_service"]],
+        snet.ext_grid[["bus", "vm_pu", "in_service"]],
+        snet.switch[["bus", "element", "et", "closed"]],
+        snet.shunt[["bus", "p_mw", "q_mvar", "vn_kv", "step", "in_service"]],
+    ]
+    return tuple(int(pd.util.hash_pandas_object(df, index=True).sum()) for df in parts)
+
+
+BACKENDS = {
+    # reference implementation, used before backends were introduced
+    "pandapower": PandapowerBackend("pandapower", algorithm="nr", numba=False),
+    "pandapower_numba": PandapowerBackend("pandapower_numba", algorithm="nr", numba=True),
+    # backward/forward sweep, suitable for radial LV feeders
+    "sweep": PandapowerBackend("sweep", algorithm="bfsw", numba=False),
+    "sparse": SparseDirectBackend(),
+}
+
+
+def get_backend(backend=None, stage=None):
+    """Returns powerflow backend
+
+    Args:
+    --------
+        backend: str or PowerflowBackend
+            backend name or instance, if None backend for stage from config is used
+        stage: str
+            name of the calculation stage (e.g. "calibration", "slopes", "timeseries"),
+            used to look up backend in config.POWERFLOW_BACKENDS
+    Returns:
+    --------
+        backend: PowerflowBackend
+    """
+    if backend is None:
+        backend = config.POWERFLOW_BACKENDS.get(stage)
+    if backend is None:
+        backend = config.POWERFLOW_BACKEND
+    if isinstance(backend, PowerflowBackend):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError("Unknown powerflow backend: {}".format(backend))
+    return BACKENDS[backend]
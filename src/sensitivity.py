@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from pandapower.pypower.dSbus_dV import dSbus_dV
+
+from network_manipulation import adjusted_snet
+from powerflow_backends import CompiledNetwork
+
+
+def get_smm_positions(snet, model):
+    """Returns positions of loads with smm among non-slack busses, loads at slack bus get -1"""
+    loads = snet.load[snet.load.smm.notna()]
+    return loads, model.load_incidence(loads.bus.values)
+
+
+def calculate_jacobian(model, v_pq):
+    """Returns powerflow Jacobian of non-slack busses in polar coordinates
+    Rows are active and reactive power injections, columns are voltage angles and magnitudes."""
+    v = np.zeros(model.n_bus, dtype=complex)
+    v[model.ref] = model.v_ref
+    v[model.pq] = v_pq
+    dS_dVm, dS_dVa = dSbus_dV(model.Ybus, v)
+    pq = model.pq
+    dS_dVa = dS_dVa[pq, :][:, pq]
+    dS_dVm = dS_dVm[pq, :][:, pq]
+    return sparse.vstack([
+        sparse.hstack([dS_dVa.real, dS_dVm.real]),
+        sparse.hstack([dS_dVa.imag, dS_dVm.imag])
+    ]).tocsc()
+
+
+def calculate_sensitivities(snet, battery_smms=None, res_factor=1., trafo_lv=0.425):
+    """Calculates voltage sensitivities of all smms to power of battery smms from one powerflow
+
+    Powerflow is solved for loads currently in snet, Jacobian of the converged state is factorized
+    once and sensitivities to all battery smms are obtained with one solve for each of them.
+    Sensitivities have the same meaning as slopes in calculate_slopes: voltage increase in V at each
+    smm when power at battery smm is decreased by 1 kW (or 1 kvar).
+    Args:
+    --------
+        snet:
+            network in pandapower format, populated with loads
+        battery_smms: list
+            smms for which sensitivities are calculated, if None all smms in snet
+        res_factor: float
+            resistance factor for lines
+        trafo_lv: float
+            transformer voltage
+    Returns:
+    --------
+        slopes_p:
+            dataframe with battery smms as columns and all smms in snet as index, V/kW
+        slopes_q:
+            dataframe with battery smms as columns and all smms in snet as index, V/kvar
+    """
+    with adjusted_snet(snet, res_factor, trafo_lv):
+        model = CompiledNetwork(snet)
+    v_pq = model.solve(model.get_s_pq(snet))
+    lu = splu(calculate_jacobian(model, v_pq))
+    loads, positions = get_smm_positions(snet, model)
+    if battery_smms is None:
+        battery_smms = loads.smm.unique()
+    n_pq = len(model.pq)
+    # power decrease of 1 kW at battery smm in p.u. injections, load scaling is taken into account
+    rhs = np.zeros((n_pq, len(battery_smms)))
+    for j, battery_smm in enumerate(battery_smms):
+        battery_loads = loads.smm == battery_smm
+        valid = battery_loads.values & (positions >= 0)
+        np.add.at(rhs[:, j], positions[valid], loads.scaling.values[valid] * 0.001 / model.base_mva)
+    zeros = np.zeros_like(rhs)
+    dvm_p = lu.solve(np.vstack([rhs, zeros]))[n_pq:]
+    dvm_q = lu.solve(np.vstack([zeros, rhs]))[n_pq:]
+    slopes = []
+    for dvm in (dvm_p, dvm_q):
+        values = np.zeros((len(loads), len(battery_smms)))
+        valid = positions >= 0
+        values[valid] = dvm[positions[valid]] * 230
+        df = pd.DataFrame(values, index=loads.smm.values, columns=[str(smm) for smm in battery_smms])
+        df.index.name = "smm"
+        slopes.append(df)
+    return slopes[0], slopes[1]
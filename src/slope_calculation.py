@@ -8,10 +8,13 @@ import pandas as pd
 
 warnings.filterwarnings('ignore')
 from network_manipulation import run_powerflow, set_volts, populate_snet
+from powerflow_backends import get_backend, CountingBackend
+from calibration_cache import data_fingerprint
+from sensitivity import calculate_sensitivities
 from plotting import plot_volts, plot_feeder_volts
 
 
-def get_opt_res_f(snet, min_bus, id_first, state_vol, x0=0.2, t0=0.4):
+def get_opt_res_f(snet, min_bus, id_first, state_vol, x0=0.2, t0=0.4, backend=None):
     """
     Optimizes the resistance factor to match the voltage difference between min_bus and id_first 
     with real data voltage differences.
@@ -30,6 +33,8 @@ def get_opt_res_f(snet, min_bus, id_first, state_vol, x0=0.2, t0=0.4):
             initial guess for the resistance factor
         t0:
             initial guess for the transformer voltage level
+        backend:
+            powerflow backend
     Returns:
     --------
         res.root:
@@ -37,7 +42,7 @@ def get_opt_res_f(snet, min_bus, id_first, state_vol, x0=0.2, t0=0.4):
     """
     trafo_lv = t0
     def get_delta_delta(res_factor):
-        run_powerflow(snet, res_factor=res_factor, trafo_lv=trafo_lv)
+        run_powerflow(snet, res_factor=res_factor, trafo_lv=trafo_lv, backend=backend)
         volts = set_volts(snet, state_vol, warn=False)
         vol_min_bus_pp = volts[volts["bus"] == min_bus].vol_pp.values[0]
         vol_first_pp = volts[volts["bus"] == id_first].vol_pp.values[0]
@@ -51,7 +56,7 @@ def get_opt_res_f(snet, min_bus, id_first, state_vol, x0=0.2, t0=0.4):
 
     return res.root
 
-def get_opt_trafo_lv(snet, res_factor, bus, state_vol, t0=0.4):
+def get_opt_trafo_lv(snet, res_factor, bus, state_vol, t0=0.4, backend=None):
     """
     Optimizes the trafo voltage level to match the simulated voltage at bus with the real data voltage.
 
@@ -67,6 +72,8 @@ def get_opt_trafo_lv(snet, res_factor, bus, state_vol, t0=0.4):
             resistance factor used in the powerflow calculation
         t0:
             initial guess for the transformer voltage level
+        backend:
+            powerflow backend
     Returns:
     --------
         opt_trafo_lv.root:
@@ -74,7 +81,7 @@ def get_opt_trafo_lv(snet, res_factor, bus, state_vol, t0=0.4):
     """
     trafo_lv = t0
     def calculate_volts_diff_first_smm(trafo_lv):
-        run_powerflow(snet, res_factor=res_factor, trafo_lv=trafo_lv)
+        run_powerflow(snet, res_factor=res_factor, trafo_lv=trafo_lv, backend=backend)
         volts = set_volts(snet, state_vol, warn=False)
         difference = volts[volts["bus"] == bus]["vol_real"].values[0] - \
             volts[volts["bus"] == bus]["vol_pp"].values[0]
@@ -96,7 +103,7 @@ def is_id_suitable(id, snet, volts):
     return len(row) > 0 and phases == 3
 
 
-def find_id_first(snet, state_vol, min_bus):
+def find_id_first(snet, state_vol, min_bus, backend=None):
     """
     Finds the first suitable bus in the path from the transformer to the min bus.
 
@@ -108,6 +115,8 @@ def find_id_first(snet, state_vol, min_bus):
             dictionary of measured voltages
         min_bus:
             bus with the minimum voltage, or last bus in the feeder
+        backend:
+            powerflow backend
     Returns:
     --------
         id_first:
@@ -115,7 +124,7 @@ def find_id_first(snet, state_vol, min_bus):
     """
     id_first_found = False
     i = 0
-    run_powerflow(snet, res_factor=0.3, trafo_lv=0.425)
+    run_powerflow(snet, res_factor=0.3, trafo_lv=0.425, backend=backend)
     volts = set_volts(snet, state_vol, warn=False)
     min_bus = list(volts.bus)[0]
     tr = snet.bus[snet.bus["aclass_id"] == "TR"]
@@ -179,7 +188,7 @@ def calculate_difference_sum(volts, smm_list):
     volts_feeder = volts.loc[volts["smm"].isin(smm_list)]
     return (volts_feeder.vol_pp - volts_feeder.vol_real).abs().mean()
 
-def get_opt_res_f(snet, state_vol, smms_feeder, x0=1., t0=0.425):
+def get_opt_res_f(snet, state_vol, smms_feeder, x0=1., t0=0.425, backend=None):
     """
     Optimizes the resistance factor to minimize the difference between real and simulated voltages for all smms in the feeder.
 
@@ -195,6 +204,8 @@ def get_opt_res_f(snet, state_vol, smms_feeder, x0=1., t0=0.425):
             initial guess for the resistance factor
         t0:
             initial guess for the transformer voltage level
+        backend:
+            powerflow backend
     Returns:
     --------
         res.x[0]:
@@ -202,7 +213,7 @@ def get_opt_res_f(snet, state_vol, smms_feeder, x0=1., t0=0.425):
     """
     def get_difference_sum_res_f(res_f):
 
-        run_powerflow(snet, res_f[0], t0)
+        run_powerflow(snet, res_f[0], t0, backend=backend)
 
         volts = set_volts(snet, state_vol, warn = False)
         return calculate_difference_sum(volts, smms_feeder)
@@ -217,7 +228,8 @@ def calibrate_snet(snet,
                    plot=False,
                    x0=1.,
                    t0=0.425,
-                   calculate_res_f=True):
+                   calculate_res_f=True,
+                   backend=None):
     """
     Calculates the optimal resistance factor and transformer voltage level for the network.
 
@@ -237,6 +249,8 @@ def calibrate_snet(snet,
             initial guess for the transformer voltage level
         calculate_res_f:
             if True, calculates the resistance factor, otherwise uses x0
+        backend:
+            powerflow backend, if None backend for "calibration" stage from config is used
     Returns:
     --------
         opt_trafo_lv:
@@ -244,14 +258,15 @@ def calibrate_snet(snet,
         opt_res_f:
             optimal resistance factor
     """
+    backend = get_backend(backend, stage="calibration")
     if plot:
-        run_powerflow(snet, res_factor=x0, trafo_lv=opt_trafo_lv)
+        run_powerflow(snet, res_factor=x0, trafo_lv=opt_trafo_lv, backend=backend)
         volts = set_volts(snet, state_vol, warn=False)
         plot_feeder_volts(volts, smms_feeder, title="Before calibration")
-    run_powerflow(snet, res_factor=x0, trafo_lv=t0)
+    run_powerflow(snet, res_factor=x0, trafo_lv=t0, backend=backend)
     volts = set_volts(snet, state_vol, warn=False)
     min_bus = find_min_bus(snet, state_vol, volts)
-    id_first = find_id_first(snet, state_vol, min_bus)
+    id_first = find_id_first(snet, state_vol, min_bus, backend=backend)
     if calculate_res_f == True and len(smms_feeder) > 2:
         try:
             #Calculate res_f using min_bus and id_first
@@ -260,7 +275,8 @@ def calibrate_snet(snet,
                                       id_first,
                                       state_vol,
                                       x0=x0,
-                                      t0=t0)
+                                      t0=t0,
+                                      backend=backend)
         except:
             opt_res_f = 1.
 
@@ -268,18 +284,19 @@ def calibrate_snet(snet,
             #If we get weird results, try to calibrate res_f using all smms in feeder
             try:
 
-                opt_res_f = get_opt_res_f(snet, state_vol, smms_feeder, x0, t0)
+                opt_res_f = get_opt_res_f(snet, state_vol, smms_feeder, x0, t0,
+                                          backend=backend)
             except:
                 opt_res_f = 1.
             if plot:
-                run_powerflow(snet, res_factor=opt_res_f, trafo_lv=t0)
+                run_powerflow(snet, res_factor=opt_res_f, trafo_lv=t0, backend=backend)
                 volts = set_volts(snet, state_vol, warn=False)
                 plot_feeder_volts(volts,
                                   smms_feeder,
                                   title="After res_f calibration")
         else:
             if plot:
-                run_powerflow(snet, res_factor=opt_res_f, trafo_lv=t0)
+                run_powerflow(snet, res_factor=opt_res_f, trafo_lv=t0, backend=backend)
                 volts = set_volts(snet, state_vol, warn=False)
                 plot_feeder_volts(volts,
                                   smms_feeder,
@@ -291,12 +308,12 @@ def calibrate_snet(snet,
     try:
 
         opt_trafo_lv = get_opt_trafo_lv(snet, opt_res_f, min_bus, state_vol,
-                                        t0)
+                                        t0, backend=backend)
     except:
         opt_trafo_lv = t0
         print("Trafo_lv optimization failed")
     if plot:
-        run_powerflow(snet, res_factor=opt_res_f, trafo_lv=opt_trafo_lv)
+        run_powerflow(snet, res_factor=opt_res_f, trafo_lv=opt_trafo_lv, backend=backend)
         volts = set_volts(snet, state_vol, warn=False)
         plot_feeder_volts(volts,
                           smms_feeder,
@@ -304,6 +321,308 @@ def calibrate_snet(snet,
     return opt_trafo_lv, opt_res_f
 
 
+def select_dates(dates, N_of_dates=4):
+    """Selects N_of_dates evenly spaced dates from dates, first and last dates are not used"""
+    dates_index = np.arange(
+        len(dates) // (N_of_dates + 1), len(dates),
+        len(dates) // (N_of_dates + 1))[:-1]
+    return [dates[i] for i in dates_index]
+
+
+def get_calibration_volts(snet, state_vol, smms_feeder):
+    """Returns simulated and measured voltages of smms in feeder, that are suitable for calibration"""
+    volts = set_volts(snet, state_vol, warn=False, sort=False)
+    volts = volts[volts.smm.isin(smms_feeder) & volts.vol_real.notna()]
+    if "phases" in snet.load.columns:
+        volts = volts[snet.load.loc[volts.index, "phases"] == 3]
+    return volts.drop_duplicates("bus")
+
+
+def calibrate_snet_joint(snet,
+                         state_vol,
+                         smms_feeder,
+                         x0=1.,
+                         t0=0.425,
+                         calculate_res_f=True,
+                         backend=None,
+                         xtol=0.00002,
+                         max_iteration=20,
+                         res_f_limits=(0.7, 1.3)):
+    """
+    Calculates resistance factor and transformer voltage level together with Gauss-Newton iterations.
+
+    Both parameters minimize squared differences between simulated and measured voltages of 3 phase
+    smms in the feeder. Each iteration needs one powerflow, derivatives are linearized from its results:
+    voltages are proportional to transformer voltage (dV/dtrafo_lv = V/trafo_lv) and voltage drops
+    from transformer busbar are proportional to line impedances (dV/dres_f = -(V_tr - V)/res_f).
+    Starting from the solution of a similar state (warm start), few iterations are needed.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        state_vol:
+            dictionary of measured voltages
+        smms_feeder:
+            list of smms in the feeder
+        x0:
+            initial guess for the resistance factor
+        t0:
+            initial guess for the transformer voltage level
+        calculate_res_f:
+            if True, calculates the resistance factor, otherwise uses x0
+        backend:
+            powerflow backend, if None backend for "calibration" stage from config is used
+        xtol:
+            iterations stop when changes of trafo_lv and res_f are smaller than xtol
+        max_iteration:
+            maximal number of iterations
+        res_f_limits:
+            resistance factor is kept within these limits
+    Returns:
+    --------
+        opt_trafo_lv:
+            optimal transformer voltage level
+        opt_res_f:
+            optimal resistance factor
+        info:
+            dictionary with number of iterations, number of powerflows, converged flag (False if
+            max_iteration was reached) and rms voltage error in p.u. before the last step
+    """
+    backend = get_backend(backend, stage="calibration")
+    tr_bus = snet.bus[snet.bus["aclass_id"] == "TR"].index[0]
+    res_f, trafo_lv = x0, t0
+    fit_res_f = calculate_res_f and len(smms_feeder) > 2
+    n_powerflows = 0
+    for iteration in range(1, max_iteration + 1):
+        run_powerflow(snet, res_factor=res_f, trafo_lv=trafo_lv, backend=backend)
+        n_powerflows += 1
+        volts = get_calibration_volts(snet, state_vol, smms_feeder)
+        if len(volts) == 0:
+            raise ValueError("No measured voltages for calibration")
+        residual = (volts.vol_pp - volts.vol_real).values
+        jacobian = [volts.vol_pp.values / trafo_lv]
+        if fit_res_f:
+            vol_tr = snet.res_bus.vm_pu.loc[tr_bus]
+            jacobian.append(-(vol_tr - volts.vol_pp.values) / res_f)
+        step = np.linalg.lstsq(np.column_stack(jacobian), -residual, rcond=None)[0]
+        trafo_lv += step[0]
+        res_f_step = 0.
+        if fit_res_f:
+            res_f_new = float(np.clip(res_f + step[1], *res_f_limits))
+            res_f_step, res_f = res_f_new - res_f, res_f_new
+        converged = bool(abs(step[0]) < xtol and abs(res_f_step) < xtol)
+        if converged:
+            break
+    if not converged:
+        print("Calibration did not converge in", max_iteration, "iterations")
+    info = {
+        "iterations": iteration,
+        "powerflows": n_powerflows,
+        "converged": converged,
+        "rms_error_before_last_step": float(np.sqrt(np.mean(residual**2)))
+    }
+    return trafo_lv, res_f, info
+
+
+def calibrate_snet_multi_date(snet,
+                              dates,
+                              smms_feeder,
+                              df_p,
+                              df_q,
+                              df_vol,
+                              x0=1.,
+                              t0=0.425,
+                              backend=None,
+                              xtol=0.00002,
+                              max_iteration=20,
+                              res_f_limits=(0.7, 1.3)):
+    """
+    Calculates one resistance factor for all dates and transformer voltage level for each date.
+
+    Line resistances do not change between dates, so residuals (simulated - measured voltages of
+    3 phase smms in the feeder) of all dates are stacked into one least-squares problem with
+    parameters [res_f, trafo_lv_1, ..., trafo_lv_n]. It is solved with Gauss-Newton iterations,
+    derivatives are linearized like in calibrate_snet_joint. Each iteration needs one powerflow per date.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        dates:
+            list of dates used for calibration
+        smms_feeder:
+            list of smms in the feeder
+        df_p:
+            dataframe with average power for all smms
+        df_q:
+            dataframe with average reactive power for all smms
+        df_vol:
+            dataframe with average voltage for all smms
+        x0:
+            initial guess for the resistance factor
+        t0:
+            initial guess for the transformer voltage levels
+        backend:
+            powerflow backend, if None backend for "calibration" stage from config is used
+        xtol:
+            iterations stop when changes of all trafo_lv and of res_f are smaller than xtol
+        max_iteration:
+            maximal number of iterations
+        res_f_limits:
+            resistance factor is kept within these limits
+    Returns:
+    --------
+        opt_trafo_lvs:
+            series with optimal transformer voltage level for each date
+        opt_res_f:
+            optimal resistance factor
+        info:
+            dictionary with number of iterations, number of powerflows, converged flag (False if
+            max_iteration was reached) and rms voltage error in p.u. before the last step
+    """
+    backend = get_backend(backend, stage="calibration")
+    tr_bus = snet.bus[snet.bus["aclass_id"] == "TR"].index[0]
+    n_dates = len(dates)
+    res_f = x0
+    trafo_lvs = np.full(n_dates, t0, dtype=float)
+    fit_res_f = len(smms_feeder) > 2
+    n_powerflows = 0
+    for iteration in range(1, max_iteration + 1):
+        residuals = []
+        jacobians = []
+        for i, date in enumerate(dates):
+            populate_snet(snet, df_p.loc[date], df_q.loc[date], warn=False)
+            run_powerflow(snet, res_factor=res_f, trafo_lv=trafo_lvs[i], backend=backend)
+            n_powerflows += 1
+            volts = get_calibration_volts(snet, df_vol.loc[date], smms_feeder)
+            vol_pp = volts.vol_pp.values
+            residuals.append(vol_pp - volts.vol_real.values)
+            jacobian = np.zeros((len(volts), n_dates + 1))
+            jacobian[:, i] = vol_pp / trafo_lvs[i]
+            jacobian[:, n_dates] = -(snet.res_bus.vm_pu.loc[tr_bus] - vol_pp) / res_f
+            jacobians.append(jacobian)
+        residual = np.concatenate(residuals)
+        if len(residual) == 0:
+            raise ValueError("No measured voltages for calibration")
+        jacobian = np.vstack(jacobians)
+        if not fit_res_f:
+            jacobian = jacobian[:, :n_dates]
+        step = np.linalg.lstsq(jacobian, -residual, rcond=None)[0]
+        trafo_lvs += step[:n_dates]
+        res_f_step = 0.
+        if fit_res_f:
+            res_f_new = float(np.clip(res_f + step[n_dates], *res_f_limits))
+            res_f_step, res_f = res_f_new - res_f, res_f_new
+        converged = bool(np.max(np.abs(step[:n_dates])) < xtol and abs(res_f_step) < xtol)
+        if converged:
+            break
+    if not converged:
+        print("Multi-date calibration did not converge in", max_iteration, "iterations")
+    info = {
+        "iterations": iteration,
+        "powerflows": n_powerflows,
+        "converged": converged,
+        "rms_error_before_last_step": float(np.sqrt(np.mean(residual**2)))
+    }
+    return pd.Series(trafo_lvs, index=dates), res_f, info
+
+
+def calibrate_dates(snet,
+                    dates,
+                    smms_feeder,
+                    df_p,
+                    df_q,
+                    df_vol,
+                    calibrate=True,
+                    plot=False,
+                    backend=None,
+                    method="secant",
+                    calibration_info=None,
+                    calibration_cache=None,
+                    x0=1.,
+                    t0=0.425):
+    """
+    Calibrates snet for each of the dates.
+
+    Methods "secant" and "gauss_newton" calibrate dates one by one (gauss_newton warm starts from the
+    previous date, the first date from x0 and t0), "multi_date" fits one resistance factor for all
+    dates with calibrate_snet_multi_date.
+    If calibration_cache is given, cached dates are not calibrated again and new results are stored
+    in the cache together with bus results of the calibrated state and name of the backend that
+    calculated them.
+    Returns:
+    --------
+        calibration: dict
+            date -> (trafo_lv, res_f)
+    """
+    cache_method = method if calibrate else None
+    calibration = {}
+    if calibration_cache is not None:
+        for date in dates:
+            entry = calibration_cache.get(snet, date, smms_feeder, data_fingerprint(date, df_p, df_q, df_vol),
+                                          cache_method)
+            if entry is not None:
+                calibration[date] = (entry["trafo_lv"], entry["res_f"])
+    missing = [date for date in dates if date not in calibration]
+    if len(missing) == 0:
+        return calibration
+    if calibrate and method == "multi_date":
+        # res_factor depends on all dates, so they are calibrated together
+        missing = list(dates)
+        try:
+            trafo_lvs, res_f, info = calibrate_snet_multi_date(snet, missing, smms_feeder, df_p, df_q,
+                                                               df_vol, backend=backend)
+            if calibration_info is not None:
+                calibration_info.append(info)
+            calibration.update({date: (trafo_lvs[date], res_f) for date in missing})
+        except:
+            calibration.update({date: (0.425, 1.) for date in missing})
+    else:
+        opt_trafo_lv, res_f = t0, x0
+        for date in missing:
+            populate_snet(snet, df_p.loc[date], df_q.loc[date], warn=False)
+            opt_trafo_lv, res_f = calibrate_state(snet, df_vol.loc[date], smms_feeder, calibrate, plot,
+                                                  backend, method, x0=res_f, t0=opt_trafo_lv,
+                                                  calibration_info=calibration_info)
+            calibration[date] = (opt_trafo_lv, res_f)
+    if calibration_cache is not None:
+        backend = get_backend(backend, stage="calibration")
+        for date in missing:
+            opt_trafo_lv, res_f = calibration[date]
+            populate_snet(snet, df_p.loc[date], df_q.loc[date], warn=False)
+            run_powerflow(snet, res_factor=res_f, trafo_lv=opt_trafo_lv, backend=backend)
+            calibration_cache.set(snet, date, smms_feeder, opt_trafo_lv, res_f, snet.res_bus,
+                                  data_fingerprint(date, df_p, df_q, df_vol), cache_method, backend.name)
+    return {date: calibration[date] for date in dates}
+
+
+def calibrate_state(snet,
+                    state_vol,
+                    smms_feeder,
+                    calibrate=True,
+                    plot=False,
+                    backend=None,
+                    method="secant",
+                    x0=1.,
+                    t0=0.425,
+                    calibration_info=None):
+    """Calibrates snet populated with one state, returns default values if calibration fails or is not wanted
+
+    method "secant" uses calibrate_snet, "gauss_newton" uses calibrate_snet_joint starting from x0 and t0.
+    If calibration_info is a list, dictionary with iteration and powerflow counts of joint calibration is appended."""
+    if not calibrate:
+        return 0.425, 1.
+    try:
+        if method == "gauss_newton":
+            opt_trafo_lv, res_f, info = calibrate_snet_joint(snet, state_vol, smms_feeder, x0=x0, t0=t0,
+                                                             backend=backend)
+            if calibration_info is not None:
+                calibration_info.append(info)
+            return opt_trafo_lv, res_f
+        return calibrate_snet(snet, state_vol, smms_feeder, x0=1., t0=0.425, plot=plot, backend=backend)
+    except:
+        return 0.425, 1.
+
+
 def calculate_slopes(snet,
                      battery_smms,
                      dates,
@@ -313,7 +632,14 @@ def calculate_slopes(snet,
                      df_vol,
                      calibrate=True,
                      N_of_dates=4,
-                     plot=False):
+                     plot=False,
+                     backend=None,
+                     calibration_backend=None,
+                     method="finite_difference",
+                     calibration_method="secant",
+                     calibration_info=None,
+                     calibration_cache=None,
+                     date_slopes=None):
     """
     Calculates difference of voltage, when power is decreased by 1 kW at smms at battery_smms.
 
@@ -342,6 +668,24 @@ def calculate_slopes(snet,
             number of dates used for calculation of slopes
         plot:
             if True, plots calibration process
+        backend:
+            powerflow backend for slope calculation, if None backend for "slopes" stage from config is used
+        calibration_backend:
+            powerflow backend for calibration, if None backend for "calibration" stage from config is used
+        method:
+            "finite_difference" runs two powerflows for every battery smm and date,
+            "jacobian" gets slopes of all battery smms from one Jacobian factorization per date
+        calibration_method:
+            "secant" (calibrate_snet), "gauss_newton" (calibrate_snet_joint, warm started from previous date)
+            or "multi_date" (calibrate_snet_multi_date, one res_factor for all dates)
+        calibration_info:
+            list, to which iteration and powerflow counts of joint calibration are appended
+        calibration_cache:
+            CalibrationCache with calibrations and base case results, shared between battery
+            candidates and runs, entries are per feeder (smms_feeder)
+        date_slopes:
+            list, to which slopes of every date (dataframes like slopes_smms) are appended, spread of
+            slopes over dates is their uncertainty
     Returns:
     --------
         slopes_smms:
@@ -349,15 +693,24 @@ def calculate_slopes(snet,
     """
 
     # choose dates for calibration and slope calculation
-    dates_cal_index = np.arange(
-        len(dates) // (N_of_dates + 1), len(dates),
-        len(dates) // (N_of_dates + 1))[:-1]
-    dates_cal = [dates[i] for i in dates_cal_index]
+    dates_cal = select_dates(dates, N_of_dates)
+    if method not in ("finite_difference", "jacobian"):
+        raise ValueError("Unknown slope method: {}".format(method))
+    # calibration does not depend on battery smm, so every date is calibrated once
+    calibration = calibrate_dates(snet, dates_cal, smms_feeder, df_p, df_q, df_vol, calibrate, plot,
+                                  calibration_backend, calibration_method, calibration_info,
+                                  calibration_cache)
+    if method == "jacobian":
+        return calculate_slopes_jacobian(snet, battery_smms, dates_cal, df_p, df_q, calibration,
+                                         date_slopes)
+    backend = get_backend(backend, stage="slopes")
     slopes_smms = pd.DataFrame()
+    slopes_dates = [pd.DataFrame() for _ in dates_cal]
     for battery_smm in battery_smms:
         # in slope df we save slopes for different dates for one battery smm
         slope_df = pd.DataFrame()
-        slope_df["smm"] = snet.load.smm
+        # aggregated loads (without smm) are not included
+        slope_df["smm"] = snet.load.smm.dropna()
         for i in range(len(dates_cal)):
             date = dates_cal[i]
             # try:
@@ -369,27 +722,23 @@ def calculate_slopes(snet,
             state_vol = df_vol.loc[date]
             state_q = df_q.loc[date]
             populate_snet(snet, state_p, state_q, warn=False)
-            # calibration
-            if calibrate:
-                try:
-                    opt_trafo_lv, res_f = calibrate_snet(snet,
-                                                     state_vol,
-                                                     smms_feeder,
-                                                     x0=1.,
-                                                     t0=0.425,
-                                                     plot=plot)
-                except:
-                    opt_trafo_lv = 0.425
-                    res_f = 1.
+            opt_trafo_lv, res_f = calibration[date]
+            entry = None
+            if calibration_cache is not None:
+                entry = calibration_cache.get(snet, date, smms_feeder,
+                                              data_fingerprint(date, df_p, df_q, df_vol),
+                                              calibration_method if calibrate else None)
+            if entry is not None and entry["res_bus"] is not None and entry.get("backend") == backend.name:
+                # base case results of calibrated state are already known, from the same backend as the
+                # perturbed powerflow, so slopes do not include difference between backends
+                snet["res_bus"] = entry["res_bus"].copy()
             else:
-                opt_trafo_lv = 0.425
-                res_f = 1.
-            run_powerflow(snet, res_factor=res_f, trafo_lv=opt_trafo_lv)
+                run_powerflow(snet, res_factor=res_f, trafo_lv=opt_trafo_lv, backend=backend)
             # saving initial voltages, simulated with measured power data
             volts_0 = set_volts(snet, state_vol, warn=False)
             # decreasing power by 1 kW at battery smm
             snet.load.loc[snet.load.smm == battery_smm, 'p_mw'] -= 0.001
-            run_powerflow(snet, res_factor=res_f, trafo_lv=opt_trafo_lv)
+            run_powerflow(snet, res_factor=res_f, trafo_lv=opt_trafo_lv, backend=backend)
             # saving simulated voltages after power decrease
             volts_1 = set_volts(snet, state_vol, warn=False)
             # calculating difference of voltage
@@ -410,9 +759,235 @@ def calculate_slopes(snet,
                     vol_slope = np.nan
                     slope_df.loc[slope_df.smm == slope_smm,
                                  "slope" + str(i)] = vol_slope
+        for i in range(len(dates_cal)):
+            slopes_dates[i][str(battery_smm)] = slope_df["slope" + str(i)].values
         # populating slopes_smms with average slopes for battery smm
         slopes_smms[str(battery_smm)] = sum(
             slope_df["slope" + str(i)]
             for i in range(len(dates_cal))) / len(dates_cal)
     slopes_smms.index = slope_df.smm
+    if date_slopes is not None:
+        for slopes_date in slopes_dates:
+            slopes_date.index = slope_df.smm
+        date_slopes.extend(slopes_dates)
     return slopes_smms
+
+
+def calculate_slopes_jacobian(snet, battery_smms, dates_cal, df_p, df_q, calibration, date_slopes=None):
+    """
+    Calculates slopes of battery_smms from analytic voltage sensitivities instead of finite differences.
+
+    For every date snet is populated with calibrated parameters, then slopes of all battery smms are
+    obtained from the Jacobian of one powerflow (see sensitivity.calculate_sensitivities).
+    Slopes are averaged over dates, like in calculate_slopes.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        battery_smms:
+            list of smms for which the slope is calculated, if None all smms in snet
+        dates_cal:
+            dates used for slope calculation
+        df_p:
+            dataframe with average power for all smms
+        df_q:
+            dataframe with average reactive power for all smms
+        calibration: dict
+            date -> (trafo_lv, res_f), see calibrate_dates
+        date_slopes: list
+            list, to which slopes of every date are appended
+    Returns:
+    --------
+        slopes_smms:
+            dataframe with battery smms as columns and all smms in snet as index
+    """
+    slopes = []
+    for date in dates_cal:
+        populate_snet(snet, df_p.loc[date], df_q.loc[date], warn=False)
+        opt_trafo_lv, res_f = calibration[date]
+        slopes_p, _ = calculate_sensitivities(snet, battery_smms, res_factor=res_f, trafo_lv=opt_trafo_lv)
+        slopes.append(slopes_p)
+    if date_slopes is not None:
+        date_slopes.extend(slopes)
+    return sum(slopes) / len(slopes)
+
+
+def order_dates_by_diversity(dates, smms_feeder, df_p, df_q):
+    """
+    Orders dates so that each next date has the most different load state from already chosen dates.
+
+    States are active and reactive powers of feeder smms, standardized for each smm. First date is the
+    one closest to the average state, next dates are chosen by farthest point sampling.
+    Returns:
+    --------
+        ordered_dates: list
+            dates ordered by diversity of load states
+    """
+    columns = [smm for smm in smms_feeder if smm in df_p.columns]
+    states = np.hstack([df_p.loc[dates, columns].values, df_q.loc[dates, columns].values]).astype(float)
+    std = np.nanstd(states, axis=0)
+    states = (states - np.nanmean(states, axis=0)) / np.where(std > 0, std, 1)
+    states = np.nan_to_num(states)
+    order = [int(np.argmin(np.linalg.norm(states, axis=1)))]
+    min_distance = np.linalg.norm(states - states[order[0]], axis=1)
+    for _ in range(len(dates) - 1):
+        i = int(np.argmax(min_distance))
+        order.append(i)
+        min_distance = np.minimum(min_distance, np.linalg.norm(states - states[i], axis=1))
+    return [dates[i] for i in order]
+
+
+def calculate_date_slopes(snet, battery_smms, date, df_p, df_q, calibration, method="finite_difference",
+                          backend=None):
+    """
+    Calculates slopes of battery_smms for one date with calibrated parameters.
+
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        battery_smms:
+            list of smms for which the slope is calculated
+        date:
+            date of the load state
+        df_p:
+            dataframe with average power for all smms
+        df_q:
+            dataframe with average reactive power for all smms
+        calibration: tuple
+            calibrated (trafo_lv, res_f)
+        method:
+            "finite_difference" or "jacobian"
+        backend:
+            powerflow backend for finite differences
+    Returns:
+    --------
+        slopes:
+            dataframe with battery smms as columns and all smms in snet as index
+    """
+    populate_snet(snet, df_p.loc[date], df_q.loc[date], warn=False)
+    opt_trafo_lv, res_f = calibration
+    if method == "jacobian":
+        slopes, _ = calculate_sensitivities(snet, battery_smms, res_factor=res_f, trafo_lv=opt_trafo_lv)
+        return slopes
+    loads = snet.load[snet.load.smm.notna()]
+    run_powerflow(snet, res_factor=res_f, trafo_lv=opt_trafo_lv, backend=backend)
+    vol_0 = snet.res_bus.vm_pu.loc[loads.bus].values
+    slopes = pd.DataFrame(index=loads.smm.values)
+    for battery_smm in battery_smms:
+        p_mw = snet.load.p_mw.copy()
+        snet.load.loc[snet.load.smm == battery_smm, 'p_mw'] -= 0.001
+        run_powerflow(snet, res_factor=res_f, trafo_lv=opt_trafo_lv, backend=backend)
+        slopes[str(battery_smm)] = (snet.res_bus.vm_pu.loc[loads.bus].values - vol_0) * 230
+        snet.load["p_mw"] = p_mw
+    slopes.index.name = "smm"
+    return slopes
+
+
+def calculate_slopes_adaptive(snet,
+                              battery_smms,
+                              dates,
+                              smms_feeder,
+                              df_p,
+                              df_q,
+                              df_vol,
+                              calibrate=True,
+                              tol=0.02,
+                              min_dates=3,
+                              max_powerflows=200,
+                              method="finite_difference",
+                              backend=None,
+                              calibration_backend=None,
+                              calibration_method="secant",
+                              calibration_info=None,
+                              calibration_cache=None):
+    """
+    Calculates slopes with adaptive number of dates.
+
+    Dates are added in order of load state diversity (order_dates_by_diversity). After each date the
+    relative standard error of the average slope is calculated for every smm, dates are added until
+    it is below tol for all smms with slopes of feeder smms, or until next date would exceed
+    max_powerflows powerflows (calibration included). Powerflows of a date are estimated as the
+    average over previous dates, the first date is always used.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        battery_smms:
+            list of smms for which the slope is calculated
+        dates:
+            list of dates suitable for calculation of slopes
+        smms_feeder
+            list of all smms in the feeder
+        df_p:
+            dataframe with average power for all smms
+        df_q:
+            dataframe with average reactive power for all smms
+        df_vol:
+            dataframe with average voltage for all smms
+        calibrate:
+            if True, calibrates the network before calculating slopes
+        tol:
+            required relative standard error of slopes
+        min_dates:
+            minimal number of dates
+        max_powerflows:
+            powerflow budget
+        method:
+            "finite_difference" or "jacobian"
+        backend:
+            powerflow backend for slope calculation
+        calibration_backend:
+            powerflow backend for calibration
+        calibration_method:
+            see calculate_slopes, with "multi_date" res_factor is fitted for each added date separately
+        calibration_info:
+            list, to which iteration and powerflow counts of joint calibration are appended
+        calibration_cache:
+            CalibrationCache shared between battery candidates and runs
+    Returns:
+    --------
+        slopes_smms:
+            dataframe with average slopes, battery smms as columns and all smms in snet as index
+        confidence:
+            dataframe with relative standard error of average slopes in the same shape as slopes_smms,
+            number of used dates and powerflows are in confidence.attrs
+    """
+    if len(dates) == 0:
+        raise ValueError("No dates for slope calculation")
+    backend = CountingBackend(get_backend(backend, stage="slopes"))
+    calibration_backend = CountingBackend(get_backend(calibration_backend, stage="calibration"))
+    n_compiled = 0
+    n_powerflows = 0
+    slopes = []
+    # calibration of each added date warm starts from the previous date, as in calibrate_dates
+    opt_trafo_lv, res_f = 0.425, 1.
+    for date in order_dates_by_diversity(list(dates), smms_feeder, df_p, df_q):
+        if slopes and n_powerflows + n_powerflows / len(slopes) > max_powerflows:
+            break
+        calibration = calibrate_dates(snet, [date], smms_feeder, df_p, df_q, df_vol, calibrate,
+                                      backend=calibration_backend, method=calibration_method,
+                                      calibration_info=calibration_info,
+                                      calibration_cache=calibration_cache, x0=res_f, t0=opt_trafo_lv)
+        opt_trafo_lv, res_f = calibration[date]
+        slopes.append(calculate_date_slopes(snet, battery_smms, date, df_p, df_q, calibration[date],
+                                            method, backend))
+        if method == "jacobian":
+            n_compiled += 1
+        n_powerflows = backend.count + calibration_backend.count + n_compiled
+        stacked = np.stack([df.values for df in slopes])
+        mean = stacked.mean(axis=0)
+        if len(slopes) > 1:
+            std_error = stacked.std(axis=0, ddof=1) / np.sqrt(len(slopes))
+        else:
+            std_error = np.full(mean.shape, np.inf)
+        relative_error = std_error / np.where(np.abs(mean) > 0, np.abs(mean), np.nan)
+        feeder_rows = np.isin(slopes[0].index, smms_feeder)
+        converged = np.nanmax(relative_error[feeder_rows]) < tol
+        if len(slopes) >= min_dates and converged:
+            break
+    slopes_smms = pd.DataFrame(mean, index=slopes[0].index, columns=slopes[0].columns)
+    confidence = pd.DataFrame(relative_error, index=slopes[0].index, columns=slopes[0].columns)
+    confidence.attrs["N_of_dates"] = len(slopes)
+    confidence.attrs["N_of_powerflows"] = n_powerflows
+    return slopes_smms, confidence
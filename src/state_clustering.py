@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+
+
+def get_medoids(states, labels, centers):
+    """Returns position of the state closest to the centre of each cluster, empty clusters (KMeans
+    leaves them if there are fewer distinct states than clusters) are skipped
+
+    Args:
+    --------
+        states: np.array
+            states (n_states x n_features)
+        labels: np.array
+            cluster of each state
+        centers: np.array
+            cluster centres (n_clusters x n_features)
+    Returns:
+    --------
+        medoids: dict
+            cluster -> position of medoid in states
+    """
+    medoids = {}
+    for cluster, centre in enumerate(centers):
+        members = np.where(labels == cluster)[0]
+        if len(members) == 0:
+            continue
+        distance = np.linalg.norm(states[members] - centre, axis=1)
+        medoids[cluster] = members[np.argmin(distance)]
+    return medoids
+
+
+class StateClustering:
+    """Clustering of feeder load states into representative operating states
+
+    States are active and reactive powers of feeder smms, standardized for each smm. States are
+    clustered with KMeans, each cluster is represented by the date with state closest to the
+    cluster centre (medoid), on which slopes are calculated.
+    Args:
+    --------
+        smms: list
+            smms of the feeder
+        n_clusters: int
+            number of clusters
+        random_state: int
+            seed of KMeans
+    """
+
+    def __init__(self, smms, n_clusters=4, random_state=0):
+        self.smms = list(smms)
+        self.n_clusters = n_clusters
+        self.random_state = random_state
+        self.kmeans = None
+        self.mean = None
+        self.std = None
+        self.labels = None
+        self.medoids = None
+
+    def get_states(self, dates, df_p, df_q):
+        """Returns standardized states for dates, missing powers are replaced with average"""
+        states = np.hstack([df_p.reindex(index=dates, columns=self.smms).values,
+                            df_q.reindex(index=dates, columns=self.smms).values]).astype(float)
+        if self.mean is None:
+            self.mean = np.nan_to_num(np.nanmean(states, axis=0))
+            std = np.nan_to_num(np.nanstd(states, axis=0))
+            self.std = np.where(std > 0, std, 1)
+        return np.nan_to_num((states - self.mean) / self.std)
+
+    def fit(self, dates, df_p, df_q):
+        """Clusters states on dates and finds medoid date of each cluster
+
+        Returns:
+        --------
+            labels: pd.Series
+                cluster of each date
+        """
+        dates = list(pd.unique(dates))
+        states = self.get_states(dates, df_p, df_q)
+        n_clusters = min(self.n_clusters, len(dates))
+        self.kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=self.random_state)
+        labels = self.kmeans.fit_predict(states)
+        self.labels = pd.Series(labels, index=dates)
+        medoids = get_medoids(states, labels, self.kmeans.cluster_centers_)
+        self.medoids = {cluster: dates[position] for cluster, position in medoids.items()}
+        return self.labels
+
+    def predict(self, dates, df_p, df_q):
+        """Returns cluster of each date, also for dates that were not used in fit. Dates are assigned
+        to the nearest cluster with a medoid."""
+        clusters = np.array(list(self.medoids))
+        states = self.get_states(list(dates), df_p, df_q)
+        distance = np.stack([np.linalg.norm(states - self.kmeans.cluster_centers_[cluster], axis=1)
+                             for cluster in clusters], axis=1)
+        return pd.Series(clusters[np.argmin(distance, axis=1)], index=dates)
+
+    def get_weights(self):
+        """Returns share of fitted dates in each cluster"""
+        return self.labels.value_counts(normalize=True).sort_index()
@@ -1,3 +1,4 @@
+import networkx as nx
 import pandapower as pp
 import pandapower.topology as top
 
@@ -56,6 +57,46 @@ class Subnet():
             trafo_lv_bus = tps.lv_bus.values[0]
             return self.create_subnet_from_bus(trafo_lv_bus)
     
+    def create_feeder_subnet(self, feeder, other_feeders="aggregate"):
+        """Creates subnet with transformer and radial subtree of one feeder, net has to be a trafo subnet
+        with feeder column in net.load.
+        Args:
+        --------
+            feeder: str
+                name of the feeder
+            other_feeders: str
+                "aggregate": loads of other feeders are represented with one load at transformer busbar,
+                its power is set by populate_snet as sum of powers of other feeders smms
+                "ignore": other feeders are removed
+        Returns:
+        --------
+            fsnet:
+                feeder subnet, fsnet.aggregated_loads maps aggregated load index to list of smms
+        """
+        assert feeder in self.net.load.feeder.values, 'The provided feeder does not exist in the network!'
+        tr_bus = self.net.bus[self.net.bus["aclass_id"] == "TR"].index[0]
+        mg = top.create_nxgraph(self.net, respect_switches=True)
+        mg.remove_node(tr_bus)
+        load_feeders = self.net.load.groupby("bus").feeder.apply(set)
+        keep = [tr_bus]
+        for comp in nx.connected_components(mg):
+            comp_feeders = set().union(*[load_feeders.get(bus, set()) for bus in comp])
+            # components with other feeders only are removed, transformer side and the feeder are kept
+            if len(comp_feeders) == 0 or feeder in comp_feeders:
+                keep.extend(comp)
+        fsnet = pp.select_subnet(self.net, keep)
+        fsnet["aggregated_loads"] = {}
+        if other_feeders == "aggregate":
+            other_smms = self.net.load.loc[self.net.load.feeder != feeder, "smm"].tolist()
+            load_id = pp.create_load(fsnet, tr_bus, p_mw=0., q_mvar=0., name="other_feeders")
+            fsnet.load.loc[load_id, "feeder"] = "other_feeders"
+            # phases 0, so aggregated load is never used for calibration
+            fsnet.load.loc[load_id, "phases"] = 0
+            fsnet["aggregated_loads"][load_id] = other_smms
+        elif other_feeders != "ignore":
+            raise ValueError("other_feeders must be 'aggregate' or 'ignore'")
+        return fsnet
+
     def set_subnet(self, subnet):
         self.subnet = subnet
 
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from network_manipulation import adjusted_snet, run_powerflow, populate_snet
+from powerflow_backends import CompiledNetwork, SparseDirectBackend, get_backend
+
+
+class TimeseriesPowerflow:
+    """Powerflow engine for many states of a fixed network
+
+    Network is compiled once (admittance matrix and its factorization), states are solved in batches,
+    each batch is one set of fixed point iterations over a matrix of states. Powers of smms are mapped
+    to busses with a sparse incidence matrix, aggregated loads (feeder subnet) are supported.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        smms: list
+            smms (columns of power dataframes) that are mapped to loads
+        res_factor: float
+            resistance factor for lines
+        trafo_lv: float
+            transformer voltage
+    """
+
+    def __init__(self, snet, smms, res_factor=1., trafo_lv=0.425):
+        self.snet = snet
+        self.smms = list(smms)
+        self.res_factor = res_factor
+        self.trafo_lv = trafo_lv
+        with adjusted_snet(snet, res_factor, trafo_lv):
+            self.model = CompiledNetwork(snet)
+        self.create_incidence()
+
+    def create_incidence(self):
+        """Creates sparse matrix that maps smm powers to non-slack busses, constant sgen injections
+        are stored separately"""
+        model = self.model
+        smm_position = {smm: i for i, smm in enumerate(self.smms)}
+        loads = self.snet.load[self.snet.load.in_service]
+        aggregated = self.snet.get("aggregated_loads", {})
+        rows, cols, vals = [], [], []
+        for load_id, load in loads.iterrows():
+            pos = model.load_incidence([load.bus])[0]
+            if pos < 0:
+                continue
+            smms_load = aggregated.get(load_id, [load.smm])
+            for smm in smms_load:
+                if smm in smm_position:
+                    rows.append(smm_position[smm])
+                    cols.append(pos)
+                    vals.append(load.scaling)
+        self.incidence = sparse.csr_matrix((vals, (rows, cols)),
+                                           shape=(len(self.smms), len(model.pq)))
+        sgen = self.snet.sgen[self.snet.sgen.in_service]
+        self.s_sgen = np.zeros(len(model.pq), dtype=complex)
+        if len(sgen):
+            pos = model.load_incidence(sgen.bus.values)
+            valid = pos >= 0
+            np.add.at(self.s_sgen, pos[valid],
+                      ((sgen.p_mw + 1j * sgen.q_mvar) * sgen.scaling).values[valid] / model.base_mva)
+
+    def get_s_pq(self, p, q):
+        """Returns power injections in p.u. (n_pq x n_states) from powers in kW and kvar (n_states x n_smms)"""
+        s = (self.incidence.T @ (np.nan_to_num(p) + 1j * np.nan_to_num(q)).T) / 1000
+        return -s / self.model.base_mva + self.s_sgen[:, None]
+
+    def get_chunk_size(self, n_buses, max_memory_mb):
+        """Number of states solved together so that working arrays stay below max_memory_mb"""
+        # voltages, injections, mismatch, right hand side and copies of complex arrays, and results
+        bytes_per_state = 6 * 16 * len(self.model.pq) + 8 * n_buses
+        return max(1, int(max_memory_mb * 1e6 // bytes_per_state))
+
+    def run(self, df_p, df_q, buses=None, max_memory_mb=500, tolerance_mva=1e-8, max_iteration=50):
+        """Solves powerflows for all states in df_p and df_q
+
+        Args:
+        --------
+            df_p:
+                dataframe with active powers in kW, dates as index and smms as columns
+            df_q:
+                dataframe with reactive powers in kvar
+            buses: list
+                busses for which voltages are returned, if None all busses
+            max_memory_mb: float
+                memory limit for working arrays, states are solved in chunks that fit this limit
+            tolerance_mva: float
+                maximal power mismatch in MVA
+            max_iteration: int
+                maximal number of iterations
+        Returns:
+        --------
+            volts: pd.DataFrame
+                voltages in p.u. with dates as index and busses as columns
+        """
+        if buses is None:
+            buses = self.snet.bus.index.values
+        p = df_p.reindex(columns=self.smms).values
+        q = df_q.reindex(columns=self.smms).values
+        lookup = self.model.bus_lookup[np.asarray(buses, dtype=int)]
+        pq_position = self.model.pq_position[lookup]
+        is_ref = np.isin(lookup, self.model.ref)
+        v_ref = np.abs(self.model.v_ref[0])
+        volts = np.full((len(p), len(buses)), np.nan)
+        chunk = self.get_chunk_size(len(buses), max_memory_mb)
+        for start in range(0, len(p), chunk):
+            end = min(start + chunk, len(p))
+            v_pq = self.model.solve(self.get_s_pq(p[start:end], q[start:end]),
+                                    tolerance_mva=tolerance_mva,
+                                    max_iteration=max_iteration)
+            volts[start:end, pq_position >= 0] = np.abs(v_pq[pq_position[pq_position >= 0]]).T
+            volts[start:end, is_ref] = v_ref
+        return pd.DataFrame(volts, index=df_p.index, columns=buses)
+
+
+def run_timeseries_powerflow(snet, df_p, df_q, res_factor=1., trafo_lv=0.425, buses=None,
+                             max_memory_mb=500, backend=None):
+    """Calculates bus voltages for all states in df_p and df_q on fixed network
+
+    With sparse backend all states are solved in batches with one factorization, other backends
+    solve states one by one with run_powerflow and serve as reference.
+    Args:
+    --------
+        snet:
+            network in pandapower format
+        df_p:
+            dataframe with active powers in kW, dates as index and smms as columns
+        df_q:
+            dataframe with reactive powers in kvar
+        res_factor: float
+            resistance factor for lines
+        trafo_lv: float
+            transformer voltage
+        buses: list
+            busses for which voltages are returned, if None all busses
+        max_memory_mb: float
+            memory limit for working arrays of the batched solver
+        backend: str or PowerflowBackend
+            powerflow backend, if None backend for "timeseries" stage from config is used
+    Returns:
+    --------
+        volts: pd.DataFrame
+            voltages in p.u. with dates as index and busses as columns
+    """
+    backend = get_backend(backend, stage="timeseries")
+    if isinstance(backend, SparseDirectBackend):
+        engine = TimeseriesPowerflow(snet, df_p.columns, res_factor, trafo_lv)
+        return engine.run(df_p, df_q, buses=buses, max_memory_mb=max_memory_mb,
+                          tolerance_mva=backend.tolerance_mva, max_iteration=backend.max_iteration)
+    if buses is None:
+        buses = snet.bus.index.values
+    volts = []
+    for date in df_p.index:
+        populate_snet(snet, df_p.loc[date], df_q.loc[date], warn=False)
+        run_powerflow(snet, res_factor=res_factor, trafo_lv=trafo_lv, backend=backend)
+        volts.append(snet.res_bus.vm_pu.loc[buses].values)
+    return pd.DataFrame(volts, index=df_p.index, columns=buses)
@@ -0,0 +1,143 @@
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pandapower as pp
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from models.trafo_model import TrafoModel  # noqa: E402
+from models.feeder_model import FeederModel  # noqa: E402
+
+warnings.filterwarnings("ignore")
+
+FEEDER = "IZV 1"
+
+
+def make_voltage_data(n_days=10, seed=0, n_smms=5, max_depth=30, max_length=30, event_probability=0.7,
+                      headroom=4.):
+    """
+    Creates synthetic voltage data of a feeder with smms 1, ..., n_smms.
+
+    Voltages follow a daily profile with small headroom in the afternoon, so recharging is sometimes
+    slow. On most days there is an evening undervoltage event of random start, length and depth,
+    deepest at the last smm, some events last over midnight. The last smm misses phase 3 on some
+    datetimes and the first smm misses some datetimes completely.
+    Args:
+    --------
+        max_depth: float
+            maximal depth of events below 207 V at the last smm
+        max_length: int
+            maximal length of events (datetimes)
+        event_probability: float
+            probability of event on a day
+        headroom: float
+            amplitude of daily voltage profile above 207 V, small headroom makes recharging slow
+    Returns:
+    --------
+        voltage_data: pd.DataFrame
+            date_time, smm, u_1, u_2, u_3 and u_123
+        undervoltage_data: pd.DataFrame
+            rows of voltage_data with some phase below 207 V
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2024-01-01", periods=n_days * 144, freq="10min")
+    step = np.arange(len(dates)) % 144
+    base = 207 + headroom * (1.25 + np.cos(2 * np.pi * (step - 24) / 144))
+    drop = np.zeros(len(dates))
+    for day in range(n_days):
+        if rng.random() < event_probability:
+            start = day * 144 + rng.integers(110, 134)
+            stop = min(start + rng.integers(2, max_length), len(dates))
+            drop[start:stop] = base[start:stop] - 207 + rng.uniform(1, max_depth)
+    frames = []
+    for k in range(1, n_smms + 1):
+        volts = base - drop * k / n_smms
+        frame = pd.DataFrame({"date_time": dates, "smm": k})
+        for phase, offset in zip((1, 2, 3), (-0.5, 0., 0.5)):
+            frame["u_{}".format(phase)] = volts + offset + rng.normal(0, 0.2, len(dates))
+        if k == n_smms:
+            frame.loc[rng.random(len(dates)) < 0.02, "u_3"] = np.nan
+        if k == 1:
+            frame = frame[rng.random(len(dates)) > 0.02]
+        frames.append(frame)
+    voltage_data = pd.concat(frames).sort_values(["date_time", "smm"], ignore_index=True)
+    voltage_data["u_123"] = voltage_data[["u_1", "u_2", "u_3"]].mean(axis=1)
+    undervoltage_data = voltage_data[voltage_data[["u_1", "u_2", "u_3"]].min(axis=1) < 207]
+    return voltage_data, undervoltage_data
+
+
+def make_feeder(voltage_data, undervoltage_data, n_smms=5):
+    """Returns feeder model of a one feeder network with synthetic data, battery at the last smm and
+    slopes increasing along the feeder, so no powerflows are needed"""
+    net = pp.create_empty_network()
+    for k in range(1, n_smms + 1):
+        bus = pp.create_bus(net, 0.4)
+        pp.create_load(net, bus, p_mw=0.005, smm=k)
+    net.load["feeder"] = FEEDER
+    tm = TrafoModel(None, None, None, None, None, "T999- TEST", None)
+    tm.voltage_data = voltage_data
+    tm.undervoltage_data = undervoltage_data
+    tm.enough_voltage_data = True
+    tm.snet = net
+    tm.feeders = [FEEDER]
+    fm = FeederModel(tm, FEEDER)
+    fm.battery_smm = n_smms
+    fm.slopes = pd.DataFrame({str(n_smms): 0.05 * np.arange(1, n_smms + 1)}, index=range(1, n_smms + 1))
+    fm.suitable_for_battery = True
+    return fm
+
+
+def make_network(n_feeders=1, n_smms=5):
+    """Returns network with transformer and a chain of n_smms loads on each of n_feeders feeders IZV 1,
+    IZV 2, ..., smms of feeder f are (f - 1) * n_smms + 1, ..., f * n_smms"""
+    net = pp.create_empty_network()
+    hv = pp.create_bus(net, 20.)
+    busbar = pp.create_bus(net, 0.4)
+    net.bus["aclass_id"] = None
+    net.bus.at[busbar, "aclass_id"] = "TR"
+    pp.create_ext_grid(net, hv)
+    pp.create_transformer(net, hv, busbar, "0.4 MVA 20/0.4 kV")
+    for f in range(1, n_feeders + 1):
+        previous = busbar
+        for k in range((f - 1) * n_smms + 1, f * n_smms + 1):
+            bus = pp.create_bus(net, 0.4)
+            pp.create_line_from_parameters(net, previous, bus, length_km=0.1, r_ohm_per_km=0.6,
+                                           x_ohm_per_km=0.08, c_nf_per_km=0., max_i_ka=0.2,
+                                           name="IZV {}".format(f))
+            pp.create_load(net, bus, p_mw=0.005, smm=k, feeder="IZV {}".format(f))
+            previous = bus
+    return net
+
+
+def make_trafo(n_feeders=1, n_smms=5, n_days=4):
+    """Returns trafo model of make_network with synthetic voltage data (make_voltage_data, different seed
+    for each feeder) and powers, that are higher at datetimes with lower voltages"""
+    frames = []
+    for f in range(n_feeders):
+        voltage_data, _ = make_voltage_data(n_days=n_days, seed=f, n_smms=n_smms)
+        voltage_data["smm"] += f * n_smms
+        frames.append(voltage_data)
+    voltage_data = pd.concat(frames).sort_values(["date_time", "smm"], ignore_index=True)
+    # columns added by Preprocess
+    voltage_data["min_u"] = voltage_data[["u_1", "u_2", "u_3"]].min(axis=1) / 230
+    voltage_data["avg_u"] = voltage_data[["u_1", "u_2", "u_3"]].mean(axis=1) / 230
+    undervoltage_data = voltage_data[voltage_data.min_u < 207 / 230]
+    df_vol = voltage_data.pivot_table(index="date_time", columns="smm", values="u_123")
+    df_p = (2 + (df_vol.max() - df_vol) / 2).fillna(2.)
+    df_q = df_p / 5
+    tm = TrafoModel(None, None, df_vol, df_p, df_q, "T999- TEST", None)
+    tm.voltage_data = voltage_data
+    tm.undervoltage_data = undervoltage_data
+    tm.enough_voltage_data = True
+    tm.snet = make_network(n_feeders, n_smms)
+    tm.feeders = ["IZV {}".format(f) for f in range(1, n_feeders + 1)]
+    return tm
+
+
+@pytest.fixture
+def feeder():
+    return make_feeder(*make_voltage_data())
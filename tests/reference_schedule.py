@@ -0,0 +1,81 @@
+"""Battery schedule with the original loop over datetimes and smms, reference for vectorized schedules"""
+import numpy as np
+import pandas as pd
+
+
+def get_phase_diffs(vol_state, smm, vol_lim, missing_diff):
+    """Returns voltage deviations of phases of smm from vol_lim, missing_diff for missing phases"""
+    rows = vol_state[vol_state.smm == smm]
+    diffs = []
+    for column in ("u_1", "u_2", "u_3"):
+        if len(rows) == 0 or not np.isfinite(rows[column].values[0]):
+            diffs.append(missing_diff)
+        else:
+            diffs.append(vol_lim * 230 - rows[column].values[0])
+    return diffs
+
+
+def get_needed_power(bm, vol_state, charging, missing_diff):
+    """Maximum over smms of power needed to fix (or allowed by) voltages of vol_state"""
+    powers_list = []
+    for smm in bm.smms:
+        slope = bm.slopes[str(bm.battery_smm)][smm]
+        p1, p2, p3 = [diff / slope / 3 for diff in get_phase_diffs(vol_state, smm, bm.vol_lim, missing_diff)]
+        if not bm.fix_all_phases:
+            powers_list.append(p1 + p2 + p3)
+        elif charging:
+            powers_list.append(p1 * (p1 < 0) + p2 * (p2 < 0) + p3 * (p3 < 0))
+        else:
+            powers_list.append(p1 * (p1 > 0) + p2 * (p2 > 0) + p3 * (p3 > 0))
+    return max(powers_list)
+
+
+def reference_schedule(bm):
+    """
+    Calculates schedule of battery model bm datetime by datetime.
+
+    Returns:
+    --------
+        battery_df: pd.DataFrame
+            battery_power (and soc, if powers_with_charging) indexed by date_time
+        capacity: float
+            needed battery capacity, kWh
+    """
+    uv_dates = set(bm.undervoltage_data.date_time.unique())
+    states = dict(tuple(bm.voltage_data.groupby("date_time")))
+    powers, socs = [], []
+    soc = 0.
+    dates = bm.voltage_data.date_time.unique()
+    for date in dates:
+        is_uv = date in uv_dates
+        if bm.powers_with_charging:
+            if is_uv or soc < 0:
+                sp_max = get_needed_power(bm, states[date], not is_uv, -5000.)
+                if sp_max < bm.max_power_charging:
+                    if not is_uv and sp_max < soc * 6:
+                        sp_max = soc * 6
+                        soc = 0
+                    else:
+                        soc -= sp_max / 6
+                else:
+                    sp_max = 0
+            else:
+                sp_max = 0
+            socs.append(soc)
+        else:
+            sp_max = get_needed_power(bm, states[date], False, 0.) if is_uv else 0
+            if not sp_max < bm.max_power:
+                sp_max = 0
+        powers.append(sp_max)
+    battery_df = pd.DataFrame({"battery_power": powers}, index=pd.Index(dates, name="date_time"))
+    if bm.powers_with_charging:
+        battery_df["soc"] = socs
+        return battery_df, -1 * min(socs)
+    max_sum, current_sum = 0, 0
+    for value in powers:
+        if value == 0:
+            max_sum = max(max_sum, current_sum)
+            current_sum = 0
+        else:
+            current_sum += value
+    return battery_df, max_sum / 6
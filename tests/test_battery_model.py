@@ -0,0 +1,129 @@
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from models.battery_model import BatteryModel
+from reference_schedule import reference_schedule
+
+
+def calculate(fm, **attributes):
+    """Returns battery model of feeder with attributes, after battery characteristics are calculated"""
+    bm = BatteryModel(fm)
+    for name, value in attributes.items():
+        setattr(bm, name, value)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bm.calculate_battery_characteristics()
+    return bm
+
+
+@pytest.mark.parametrize("powers_with_charging", [True, False])
+@pytest.mark.parametrize("fix_all_phases", [True, False])
+@pytest.mark.parametrize("vol_lim", [207 / 230, 212 / 230])
+def test_vectorized_schedule_matches_loop(feeder, powers_with_charging, fix_all_phases, vol_lim):
+    bm = calculate(feeder, powers_with_charging=powers_with_charging, fix_all_phases=fix_all_phases,
+                   vol_lim=vol_lim)
+    battery_df, capacity = reference_schedule(bm)
+    pd.testing.assert_frame_equal(bm.battery_df[battery_df.columns], battery_df, check_exact=False,
+                                  check_index_type=False)
+    assert bm.battery_capacity == pytest.approx(capacity)
+    assert bm.battery_power == pytest.approx(battery_df.battery_power.max())
+    energy = battery_df.battery_power[battery_df.battery_power > 0].sum() / 6
+    assert bm.battery_cycles == pytest.approx(energy / capacity)
+
+
+@pytest.mark.parametrize("fix_all_phases", [True, False])
+@pytest.mark.parametrize("vol_lim", [207 / 230, 212 / 230])
+def test_event_driven_schedule_matches_dense(feeder, fix_all_phases, vol_lim):
+    dense = calculate(feeder, fix_all_phases=fix_all_phases, vol_lim=vol_lim)
+    events = calculate(feeder, fix_all_phases=fix_all_phases, vol_lim=vol_lim, event_driven=True)
+    # idle datetimes are not simulated
+    pd.testing.assert_frame_equal(events.battery_df, dense.battery_df.loc[events.battery_df.index])
+    assert (dense.battery_df.drop(events.battery_df.index).battery_power == 0).all()
+    assert events.battery_capacity == dense.battery_capacity
+    assert events.battery_power == dense.battery_power
+    assert events.battery_cycles == pytest.approx(dense.battery_cycles)
+    assert events.N_of_unresolved == dense.N_of_unresolved
+
+
+def start_rolling(fm, voltage_data, undervoltage_data, **attributes):
+    """Returns battery model with rolling schedule started on given data"""
+    bm = BatteryModel(fm)
+    bm.voltage_data = voltage_data
+    bm.undervoltage_data = undervoltage_data
+    for name, value in attributes.items():
+        setattr(bm, name, value)
+    bm.start_rolling_schedule()
+    return bm
+
+
+@pytest.mark.parametrize("powers_with_charging", [True, False])
+def test_rolling_schedule_matches_full_schedule(feeder, powers_with_charging):
+    dense = calculate(feeder, powers_with_charging=powers_with_charging)
+    rolling = start_rolling(feeder, feeder.voltage_data, feeder.undervoltage_data,
+                            powers_with_charging=powers_with_charging)
+    pd.testing.assert_frame_equal(rolling.battery_df, dense.battery_df[rolling.battery_df.columns],
+                                  check_index_type=False)
+    assert rolling.battery_capacity == dense.battery_capacity
+    assert rolling.battery_power == dense.battery_power
+    assert rolling.N_of_unresolved == dense.N_of_unresolved
+
+
+@pytest.mark.parametrize("powers_with_charging", [True, False])
+def test_rolling_updates_match_recalculation(feeder, tmp_path, powers_with_charging):
+    voltage_data, undervoltage_data = feeder.voltage_data, feeder.undervoltage_data
+    days = voltage_data.date_time.dt.normalize()
+    uv_days = undervoltage_data.date_time.dt.normalize()
+    first_days = sorted(days.unique())
+    window = pd.Timedelta(days=3)
+    bm = start_rolling(feeder, voltage_data[days < first_days[4]], undervoltage_data[uv_days < first_days[4]],
+                       powers_with_charging=powers_with_charging)
+    path = tmp_path / "rolling_schedule.pkl"
+    for day in first_days[4:]:
+        bm.save_rolling_schedule(path)
+        bm = BatteryModel(feeder)
+        bm.powers_with_charging = powers_with_charging
+        bm.load_rolling_schedule(path)
+        bm.update_rolling_schedule(voltage_data[days == day], undervoltage_data[uv_days == day], window=window)
+        start = pd.Timestamp(bm.rolling_schedule.dates[-1]) - window
+        in_window = (voltage_data.date_time >= start) & (days <= day)
+        uv_in_window = (undervoltage_data.date_time >= start) & (uv_days <= day)
+        reference = start_rolling(feeder, voltage_data[in_window], undervoltage_data[uv_in_window],
+                                  powers_with_charging=powers_with_charging)
+        np.testing.assert_array_equal(bm.rolling_schedule.powers, reference.rolling_schedule.powers)
+        np.testing.assert_array_equal(bm.rolling_schedule.socs, reference.rolling_schedule.socs)
+        assert bm.battery_capacity == reference.battery_capacity
+        assert bm.N_of_unresolved == reference.N_of_unresolved
+
+
+def set_phase_slopes(fm):
+    """Sets per phase slopes of the feeder, phases differ by 10 %"""
+    column = str(fm.battery_smm)
+    fm.phase_slopes = {None: {phase: pd.DataFrame({column: fm.slopes[column] * (0.9 + 0.1 * phase)})
+                              for phase in (1, 2, 3)}}
+
+
+@pytest.mark.parametrize("powers_with_charging", [True, False])
+@pytest.mark.parametrize("phase_slopes", [True, False])
+def test_sweep_matches_schedule(feeder, powers_with_charging, phase_slopes):
+    if phase_slopes:
+        set_phase_slopes(feeder)
+    vol_lims = [207 / 230, 212 / 230]
+    bm = BatteryModel(feeder)
+    bm.powers_with_charging = powers_with_charging
+    sweep_df = bm.sweep(vol_lims)
+    for row in sweep_df.itertuples():
+        expected = calculate(feeder, powers_with_charging=powers_with_charging, vol_lim=row.vol_lim,
+                             fix_all_phases=row.fix_all_phases)
+        assert row.battery_capacity == pytest.approx(expected.battery_capacity)
+        assert row.battery_power == pytest.approx(expected.battery_power)
+        assert row.unresolved_minutes == expected.N_of_unresolved * 10
+
+
+def test_sweep_closed_loop_raises(feeder):
+    bm = BatteryModel(feeder)
+    bm.closed_loop = True
+    with pytest.raises(ValueError):
+        bm.sweep([207 / 230])
@@ -0,0 +1,43 @@
+import contextlib
+import io
+
+import pytest
+
+from conftest import FEEDER, make_trafo
+from models.feeder_model import FeederModel
+from battery_siting import place_batteries
+
+
+@pytest.fixture(scope="module")
+def network_feeder():
+    """Feeder with network and power data, battery site is searched and units are placed"""
+    fm = FeederModel(make_trafo(), FEEDER)
+    fm.search_battery_smm = True
+    fm.max_batteries = 3
+    with contextlib.redirect_stdout(io.StringIO()):
+        fm.calculate_uv_data_and_slopes()
+    return fm
+
+
+def test_rank_battery_smms(network_feeder):
+    ranking = network_feeder.site_ranking
+    assert sorted(ranking.index) == sorted(network_feeder.smms)
+    assert network_feeder.battery_smm == ranking.index[0]
+    assert ranking.N_of_unresolved.is_monotonic_increasing
+    # slopes grow along the feeder, so the battery at its end needs the least energy
+    assert ranking.index[0] == max(network_feeder.smms)
+    assert (ranking.battery_capacity > 0).all()
+
+
+def test_place_batteries(network_feeder):
+    units = network_feeder.battery_units
+    assert units.battery_smm.iloc[0] == network_feeder.battery_smm
+    assert units.N_of_unresolved.iloc[-1] == 0
+
+
+def test_place_batteries_with_limited_power(network_feeder):
+    units = place_batteries(network_feeder, max_batteries=3, max_power=20.)
+    assert len(units) > 1
+    assert units.battery_smm.is_unique
+    assert (units.battery_power <= 20. + 1e-9).all()
+    assert units.N_of_unresolved.is_monotonic_decreasing
@@ -0,0 +1,50 @@
+import contextlib
+import io
+
+from conftest import FEEDER, make_trafo
+from powerflow_backends import CountingBackend, get_backend
+from slope_calculation import calibrate_dates, calculate_slopes, select_dates
+from utils import get_feeder_smms
+
+
+def test_feeders_have_separate_entries():
+    tm = make_trafo(n_feeders=2)
+    dates = list(tm.undervoltage_data.date_time.unique()[:2])
+    cache = tm.calibration_cache
+    calibration = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for feeder in tm.feeders:
+            smms = get_feeder_smms(tm.snet, feeder)
+            calibration[feeder] = calibrate_dates(tm.snet, dates, smms, tm.df_p, tm.df_q, tm.df_vol,
+                                                  method="gauss_newton", calibration_cache=cache)
+    # joint calibration of the second feeder is fitted to its own smms, not taken from the first feeder
+    assert cache.hits == 0
+    assert len(cache.entries) == 2 * len(dates)
+    assert calibration["IZV 1"] != calibration["IZV 2"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for feeder in tm.feeders:
+            smms = get_feeder_smms(tm.snet, feeder)
+            cached = calibrate_dates(tm.snet, dates, smms, tm.df_p, tm.df_q, tm.df_vol, method="gauss_newton",
+                                     calibration_cache=cache)
+            assert cached == calibration[feeder]
+    assert cache.hits == 2 * len(dates)
+
+
+def test_base_case_is_reused_only_with_same_backend():
+    tm = make_trafo()
+    dates = list(tm.undervoltage_data.date_time.unique())
+    dates_cal = select_dates(dates, N_of_dates=2)
+    smms = get_feeder_smms(tm.snet, FEEDER)
+    cache = tm.calibration_cache
+    with contextlib.redirect_stdout(io.StringIO()):
+        calibrate_dates(tm.snet, dates_cal, smms, tm.df_p, tm.df_q, tm.df_vol, backend="pandapower",
+                        calibration_cache=cache)
+        counts = {}
+        for name in ("pandapower", "sparse"):
+            backend = CountingBackend(get_backend(name))
+            calculate_slopes(tm.snet, smms[-1:], dates, smms, tm.df_p, tm.df_q, tm.df_vol, N_of_dates=2,
+                             backend=backend, calibration_backend="pandapower", calibration_cache=cache)
+            counts[name] = backend.count
+    assert all(entry["backend"] == "pandapower" for entry in cache.entries.values())
+    # base case of other backend is calculated again, otherwise only perturbed powerflows are run
+    assert counts == {"pandapower": len(dates_cal), "sparse": 2 * len(dates_cal)}
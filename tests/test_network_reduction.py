@@ -0,0 +1,53 @@
+import pandapower as pp
+import pytest
+
+from network_reduction import reduce_snet
+
+
+def make_network():
+    """Returns network with a measured end of feeder, an unloaded dead end with large capacitance and
+    lines from a bus to itself"""
+    net = pp.create_empty_network()
+    hv = pp.create_bus(net, 20.)
+    busbar = pp.create_bus(net, 0.4)
+    net.bus["aclass_id"] = None
+    net.bus.at[busbar, "aclass_id"] = "TR"
+    pp.create_ext_grid(net, hv)
+    pp.create_transformer(net, hv, busbar, "0.4 MVA 20/0.4 kV")
+    junction, end, dead_1, dead_2 = [pp.create_bus(net, 0.4) for _ in range(4)]
+    for from_bus, to_bus in ((busbar, junction), (junction, end), (junction, dead_1), (dead_1, dead_2),
+                             (junction, junction), (end, end)):
+        pp.create_line_from_parameters(net, from_bus, to_bus, length_km=0.5, r_ohm_per_km=0.2,
+                                       x_ohm_per_km=0.08, c_nf_per_km=2000., max_i_ka=0.3)
+    pp.create_load(net, end, p_mw=0.05, q_mvar=0.01, smm=1)
+    return net, end
+
+
+def test_reduction_keeps_capacitance():
+    net, end = make_network()
+    pp.runpp(net)
+    # only the dead end is removed, lumping its capacitance is exact up to charging current along it
+    reduced = reduce_snet(net, max_degree=1)
+    assert len(reduced.bus) == 4
+    assert not (reduced.line.from_bus == reduced.line.to_bus).any()
+    pp.runpp(reduced)
+    assert reduced.res_bus.at[end, "vm_pu"] == pytest.approx(net.res_bus.at[end, "vm_pu"], abs=1e-7)
+    assert reduced.res_ext_grid.q_mvar.sum() == pytest.approx(net.res_ext_grid.q_mvar.sum(), abs=1e-7)
+
+
+def test_reduction_of_double_cable_spur():
+    # eliminating x gives a branch from a to itself, a is then a dead end and is eliminated too
+    net, end = make_network()
+    busbar = net.bus.index[net.bus.aclass_id == "TR"][0]
+    a, x = pp.create_bus(net, 0.4), pp.create_bus(net, 0.4)
+    for from_bus, to_bus in ((busbar, a), (a, x), (a, x)):
+        pp.create_line_from_parameters(net, from_bus, to_bus, length_km=0.5, r_ohm_per_km=0.2,
+                                       x_ohm_per_km=0.08, c_nf_per_km=2000., max_i_ka=0.3)
+    pp.runpp(net)
+    # junction of make_network is kept, so only dead ends are removed
+    reduced = reduce_snet(net, keep_buses=[net.line.at[0, "to_bus"]])
+    assert a not in reduced.bus.index and x not in reduced.bus.index
+    assert not (reduced.line.from_bus == reduced.line.to_bus).any()
+    pp.runpp(reduced)
+    assert reduced.res_bus.at[end, "vm_pu"] == pytest.approx(net.res_bus.at[end, "vm_pu"], abs=1e-7)
+    assert reduced.res_ext_grid.q_mvar.sum() == pytest.approx(net.res_ext_grid.q_mvar.sum(), abs=1e-7)
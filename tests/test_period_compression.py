@@ -0,0 +1,57 @@
+import contextlib
+import io
+
+import pandas as pd
+import pytest
+
+from conftest import make_voltage_data, make_feeder
+from period_compression import calculate_compression_error
+from test_battery_model import calculate
+
+
+@pytest.fixture(params=[0, 1, 6])
+def long_feeder(request):
+    # rare events with slow recharging, that lasts beyond the kept day after the event, but ends before
+    # the next event, so capacity is the energy of the largest event
+    return make_feeder(*make_voltage_data(n_days=60, seed=request.param, max_depth=20, event_probability=0.15,
+                                          headroom=1.))
+
+
+@pytest.mark.parametrize("powers_with_charging", [True, False])
+def test_compressed_capacity_matches_full(long_feeder, powers_with_charging):
+    full = calculate(long_feeder, powers_with_charging=powers_with_charging)
+    long_feeder.tm.compress_period(n_representative=5, n_extreme=3)
+    assert long_feeder.tm.period_compression.get_compression_ratio() < 0.5
+    compressed = calculate(long_feeder, powers_with_charging=powers_with_charging)
+    assert compressed.voltage_data.date_time.nunique() < full.voltage_data.date_time.nunique()
+    # the largest event is on an extreme day
+    assert compressed.battery_capacity == pytest.approx(full.battery_capacity)
+    assert compressed.battery_power == pytest.approx(full.battery_power)
+
+
+def test_compressed_event_driven_matches_dense(long_feeder):
+    long_feeder.tm.compress_period(n_representative=5, n_extreme=3)
+    dense = calculate(long_feeder)
+    events = calculate(long_feeder, event_driven=True)
+    pd.testing.assert_frame_equal(events.battery_df, dense.battery_df.loc[events.battery_df.index])
+    assert events.battery_capacity == dense.battery_capacity
+    assert events.battery_cycles == pytest.approx(dense.battery_cycles)
+
+
+def test_compression_error(long_feeder):
+    long_feeder.tm.compress_period(n_representative=5, n_extreme=3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        error_df = calculate_compression_error(long_feeder, long_feeder.tm.period_compression)
+    assert abs(error_df.at["battery_capacity", "relative_error"]) < 1e-9
+    assert abs(error_df.at["battery_cycles", "relative_error"]) < 0.2
+
+
+@pytest.mark.parametrize("method", ["sweep", "monte_carlo", "start_rolling_schedule"])
+def test_unsupported_methods_raise(long_feeder, method):
+    long_feeder.tm.compress_period(n_representative=5, n_extreme=3)
+    bm = calculate(long_feeder)
+    with pytest.raises(ValueError):
+        if method == "sweep":
+            bm.sweep([207 / 230])
+        else:
+            getattr(bm, method)()
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+from state_clustering import StateClustering
+
+
+def test_fewer_distinct_states_than_clusters():
+    # two distinct states repeated, KMeans leaves the other clusters empty
+    dates = pd.date_range("2024-01-01", periods=10, freq="10min")
+    df_p = pd.DataFrame({1: [1., 5.] * 5, 2: [2., 8.] * 5}, index=dates)
+    df_q = df_p / 10
+    clustering = StateClustering([1, 2], n_clusters=4)
+    labels = clustering.fit(dates, df_p, df_q)
+    assert len(clustering.medoids) == 2
+    assert set(labels) == set(clustering.medoids)
+    assert clustering.get_weights().tolist() == [0.5, 0.5]
+    predicted = clustering.predict(dates, df_p, df_q)
+    assert np.isin(predicted, list(clustering.medoids)).all()
+    assert (predicted.values == labels.values).all()